@@ -0,0 +1,39 @@
+# Jalali conversion of whole arrays against the per-date Gregorian and Persian classes
+# Run from the repository root: python benchmarks/bench_jalali.py
+
+import datetime
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jalali import Gregorian, Persian, gregorian_to_jalali, jalali_to_gregorian, ordinal_to_gregorian
+
+
+def benchmark(n=100000):
+    import time
+    import numpy as np
+    rng = np.random.default_rng(0)
+    ordinals = rng.integers(datetime.date(1990, 1, 1).toordinal(), datetime.date(2030, 1, 1).toordinal(), n)
+    dates = [datetime.date.fromordinal(int(o)) for o in ordinals]
+    year, month, day = ordinal_to_gregorian(ordinals)
+
+    start = time.perf_counter()
+    expected = [Gregorian(date).persian_tuple() for date in dates]
+    per_object = time.perf_counter() - start
+    start = time.perf_counter()
+    jy, jm, jd = gregorian_to_jalali(year, month, day)
+    vectorized = time.perf_counter() - start
+    assert expected == list(zip(jy.tolist(), jm.tolist(), jd.tolist()))
+    print(f"Gregorian to Jalali of {n} dates: per object {per_object:.3f}s, arrays {vectorized:.4f}s")
+
+    start = time.perf_counter()
+    expected = [Persian(*date).gregorian_tuple() for date in zip(jy.tolist(), jm.tolist(), jd.tolist())]
+    per_object = time.perf_counter() - start
+    start = time.perf_counter()
+    gy, gm, gd = jalali_to_gregorian(jy, jm, jd)
+    vectorized = time.perf_counter() - start
+    assert expected == list(zip(gy.tolist(), gm.tolist(), gd.tolist()))
+    print(f"Jalali to Gregorian of {n} dates: per object {per_object:.3f}s, arrays {vectorized:.4f}s")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,63 @@
+## Grid of the datasource cells: the pivot of process.json_from_data against the row by row .loc assignments it replaced
+## Run from the repository root: python benchmarks/bench_process.py
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import pandas as pd
+from process import json_from_data
+
+## Cells of a datasource table with several periods: header rows with the dates, a شرح column per period and numeric bodies
+def benchmark_cells(rows=400, periods=4, columns=3, seed=0):
+    rng = np.random.default_rng(seed)
+    cells = []
+    n_columns = periods * (columns + 1)
+    for row in range(1, rows + 1):
+        for column in range(1, n_columns + 1):
+            period, position = divmod(column - 1, columns + 1)
+            if row <= 2:
+                value = 'شرح' if position == 0 else f'{1400 + period}/12/29' if row == 1 else f'ستون {position}'
+                group = 'Header'
+            elif position > 0 and rng.random() < 0.1:
+                continue
+            else:
+                value = f'ردیف {row}' if position == 0 else float(rng.integers(-10**9, 10**9))
+                group = 'Body'
+            cells.append(dict(cellGroupName=group, rowSequence=row, columnSequence=column, value=value))
+    return pd.DataFrame(cells)
+
+def benchmark(tables=5, rows=400, periods=4):
+    import time
+    frames = [benchmark_cells(rows, periods, seed=seed) for seed in range(tables)]
+
+    ## The grid as it was built before, one .loc assignment per row
+    def rows_grid(df_con_dd):
+        cons = pd.DataFrame(columns=sorted(df_con_dd['columnSequence'].unique()))
+        for ind, group in df_con_dd.groupby('rowSequence'):
+            construct_row = group.T.set_axis(group['columnSequence'], axis='columns')
+            cons.loc[ind] = construct_row.loc['value']
+        return cons
+
+    def pivot_grid(df_con_dd):
+        return df_con_dd.astype({'value': object}).pivot(index='rowSequence', columns='columnSequence', values='value').rename_axis(index=None, columns=None)
+
+    start = time.perf_counter()
+    expected = [rows_grid(df) for df in frames]
+    by_rows = time.perf_counter() - start
+    start = time.perf_counter()
+    grids = [pivot_grid(df) for df in frames]
+    pivoted = time.perf_counter() - start
+    for grid, cons in zip(grids, expected):
+        assert grid.index.tolist() == cons.index.tolist() and grid.columns.tolist() == cons.columns.tolist()
+        assert grid.fillna('').equals(cons.fillna('').astype(object))
+    start = time.perf_counter()
+    for df in frames:
+        json_from_data(df)
+    tables_time = time.perf_counter() - start
+    print(f"Grid of {tables} tables of {rows} rows and {periods} periods: by rows {by_rows:.3f}s, pivot {pivoted:.4f}s, "
+          f"json_from_data {tables_time:.3f}s")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,98 @@
+## Persistent cache of downloaded pages keyed by (trace_no, sheet_id), kept between runs outside the dated folder
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+class DownloadCache:
+    def __init__(self, path, fresh_for=7*24*3600, max_age=30*24*3600, max_bytes=2*1024**3):
+        self.path = path
+        self.fresh_for = fresh_for
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(path, 'bodies'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS entries (
+                trace_no TEXT, sheet_id TEXT, sha256 TEXT, etag TEXT, last_modified TEXT,
+                fetched_at REAL, size INTEGER, PRIMARY KEY (trace_no, sheet_id))''')
+
+    def body_path(self, sha256):
+        return os.path.join(self.path, 'bodies', sha256)
+
+    def get(self, trace_no, sheet_id):
+        with self.lock:
+            row = self.db.execute('SELECT sha256, etag, last_modified, fetched_at, size FROM entries WHERE trace_no=? AND sheet_id=?',
+                                  (str(trace_no), str(sheet_id))).fetchone()
+        if row is None or not os.path.exists(self.body_path(row[0])):
+            return None
+        return dict(trace_no=str(trace_no), sheet_id=str(sheet_id), sha256=row[0], etag=row[1], last_modified=row[2], fetched_at=row[3], size=row[4])
+
+    def body(self, entry):
+        with open(self.body_path(entry['sha256']), 'r', encoding='utf-8') as bodyfile:
+            return bodyfile.read()
+
+    def is_fresh(self, entry):
+        return time.time() - entry['fetched_at'] < self.fresh_for
+
+    ## Headers for revalidating a stale entry
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, trace_no, sheet_id, text, etag=None, last_modified=None):
+        content = text.encode('utf-8')
+        sha256 = hashlib.sha256(content).hexdigest()
+        if not os.path.exists(self.body_path(sha256)):
+            tmp_path = self.body_path(sha256) + f'.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as bodyfile:
+                bodyfile.write(content)
+            os.replace(tmp_path, self.body_path(sha256))
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (str(trace_no), str(sheet_id), sha256, etag, last_modified, time.time(), len(content)))
+
+    ## Mark an entry as fetched now, after the server answered 304
+    def touch(self, trace_no, sheet_id):
+        with self.lock, self.db:
+            self.db.execute('UPDATE entries SET fetched_at=? WHERE trace_no=? AND sheet_id=?', (time.time(), str(trace_no), str(sheet_id)))
+
+    ## Drop entries older than max_age, then the oldest ones until the cache fits in max_bytes
+    def evict(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM entries WHERE fetched_at < ?', (time.time() - self.max_age,))
+            total = 0
+            stale = []
+            for trace_no, sheet_id, size in self.db.execute('SELECT trace_no, sheet_id, size FROM entries ORDER BY fetched_at DESC').fetchall():
+                total += size
+                if total > self.max_bytes:
+                    stale.append((trace_no, sheet_id))
+            self.db.executemany('DELETE FROM entries WHERE trace_no=? AND sheet_id=?', stale)
+            in_use = {row[0] for row in self.db.execute('SELECT DISTINCT sha256 FROM entries')}
+        removed = 0
+        for name in os.listdir(os.path.join(self.path, 'bodies')):
+            if name not in in_use:
+                try:
+                    os.remove(self.body_path(name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+## Cache configured from the environment, CODAL_CACHE=0 disables it
+def cache_from_env():
+    if os.getenv('CODAL_CACHE', '1') == '0':
+        return None
+    return DownloadCache(
+        path=os.getenv('CODAL_CACHE_DIR', '.codal-cache'),
+        fresh_for=float(os.getenv('CODAL_CACHE_FRESH_HOURS', 7*24)) * 3600,
+        max_age=float(os.getenv('CODAL_CACHE_MAX_AGE_DAYS', 30)) * 24 * 3600,
+        max_bytes=float(os.getenv('CODAL_CACHE_MAX_MB', 2048)) * 1024**2,
+    )
@@ -0,0 +1,272 @@
+## Asynchronous codal.ir client: search api paging, report pages, sub sheets and the excel fallback
+
+import asyncio
+import aiohttp
+import logging
+import math
+import os
+import random
+import threading
+import time
+from itertools import chain
+from download import headers_html, headers_excel, download_workers, sheet_url, write_sheet, get_cache, valid_body, valid_entry
+from parsing import sheet_document
+from ledger import ledger
+
+logger = logging.getLogger('download')
+logger_list = logging.getLogger('main')
+
+headers_search = {
+    'Accept': 'application/json',
+    'Accept-Language': 'en-US,en;q=0.9,fa;q=0.8',
+    'Cache-Control': 'max-age=0',
+    'Connection': 'keep-alive',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Sec-Fetch-User': '?1',
+    'Upgrade-Insecure-Requests': '1',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36',
+    'sec-ch-ua': '"Google Chrome";v="135", "Not-A.Brand";v="8", "Chromium";v="135"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+}
+
+search_url = 'https://search.codal.ir/api/search/v2/q?&LetterType=6&FromDate={date_j}&PageNumber={n_page}&CompanyType=1'
+status_forcelist = [500, 502, 503, 504]
+
+class ResponseError(Exception):
+    pass
+
+class ListError(Exception):
+    pass
+
+## Token bucket for the event loop, same semantics as download.TokenBucket
+class AsyncTokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class CodalClient:
+    def __init__(self, concurrency=download_workers, rate=float(os.getenv('CODAL_RATE_LIMIT', 5)),
+                 retries=6, backoff_factor=0.3, timeout=20, search_url=search_url):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.search_url = search_url
+        self.session = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.rate_limiter = AsyncTokenBucket(self.rate)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    ## GET with retries on connection errors and status_forcelist, backoff is jittered
+    async def get(self, url, headers, as_json=False, response_headers=None):
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.semaphore:
+                    await self.rate_limiter.acquire()
+                    async with self.session.get(url, headers=headers) as response:
+                        if response.status not in status_forcelist or attempt == self.retries:
+                            if response_headers is not None:
+                                response_headers.update(response.headers)
+                            if as_json and response.status == 200:
+                                return response.status, await response.json(content_type=None)
+                            return response.status, await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(random.uniform(0, self.backoff_factor * (2 ** attempt)))
+
+    ## GET through the download cache, same policy as download.cached_get
+    async def cached_get(self, trace_no, sheet_id, url, headers, refresh=False):
+        cache = get_cache()
+        entry = await asyncio.to_thread(valid_entry, trace_no, sheet_id)
+        if entry and not refresh and cache.is_fresh(entry):
+            return 200, cache.body(entry)
+        if entry:
+            headers = dict(headers, **cache.conditional_headers(entry))
+        response_headers = {}
+        status, text = await self.get(url, headers, response_headers=response_headers)
+        if status == 304 and entry:
+            cache.touch(trace_no, sheet_id)
+            return 200, cache.body(entry)
+        if status == 200 and cache and await asyncio.to_thread(valid_body, sheet_id, text):
+            cache.put(trace_no, sheet_id, text, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+        return status, text
+
+    async def search_page(self, date_j, n_page):
+        status, body = await self.get(self.search_url.format(date_j=date_j, n_page=n_page), headers_search, as_json=True)
+        if status != 200:
+            raise ResponseError(f'Response status {status}')
+        return body
+
+    ## Number of search pages, from the page count or the total letters reported by the first page
+    @staticmethod
+    def page_count(body):
+        if body.get('Page'):
+            return int(body['Page'])
+        if body.get('Total') and len(body['Letters']) > 0:
+            return math.ceil(int(body['Total']) / len(body['Letters']))
+        return None
+
+    ## A search page, a page that fails raises ListError so a part of the list is never taken for the list of the date
+    async def list_page(self, date_j, n_page):
+        try:
+            return await self.search_page(date_j, n_page)
+        except Exception as e_list_codal:
+            logger_list.info(f'[List Error] Page {n_page} | {type(e_list_codal).__name__} {e_list_codal}')
+            raise ListError(f'Search page {n_page} of {date_j} failed | {e_list_codal}') from e_list_codal
+
+    async def letters_of_page(self, date_j, n_page):
+        return (await self.list_page(date_j, n_page))['Letters']
+
+    ## Letters of all the search pages of a date, the remaining pages are fetched concurrently once the count is known
+    async def get_list(self, date_j):
+        first = await self.list_page(date_j, 1)
+        if len(first['Letters']) == 0:
+            return []
+
+        n_pages = self.page_count(first)
+        if n_pages is not None:
+            pages = await asyncio.gather(*[self.letters_of_page(date_j, n_page) for n_page in range(2, n_pages + 1)])
+        else:
+            pages = []
+            n_page = 2
+            while letters := await self.letters_of_page(date_j, n_page):
+                pages.append(letters)
+                n_page += 1
+        return list(chain(first['Letters'], *pages))
+
+    async def download_excel(self, r, path_download_excel, refresh=False):
+        try:
+            status, text = await self.cached_get(r['trace_no'], 'excel', r['excel_url'], headers_excel, refresh)
+            if status == 200:
+                with open(path_download_excel+f'{r["trace_no"]}.xls', 'w', encoding='utf-8') as mainfile:
+                    mainfile.write(text)
+            else:
+                logger.info(f'Error |{r["trace_no"]}| Excel did not download')
+                ledger.record(r['trace_no'], 'download', 'Excel did not download', sheet='excel')
+        except Exception as ex:
+            logger.info(f'Excel Connection Error |{r["trace_no"]}| {ex}')
+            ledger.record(r['trace_no'], 'download', 'Excel Connection Error', ex, sheet='excel')
+
+    async def download_sub_sheet(self, r, sheet, path_download_html, refresh=False):
+        try:
+            status, text = await self.cached_get(r['trace_no'], sheet, sheet_url(r['url'], sheet), headers_html, refresh)
+            if status == 200:
+                await asyncio.to_thread(write_sheet, path_download_html, r["trace_no"], sheet, text)
+                return True
+            else:
+                logger.info(f'Error |{r["trace_no"]}| Sub sheet did not download - {sheet}')
+                ledger.record(r['trace_no'], 'download', 'Sub sheet did not download', sheet=sheet)
+        except Exception as sub_e:
+            logger.info(f'Error |{r["trace_no"]}| Failed to download sub sheet - {sheet} - {sub_e}')
+            ledger.record(r['trace_no'], 'download', 'Failed to download sub sheet', sub_e, sheet=sheet)
+        return False
+
+    async def download_report_page(self, r, path_download_html, path_download_excel, refresh=False):
+        try:
+            status, text = await self.cached_get(r['trace_no'], 'report', r['url'], headers_html, refresh)
+            if status == 200:
+                document = await asyncio.to_thread(sheet_document, text)
+                await asyncio.to_thread(write_sheet, path_download_html, r["trace_no"], document['sheet_id'], text, document)
+                return document['options']
+            else:
+                logger.info(f'Error |{r["trace_no"]}| Report html did not load')
+                ledger.record(r['trace_no'], 'download', 'Report html did not load', sheet='report')
+                await self.download_excel(r, path_download_excel, refresh)
+        except TypeError as tex:
+            logger.info(f'Error |{r["trace_no"]}| TypeError in html - {tex}')
+            ledger.record(r['trace_no'], 'download', 'TypeError in html', tex, sheet='report')
+        except Exception as ex:
+            logger.info(f'Error |{r["trace_no"]}| Failed to read report page html - {ex}')
+            ledger.record(r['trace_no'], 'download', 'Failed to read report page html', ex, sheet='report')
+            await self.download_excel(r, path_download_excel, refresh)
+        return None
+
+    async def download_sheets(self, r, path_download_html, path_download_excel, refresh=False):
+        if type(r['sheet_no'])==list:
+            await asyncio.gather(*[self.download_sub_sheet(r, sheet, path_download_html, refresh) for sheet in r['sheet_no']])
+        else:
+            opt_tags_value = await self.download_report_page(r, path_download_html, path_download_excel, refresh)
+            downloaded = await asyncio.gather(*[self.download_sub_sheet(r, sheet, path_download_html, refresh) for sheet in opt_tags_value or []])
+            if not all(downloaded):
+                await self.download_excel(r, path_download_excel, refresh)
+
+    async def download_reports(self, rows, path_download_html, path_download_excel, refresh=False):
+        await asyncio.gather(*[self.download_sheets(r, path_download_html, path_download_excel, refresh) for r in rows])
+
+## Blocking wrapper, the client runs on its own event loop thread so it can be shared by sync code
+class SyncCodalClient:
+    def __init__(self, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='codal-client', daemon=True)
+        self.thread.start()
+        self.client = CodalClient(**kwargs)
+        self.run(self.client.start())
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    def get_list(self, date_j):
+        return self.run(self.client.get_list(date_j))
+
+    def download_sheets(self, r, path_download_html, path_download_excel, refresh=False):
+        return self.run(self.client.download_sheets(r, path_download_html, path_download_excel, refresh))
+
+    def download_reports(self, download_df, path_download_html, path_download_excel, refresh=False):
+        rows = [r for _, r in download_df.iterrows()]
+        return self.run(self.client.download_reports(rows, path_download_html, path_download_excel, refresh))
+
+    def close(self):
+        self.run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+_client = None
+_client_lock = threading.Lock()
+
+## Shared client of the process, one connection pool for every caller
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = SyncCodalClient()
+        return _client
+
+## Close the shared client and its connection pool, the next get_client creates a new one
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
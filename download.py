@@ -1,13 +1,16 @@
 ## Downloading the html files and in case of error, the excel files of the reports
 
-import pandas as pd
 import re
 import requests
 from requests.adapters import HTTPAdapter, Retry
-from bs4 import BeautifulSoup
 import logging
-from multiprocessing import Pool
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import threading
+import time
+import os
+from cache import cache_from_env
+from parsing import sheet_document, write_sheet_document, document_path
+from ledger import ledger
 
 logger = logging.getLogger('download')
 
@@ -43,81 +46,212 @@ headers_excel = {
     'sec-ch-ua-platform': '"Windows"',
 }
 
-se = requests.Session()
+## Token bucket shared by every worker so the whole run stays under the codal.ir request rate
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+download_workers = int(os.getenv('DOWNLOAD_WORKERS', 8))
+rate_limiter = TokenBucket(rate=float(os.getenv('CODAL_RATE_LIMIT', 5)))
 retries = Retry(total=6,
                 backoff_factor=0.3,
                 status_forcelist=[ 500, 502, 503, 504 ])
-se.mount('https://', HTTPAdapter(max_retries=retries))
 
-def download_excel(r, path_download_excel):
+## The cache and the session are created on first use, importing this module opens no files and no connections
+_cache = None
+_cache_opened = False
+_session = None
+_lock = threading.Lock()
+
+## Download cache of the process, None when CODAL_CACHE=0
+def get_cache():
+    global _cache, _cache_opened
+    with _lock:
+        if not _cache_opened:
+            _cache = cache_from_env()
+            _cache_opened = True
+        return _cache
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            mount_session(_session, download_workers)
+        return _session
+
+def mount_session(session, workers):
+    session.mount('https://', HTTPAdapter(max_retries=retries, pool_connections=workers, pool_maxsize=workers))
+
+## Size the connection pool to the number of download workers
+def configure_session(workers=download_workers):
+    mount_session(get_session(), workers)
+
+def get(url, headers, timeout=None):
+    rate_limiter.acquire()
+    return get_session().get(url=url, headers=headers, timeout=timeout)
+
+sheet_select_re = re.compile(r'<select\b.*?<option\b[^>]*\bselected\s*=\s*["\']?selected', re.IGNORECASE | re.DOTALL)
+
+## A body is worth caching only when it is a sheet page with its <select> and selected <option>, or an excel export with its <h3> titles
+## Maintenance and error pages served with status 200 are neither kept nor replayed from the cache
+## This is a text search, the page is parsed once, by write_sheet or download_report_page
+def valid_body(sheet_id, text):
+    if sheet_id == 'excel':
+        return '<h3' in text
+    return sheet_select_re.search(text) is not None
+
+## Cached entry of the sheet if its body is valid, an invalid one is refetched without revalidation headers
+def valid_entry(trace_no, sheet_id):
+    cache = get_cache()
+    entry = cache.get(trace_no, sheet_id) if cache else None
+    if entry and not valid_body(sheet_id, cache.body(entry)):
+        return None
+    return entry
+
+## GET through the download cache: fresh entries skip the request, stale ones are revalidated
+def cached_get(trace_no, sheet_id, url, headers, timeout=None, refresh=False):
+    cache = get_cache()
+    entry = valid_entry(trace_no, sheet_id)
+    if entry and not refresh and cache.is_fresh(entry):
+        return 200, cache.body(entry)
+    if entry:
+        headers = dict(headers, **cache.conditional_headers(entry))
+    response = get(url, headers, timeout)
+    if response.status_code == 304 and entry:
+        cache.touch(trace_no, sheet_id)
+        return 200, cache.body(entry)
+    if response.status_code == 200 and cache and valid_body(sheet_id, response.text):
+        cache.put(trace_no, sheet_id, response.text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    return response.status_code, response.text
+
+## Build the url of a sub sheet of the report
+def sheet_url(url, sheet):
+    url_sub, n_sub = re.subn(r'[sS]heetId=(\d+)', 'SheetId='+str(sheet), url)
+    if n_sub==0:
+        url_sub = url+'&SheetId='+str(sheet)
+    return url_sub
+
+## Write the sheet html and its parsed document, so processing does not parse the page again
+def write_sheet(path_download_html, trace_no, sheet, text, document=None):
+    html_path = path_download_html+f'{trace_no}-{sheet}.html'
+    with open(html_path, 'w', encoding='utf-8') as sheetfile:
+        sheetfile.write(text)
+    if document is None:
+        try:
+            document = sheet_document(text)
+        except Exception:
+            pass
+    if document is not None:
+        write_sheet_document(html_path, document)
+    elif os.path.exists(document_path(html_path)):
+        os.remove(document_path(html_path))
+
+def download_excel(r, path_download_excel, refresh=False):
     try:
-        response = se.get(
-            url=r['excel_url'],
-            headers= headers_excel,
-            timeout=20
-        )
-        if response.status_code == 200:
+        status, text = cached_get(r['trace_no'], 'excel', url=r['excel_url'], headers=headers_excel, timeout=20, refresh=refresh)
+        if status == 200:
             with open(path_download_excel+f'{r["trace_no"]}.xls', 'w', encoding='utf-8') as mainfile:
-                mainfile.write(response.text)
+                mainfile.write(text)
         else:
             logger.info(f'Error |{r["trace_no"]}| Excel did not download')
+            ledger.record(r['trace_no'], 'download', 'Excel did not download', sheet='excel')
     except Exception as ex:
         logger.info(f'Excel Connection Error |{r["trace_no"]}| {ex}')
+        ledger.record(r['trace_no'], 'download', 'Excel Connection Error', ex, sheet='excel')
+
+## Download one sub sheet of the report, returns False if it failed
+def download_sub_sheet(r, sheet, path_download_html, refresh=False):
+    try:
+        status, text = cached_get(r['trace_no'], sheet, url=sheet_url(r['url'], sheet), headers=headers_html, refresh=refresh)
+        if status==200:
+            write_sheet(path_download_html, r["trace_no"], sheet, text)
+            return True
+        else:
+            logger.info(f'Error |{r["trace_no"]}| Sub sheet did not download - {sheet}')
+            ledger.record(r['trace_no'], 'download', 'Sub sheet did not download', sheet=sheet)
+    except Exception as sub_e:
+        logger.info(f'Error |{r["trace_no"]}| Failed to download sub sheet - {sheet} - {sub_e}')
+        ledger.record(r['trace_no'], 'download', 'Failed to download sub sheet', sub_e, sheet=sheet)
+    return False
 
-def download_sheets(r, path_download_html, path_download_excel):
+## Download the main report page, returns the list of other sheets to download or None if it failed
+def download_report_page(r, path_download_html, path_download_excel, refresh=False):
+    try:
+        status, text = cached_get(r['trace_no'], 'report', url=r['url'], headers=headers_html, timeout=10, refresh=refresh)
+        if status == 200:
+            document = sheet_document(text)
+            write_sheet(path_download_html, r["trace_no"], document['sheet_id'], text, document)
+            return document['options']
+        else:
+            logger.info(f'Error |{r["trace_no"]}| Report html did not load')
+            ledger.record(r['trace_no'], 'download', 'Report html did not load', sheet='report')
+            download_excel(r=r, path_download_excel=path_download_excel, refresh=refresh)
+    except TypeError as tex:
+        logger.info(f'Error |{r["trace_no"]}| TypeError in html - {tex}')
+        ledger.record(r['trace_no'], 'download', 'TypeError in html', tex, sheet='report')
+    except Exception as ex:
+        logger.info(f'Error |{r["trace_no"]}| Failed to read report page html - {ex}')
+        ledger.record(r['trace_no'], 'download', 'Failed to read report page html', ex, sheet='report')
+        download_excel(r=r, path_download_excel=path_download_excel, refresh=refresh)
+    return None
+
+def download_sheets(r, path_download_html, path_download_excel, refresh=False):
     if type(r['sheet_no'])==list:
         for sheet in r['sheet_no']:
-            try:
-                url, n_sub = re.subn(r'[sS]heetId=(\d+)', 'SheetId='+str(sheet), r['url'])
-                response_sub = se.get(url= url, headers=headers_html) 
-                if n_sub==0:
-                    response_sub = se.get(url= r['url']+'&SheetId='+str(sheet), headers=headers_html)
-                if response_sub.status_code==200:
-                    with open(path_download_html+f'{r["trace_no"]}-{sheet}.html', 'w', encoding='utf-8') as subfile:
-                        subfile.write(response_sub.text)
-                else:
-                    logger.info(f'Error |{r["trace_no"]}| Sub sheet did not download - {sheet}')
-            except Exception as sub_e:
-                logger.info(f'Error |{r["trace_no"]}| Failed to download sub sheet - {sheet} - {sub_e}')
+            download_sub_sheet(r, sheet, path_download_html, refresh)
     else:
-        try:
-            response = se.get(
-                url=r['url'],
-                headers=headers_html,
-                timeout=10
-            )
-            if response.status_code == 200:
-                bs = BeautifulSoup(response.text, features='html5lib')
-                opt_tags = bs.find(name='select').findChildren('option', recursive=False)
-                selected = bs.find(name='select').findChildren('option', attrs={'selected': 'selected'}, recursive=False)
-                opt_tags.remove(selected[0])
-                selected_id = selected[0].attrs['value']
-                # logger.info(selected_id)
-                # if not Path(f'../download/fs-sheets/{r["trace_no"]}-{selected_id}.html').exists():
-                with open(path_download_html+f'{r["trace_no"]}-{selected_id}.html', 'w', encoding='utf-8') as mainfile:
-                    mainfile.write(response.text)
-
-                opt_tags_value = [o.attrs['value'] for o in opt_tags]
-                for sheet in opt_tags_value:
-                    try:
-                        url, n_sub = re.subn(r'[sS]heetId=(\d+)', 'SheetId='+str(sheet), r['url'])
-                        response_sub = se.get(url= url, headers=headers_html)                    
-                        if n_sub==0:
-                            response_sub = se.get(url= r['url']+'&SheetId='+str(sheet), headers=headers_html)
-                        if response_sub.status_code==200:
-                            with open(path_download_html+f'{r["trace_no"]}-{sheet}.html', 'w', encoding='utf-8') as subfile:
-                                subfile.write(response_sub.text)
-                        else:
-                            logger.info(f'Error |{r["trace_no"]}| Sub sheet did not download - {sheet}')
-                            download_excel(r=r, path_download_excel=path_download_excel)
-                    except Exception as sub_e:
-                        logger.info(f'Error |{r["trace_no"]}| Failed to download sub sheet - {sheet} - {sub_e}')
-                        download_excel(r=r, path_download_excel=path_download_excel)
+        opt_tags_value = download_report_page(r, path_download_html, path_download_excel, refresh)
+        for sheet in opt_tags_value or []:
+            if not download_sub_sheet(r, sheet, path_download_html, refresh):
+                download_excel(r=r, path_download_excel=path_download_excel, refresh=refresh)
+
+## Download all the reports concurrently, report pages and sub sheets share one bounded worker pool
+def download_reports(download_df, path_download_html, path_download_excel, workers=download_workers, refresh=False):
+    configure_session(workers)
+    excel_lock = threading.Lock()
+    excel_done = set()
+
+    def excel_once(r):
+        with excel_lock:
+            if r['trace_no'] in excel_done:
+                return
+            excel_done.add(r['trace_no'])
+        download_excel(r=r, path_download_excel=path_download_excel, refresh=refresh)
+
+    def sub_sheet(r, sheet):
+        if not download_sub_sheet(r, sheet, path_download_html, refresh) and type(r['sheet_no'])!=list:
+            excel_once(r)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for _, r in download_df.iterrows():
+            if type(r['sheet_no'])==list:
+                pending.update(executor.submit(sub_sheet, r, sheet) for sheet in r['sheet_no'])
             else:
-                logger.info(f'Error |{r["trace_no"]}| Report html did not load')
-                download_excel(r=r, path_download_excel=path_download_excel)
-        except TypeError as tex:
-            logger.info(f'Error |{r["trace_no"]}| TypeError in html - {tex}')
-        except Exception as ex:
-            logger.info(f'Error |{r["trace_no"]}| Failed to read report page html - {ex}')
-            download_excel(r=r, path_download_excel=path_download_excel)
\ No newline at end of file
+                future = executor.submit(download_report_page, r, path_download_html, path_download_excel, refresh)
+                future.row = r
+                pending.add(future)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if hasattr(future, 'row'):
+                    pending.update(executor.submit(sub_sheet, future.row, sheet) for sheet in future.result() or [])
@@ -0,0 +1,376 @@
+## Evaluating the formulas of the datasource cells
+## SUM, + - * /, unary signs, parentheses, numbers, cell references and ranges are evaluated natively with the same
+## value semantics as xlcalculator, a table using anything else raises Unsupported and is evaluated by xlcalculator
+
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+from xlcalculator import ModelCompiler
+from xlcalculator import Evaluator
+from xlcalculator.xltypes import XLRange
+from xlcalculator.xlfunctions import func_xltypes, xlerrors
+
+class Unsupported(Exception):
+    pass
+
+class CellError:
+    def __init__(self, code):
+        self.code = code
+
+    def __repr__(self):
+        return self.code
+
+VALUE = CellError('#VALUE!')
+DIV0 = CellError('#DIV/0!')
+
+## Value of a referenced cell that is not in the table
+BLANK = object()
+## Value of a formula cell whose evaluation raised, the cells using it raise too
+FAILED = object()
+
+## Consecutive empty cells after which xlcalculator stops reading a range
+max_empty = 100
+
+address_re = re.compile(r'[A-Z]{1,3}[1-9][0-9]*')
+token_re = re.compile(r' *(?:(?P<range>[A-Z]{1,3}[1-9][0-9]*:[A-Z]{1,3}[1-9][0-9]*)|(?P<func>[A-Za-z]+)\(|(?P<ref>[A-Z]{1,3}[1-9][0-9]*)'
+                      r'|(?P<number>(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)|(?P<op>[-+*/(),]))')
+
+class CellFailed(Exception):
+    pass
+
+## Cells of a range in xlcalculator's order, row by row
+@lru_cache(maxsize=4096)
+def range_cells(cell_range):
+    return tuple(address.split('!')[1] for row in XLRange(f'Sheet1!{cell_range}', cell_range).cells for address in row)
+
+## Number of a text cell, xlcalculator's conversion is used so dates and boolean texts behave the same
+@lru_cache(maxsize=4096)
+def text_number(text):
+    try:
+        return func_xltypes.Text(text).__number__()
+    except xlerrors.ExcelError:
+        return VALUE
+
+def number_value(value):
+    if value.__class__ is str:
+        return text_number(value)
+    if value is BLANK:
+        return 0.0
+    return value
+
+def literal(text):
+    try:
+        value = int(text)
+    except ValueError:
+        value = float(text)
+    return lambda env: value
+
+def reference(address):
+    def evaluate(env):
+        value = env.get(address, BLANK)
+        if value is FAILED:
+            raise CellFailed(address)
+        return value
+    return evaluate
+
+def range_values(env, cells):
+    empty = 0
+    for address in cells:
+        value = env[address]
+        if value is FAILED:
+            raise CellFailed(address)
+        if value is BLANK or value == '':
+            empty += 1
+            if empty > max_empty:
+                raise Unsupported(f'More than {max_empty} empty cells in a range')
+        else:
+            empty = 0
+        yield value
+
+def negate(operand):
+    def evaluate(env):
+        value = operand(env)
+        if value.__class__ is CellError:
+            return value
+        value = number_value(value)
+        if value is VALUE:
+            return value
+        return -1 * value
+    return evaluate
+
+def arithmetic(op, left, right):
+    def evaluate(env):
+        a = left(env)
+        b = right(env)
+        if a.__class__ is CellError:
+            return a
+        if b.__class__ is CellError:
+            return b
+        a = number_value(a)
+        if a is VALUE:
+            return a
+        b = number_value(b)
+        if b is VALUE:
+            return b
+        if op == '+':
+            return a + b
+        if op == '-':
+            return a - b
+        return a * b
+    return evaluate
+
+def divide(left, right):
+    def evaluate(env):
+        a = left(env)
+        b = right(env)
+        if a.__class__ is CellError:
+            return a
+        if b.__class__ is CellError:
+            return b
+        b = number_value(b)
+        if b is VALUE:
+            return b
+        if float(b) == 0:
+            return DIV0
+        a = number_value(a)
+        if a is VALUE:
+            return a
+        return float(a) / float(b)
+    return evaluate
+
+## SUM skips errors and texts that are not numbers, arguments are summed in order and ranges row by row
+def sum_of(args):
+    def evaluate(env):
+        total = 0
+        for cells, operand in args:
+            for value in range_values(env, cells) if cells is not None else (operand(env),):
+                if value.__class__ is CellError:
+                    continue
+                value = number_value(value)
+                if value is VALUE:
+                    continue
+                total = total + value
+        return total
+    return evaluate
+
+## Recursive descent parser of one formula into a function of the cell values
+class Parser:
+    def __init__(self, formula):
+        self.formula = formula
+        self.tokens = []
+        pos = 1
+        while pos < len(formula):
+            match = token_re.match(formula, pos)
+            if match is None:
+                raise Unsupported(formula)
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            pos = match.end()
+        self.pos = 0
+        self.refs = set()
+        self.ranges = []
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, text=None):
+        token = self.peek()
+        if token[0] is None or (kind is not None and token[0] != kind) or (text is not None and token[1] != text):
+            raise Unsupported(self.formula)
+        self.pos += 1
+        return token
+
+    def parse(self):
+        node = self.expression()
+        if self.pos != len(self.tokens):
+            raise Unsupported(self.formula)
+        return node
+
+    def expression(self):
+        node = self.term()
+        while self.peek()[0] == 'op' and self.peek()[1] in '+-':
+            op = self.take()[1]
+            node = arithmetic(op, node, self.term())
+        return node
+
+    def term(self):
+        node = self.unary()
+        while self.peek()[0] == 'op' and self.peek()[1] in '*/':
+            op = self.take()[1]
+            node = arithmetic(op, node, self.unary()) if op == '*' else divide(node, self.unary())
+        return node
+
+    def unary(self):
+        kind, text = self.peek()
+        if kind == 'op' and text == '-':
+            self.take()
+            return negate(self.unary())
+        if kind == 'op' and text == '+':
+            self.take()
+            return self.unary()
+        return self.primary()
+
+    def primary(self):
+        kind, text = self.take()
+        if kind == 'number':
+            return literal(text)
+        if kind == 'ref':
+            self.refs.add(text)
+            return reference(text)
+        if kind == 'op' and text == '(':
+            node = self.expression()
+            self.take('op', ')')
+            return node
+        if kind == 'func' and text.upper() == 'SUM':
+            return sum_of(self.arguments())
+        raise Unsupported(self.formula)
+
+    def arguments(self):
+        args = []
+        if self.peek() == ('op', ')'):
+            self.take()
+            return args
+        while True:
+            if self.peek()[0] == 'range':
+                cells = range_cells(self.take()[1])
+                self.ranges.append(cells)
+                args.append((cells, None))
+            else:
+                args.append((None, self.expression()))
+            separator = self.take('op')[1]
+            if separator == ')':
+                return args
+            if separator != ',':
+                raise Unsupported(self.formula)
+
+## Formulas of a table compiled once into functions and an evaluation order, independent of the other cell values
+class FormulaGraph:
+    def __init__(self, formulas):
+        self.functions = {}
+        self.range_cells = set()
+        deps = {}
+        for address, formula in formulas.items():
+            if not address_re.fullmatch(address):
+                raise Unsupported(address)
+            parser = Parser(formula)
+            self.functions[address] = parser.parse()
+            cells = {cell for cells in parser.ranges for cell in cells}
+            self.range_cells.update(cells)
+            deps[address] = {ref for ref in parser.refs | cells if ref in formulas}
+
+        ## Topological order, cells in a cycle and the cells depending on them are left out
+        dependents = defaultdict(list)
+        waiting = {}
+        for address, cell_deps in deps.items():
+            waiting[address] = len(cell_deps)
+            for dep in cell_deps:
+                dependents[dep].append(address)
+        ready = [address for address, n in waiting.items() if n == 0]
+        self.order = []
+        while ready:
+            address = ready.pop()
+            self.order.append(address)
+            for dependent in dependents[address]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+
+    ## Computed values of the formula cells, in the form extract_from_data writes them back
+    def evaluate(self, values):
+        env = {}
+        for address, value in values.items():
+            if value.__class__ not in (int, float, str) or value == '' or not address_re.fullmatch(address):
+                raise Unsupported(address)
+            env[address] = value
+        for address in self.range_cells:
+            if address not in env:
+                env[address] = ''
+
+        results = {}
+        for address in self.order:
+            try:
+                value = env[address] = self.functions[address](env)
+            except (CellFailed, ArithmeticError, TypeError, ValueError):
+                env[address] = FAILED
+                continue
+            if value.__class__ is CellError:
+                if value is not DIV0:
+                    results[address] = value.code
+            elif value is BLANK:
+                results[address] = None
+            else:
+                results[address] = value
+        return results
+
+## Values of the formula cells computed by xlcalculator
+def xlcalculator_results(values):
+    compiler = ModelCompiler()
+    my_model = compiler.read_and_parse_dict(values)
+    evaluator = Evaluator(my_model)
+
+    results = {}
+    for formula in my_model.formulae:
+        try:
+            val = evaluator.evaluate(formula)
+            if type(val)!=float:
+                if val.value=='#DIV/0!':
+                    pass
+                else:
+                    results[formula.replace('Sheet1!', '')] = val.value
+            else:
+                results[formula.replace('Sheet1!', '')] = val
+        except Exception:
+            pass
+    return results
+
+## Compiled graphs shared by the tables of the same Codal template, least recently used ones are dropped
+## A template whose formulas are not supported is cached too, as None, so they are not parsed again
+class FormulaCache:
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.graphs = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    ## The formula set is hashed in the key, a template whose formulas changed gets its own entry
+    @staticmethod
+    def key(template, formulas):
+        digest = hashlib.blake2b(digest_size=16)
+        for address, formula in sorted(formulas.items()):
+            digest.update(f'{address}\0{formula}\0'.encode('utf-8'))
+        return template, digest.hexdigest()
+
+    def get(self, template, formulas):
+        key = self.key(template, formulas)
+        with self.lock:
+            if key in self.graphs:
+                self.hits += 1
+                self.graphs.move_to_end(key)
+                return self.graphs[key]
+            self.misses += 1
+        try:
+            graph = FormulaGraph(formulas)
+        except Unsupported:
+            graph = None
+        with self.lock:
+            self.graphs[key] = graph
+            while len(self.graphs) > self.maxsize:
+                self.graphs.popitem(last=False)
+        return graph
+
+formula_cache = FormulaCache(maxsize=int(os.getenv('FORMULA_CACHE_SIZE', 256)))
+
+## Values of the formula cells of a table given as {address: value or '=formula'}
+## `template` identifies the Codal template of the table, e.g. (sheet code, table versionNo), to reuse its compiled graph
+def evaluate_formulas(values, template=None):
+    formulas = {address: value for address, value in values.items() if isinstance(value, str) and value[:1] == '='}
+    graph = formula_cache.get(template, formulas)
+    if graph is not None:
+        try:
+            return graph.evaluate(values)
+        except Unsupported:
+            pass
+    return xlcalculator_results(values)
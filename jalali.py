@@ -198,4 +198,160 @@ class Persian:
         return date_format.format(self.gregorian_year, self.gregorian_month, self.gregorian_day)
 
     def gregorian_datetime(self):
-        return datetime.date(self.gregorian_year, self.gregorian_month, self.gregorian_day)
\ No newline at end of file
+        return datetime.date(self.gregorian_year, self.gregorian_month, self.gregorian_day)
+
+# Array conversion
+#
+#  Dates are converted through day ordinals (datetime.date.toordinal) with a table of the
+#  ordinal of 1 Farvardin of every Jalali year in [first_year, last_year], computed once
+#  with the Persian class above, so the results are the same as the per-date classes.
+#  The range is where Gregorian and Persian agree with each other (1900-03-21 to 2094-03-19).
+#
+#  >>> jalali.gregorian_to_jalali(np.array([2014]), np.array([3]), np.array([31]))
+#  (array([1393]), array([1]), array([11]))
+#  >>> pd.Series(['1393/01/11 10:30:00']).jdate.to_gregorian()
+#  0   2014-03-31 10:30:00
+#  dtype: datetime64[ns]
+#
+#  numpy and pandas are imported by the array functions when they are first called, so
+#  importing this module stays cheap. The 'jdate' accessor is registered on import when
+#  pandas is already loaded, otherwise by register_accessor().
+
+import sys
+from functools import lru_cache
+
+first_year = 1279
+last_year = 1472
+
+epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+
+# Month lengths and starts in a year, and the ordinal of 1 Farvardin of every year
+@lru_cache(maxsize=None)
+def _tables():
+    import numpy as np
+    month_days = np.array([31] * 6 + [30] * 6)
+    month_starts = np.concatenate([[0], np.cumsum(month_days)[:-1]])
+    starts = [datetime.date(*Persian(year, 1, 1).gregorian_tuple()).toordinal() for year in range(first_year, last_year + 2)]
+    return month_days, month_starts, np.array(starts, dtype=np.int64)
+
+
+def _check_range(ordinals):
+    year_starts = _tables()[2]
+    if ordinals.size and (ordinals.min() < year_starts[0] or ordinals.max() >= year_starts[-1]):
+        raise ValueError(f"Date out of the supported range {first_year}-{last_year}")
+
+
+def jalali_valid(year, month, day):
+    import numpy as np
+    month_days, _, year_starts = _tables()
+    year, month, day = np.asarray(year), np.asarray(month), np.asarray(day)
+    valid = (year >= first_year) & (year <= last_year) & (month >= 1) & (month <= 12) & (day >= 1)
+    index = np.clip(year - first_year, 0, last_year - first_year)
+    safe_month = np.clip(month, 1, 12) - 1
+    length = np.where(safe_month == 11, year_starts[index + 1] - year_starts[index] - 336, month_days[safe_month])
+    return valid & (day <= length)
+
+
+def jalali_to_ordinal(year, month, day):
+    import numpy as np
+    _, month_starts, year_starts = _tables()
+    year, month, day = np.asarray(year), np.asarray(month), np.asarray(day)
+    if not jalali_valid(year, month, day).all():
+        raise ValueError("Invalid Jalali Date")
+    return year_starts[year - first_year] + month_starts[month - 1] + day - 1
+
+
+def ordinal_to_jalali(ordinals):
+    import numpy as np
+    year_starts = _tables()[2]
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    _check_range(ordinals)
+    index = np.searchsorted(year_starts, ordinals, side='right') - 1
+    doy = ordinals - year_starts[index]
+    first_half = doy < 186
+    month = np.where(first_half, doy // 31 + 1, (doy - 186) // 30 + 7)
+    day = np.where(first_half, doy % 31 + 1, (doy - 186) % 30 + 1)
+    return index + first_year, month, day
+
+
+def gregorian_to_ordinal(year, month, day):
+    import numpy as np
+    year, month, day = np.asarray(year), np.asarray(month), np.asarray(day)
+    dates = (year - 1970).astype('datetime64[Y]') + (month - 1).astype('timedelta64[M]')
+    ordinals = dates.astype('datetime64[D]').astype(np.int64) + day - 1 + epoch_ordinal
+    if not (ordinal_to_gregorian(ordinals)[2] == day).all():
+        raise ValueError("Invalid Date")
+    return ordinals
+
+
+def ordinal_to_gregorian(ordinals):
+    import numpy as np
+    dates = (np.asarray(ordinals, dtype=np.int64) - epoch_ordinal).astype('datetime64[D]')
+    years = dates.astype('datetime64[Y]')
+    months = dates.astype('datetime64[M]')
+    return (years.astype(np.int64) + 1970,
+            (months - years).astype(np.int64) + 1,
+            (dates - months).astype(np.int64) + 1)
+
+
+def jalali_to_gregorian(year, month, day):
+    return ordinal_to_gregorian(jalali_to_ordinal(year, month, day))
+
+
+def gregorian_to_jalali(year, month, day):
+    return ordinal_to_jalali(gregorian_to_ordinal(year, month, day))
+
+
+# Persian and Arabic-Indic digits to ASCII
+digit_table = str.maketrans('۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩', '01234567890123456789')
+date_re = r'^\s*(\d{4})\D(\d{1,2})\D(\d{1,2})(?:\D+(\d{1,2})\D(\d{1,2})(?:\D(\d{1,2}))?)?\s*$'
+
+
+class JalaliAccessor:
+
+    def __init__(self, series):
+        self.series = series
+
+    def ascii_digits(self):
+        return self.series.str.translate(digit_table)
+
+    # 'yyyy/mm/dd[ HH:MM[:SS]]' strings, in any digits, to datetime64, invalid dates raise or are NaT with errors='coerce'
+    def to_gregorian(self, errors='raise'):
+        import numpy as np
+        import pandas as pd
+        parts = self.ascii_digits().str.extract(date_re).astype(float)
+        year, month, day = parts[0].to_numpy(), parts[1].to_numpy(), parts[2].to_numpy()
+        valid = ~np.isnan(year) & jalali_valid(np.nan_to_num(year).astype(np.int64), np.nan_to_num(month).astype(np.int64), np.nan_to_num(day).astype(np.int64))
+        if errors == 'raise' and not valid[self.series.notna().to_numpy()].all():
+            raise ValueError("Invalid Jalali Date")
+        ordinals = np.zeros(len(parts), dtype=np.int64)
+        ordinals[valid] = jalali_to_ordinal(year[valid].astype(np.int64), month[valid].astype(np.int64), day[valid].astype(np.int64))
+        seconds = parts[3].fillna(0) * 3600 + parts[4].fillna(0) * 60 + parts[5].fillna(0)
+        values = (ordinals - epoch_ordinal).astype('datetime64[D]').astype('datetime64[ns]') + (seconds.to_numpy() * 1e9).astype('timedelta64[ns]')
+        values[~valid] = np.datetime64('NaT')
+        return pd.Series(values, index=self.series.index, name=self.series.name)
+
+    # datetime64 values to Jalali strings formatted with year, month, day as in Gregorian.persian_string
+    def to_jalali(self, date_format="{}/{}/{}"):
+        import numpy as np
+        import pandas as pd
+        dates = pd.to_datetime(self.series)
+        valid = dates.notna().to_numpy()
+        result = pd.Series(None, index=self.series.index, name=self.series.name, dtype=object)
+        if valid.any():
+            ordinals = dates[valid].to_numpy().astype('datetime64[D]').astype(np.int64) + epoch_ordinal
+            year, month, day = ordinal_to_jalali(ordinals)
+            result[valid] = [date_format.format(y, f'{m:02d}', f'{d:02d}') for y, m, d in zip(year, month, day)]
+        return result
+
+
+# Register the 'jdate' accessor on pandas Series, pandas is imported here
+@lru_cache(maxsize=None)
+def register_accessor():
+    import pandas as pd
+    pd.api.extensions.register_series_accessor('jdate')(JalaliAccessor)
+
+
+if 'pandas' in sys.modules:
+    register_accessor()
@@ -0,0 +1,91 @@
+## Failures of the run recorded as they happen: report, sheet, stage and error, with an optional append-only JSONL sink
+## Retries and reprocessing query the ledger instead of parsing the logs
+
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+
+class ErrorLedger:
+    def __init__(self, path=None):
+        self.lock = threading.Lock()
+        self.sink = None
+        self.reset()
+        if path:
+            self.open(path)
+
+    def reset(self):
+        self.records = []
+        self.trace_nos_by_stage = defaultdict(set)
+        self.counts = Counter()
+
+    def open(self, path):
+        with self.lock:
+            if self.sink is not None:
+                self.sink.close()
+            self.sink = open(path, 'a', encoding='utf-8')
+
+    def close(self):
+        with self.lock:
+            if self.sink is not None:
+                self.sink.close()
+                self.sink = None
+
+    ## In a worker process the inherited records and sink are dropped, its records go back to the parent with drain
+    def detach(self):
+        self.lock = threading.Lock()
+        self.sink = None
+        self.reset()
+
+    ## `kind` is the tag of the failure as it is logged, `error` the exception when there is one
+    def record(self, trace_no, stage, kind, error=None, sheet=None):
+        self.add(dict(
+            trace_no=str(trace_no),
+            sheet=None if sheet is None else str(sheet),
+            stage=stage,
+            kind=kind,
+            error=type(error).__name__ if isinstance(error, BaseException) else error,
+            message=None if error is None else str(error),
+            time=time.time(),
+        ))
+
+    def add(self, entry):
+        with self.lock:
+            self.records.append(entry)
+            self.trace_nos_by_stage[entry['stage']].add(entry['trace_no'])
+            self.counts[entry['stage']] += 1
+            if self.sink is not None:
+                self.sink.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                self.sink.flush()
+
+    ## Records sent back by a worker process
+    def extend(self, records):
+        for entry in records:
+            self.add(entry)
+
+    ## Take the records out of the ledger, used by worker processes to send them to the parent
+    def drain(self):
+        with self.lock:
+            records = self.records
+            self.reset()
+        return records
+
+    ## Trace numbers (as str) with a failure, in one stage or in any of them
+    def trace_nos(self, stage=None):
+        with self.lock:
+            if stage is not None:
+                return set(self.trace_nos_by_stage.get(stage, ()))
+            return set().union(*self.trace_nos_by_stage.values())
+
+    def failed(self, trace_no, stage=None):
+        with self.lock:
+            if stage is not None:
+                return str(trace_no) in self.trace_nos_by_stage.get(stage, ())
+            return any(str(trace_no) in trace_nos for trace_nos in self.trace_nos_by_stage.values())
+
+    ## Number of failures by stage
+    def summary(self):
+        with self.lock:
+            return dict(self.counts)
+
+ledger = ErrorLedger()
@@ -1,24 +1,16 @@
 # getting the list of all the financial statements to download from today as 'date'
 # ONLY NASHER Companies (company type = 1 in search url)
-import requests
-from requests.adapters import HTTPAdapter, Retry
-import jalali
+## Importing this module has no side effects, init() creates the run folders and the log files
+## pandas, pymongo, boto3 and the download and process modules are imported where they are first needed
 from datetime import datetime, timedelta
 import logging
-import pandas as pd
-from unidecode import unidecode
-# from multiprocessing import Pool
-# from itertools import repeat
-import jalali_pandas
-from pymongo.errors import BulkWriteError
-from pymongo import MongoClient
 import os
+import json
 import shutil
-from utils import get_s3_client
-from sync import sync_directory_to_s3
-from dotenv import load_dotenv
-
-load_dotenv()
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ledger import ledger
 
 today = datetime.now().date().strftime('%Y-%m-%d')
 yesterday = (datetime.now().date() - timedelta(days=1)).strftime('%Y-%m-%d')
@@ -26,120 +18,87 @@ path_download = today + '/fs-sheets'
 path_logs = today + '/logs'
 path_export = today + '/export'
 
-os.makedirs(today, exist_ok=True)
-os.makedirs(path_logs, exist_ok=True)
-os.makedirs(path_download, exist_ok=True)
-os.makedirs(path_export, exist_ok=True)
-
-formatter = logging.Formatter(fmt="%(asctime)s - %(levelname)s - %(message)s", datefmt = "%Y-%m-%d %H:%M")
-
-# process logger
-logger_p = logging.getLogger('process')
-logger_p.setLevel(logging.INFO)
-fh_process = logging.FileHandler(path_logs+"/process_errors.log", encoding='utf-8')
-fh_process.setFormatter(formatter)
-logger_p.addHandler(fh_process)
-
-# download logger
-logger_d = logging.getLogger('download')
-logger_d.setLevel(logging.INFO)
-fh_download = logging.FileHandler(path_logs+"/download_fs.log", encoding='utf-8')
-fh_download.setFormatter(formatter)
-logger_d.addHandler(fh_download)
-from download import *
-from process import *
-
-# set main logger
 logger = logging.getLogger('main')
-logger.setLevel(logging.INFO)
-fh = logging.FileHandler(path_logs+"/updates.log", encoding='utf-8')
-fh.setFormatter(formatter)
-logger.addHandler(fh)
+initialized = False
+
+## Load .env, create the folders of the run and attach the log files, only the first call does it
+def init():
+    global initialized
+    if initialized:
+        return
+    initialized = True
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    os.makedirs(today, exist_ok=True)
+    os.makedirs(path_logs, exist_ok=True)
+    os.makedirs(path_download, exist_ok=True)
+    os.makedirs(path_export, exist_ok=True)
+
+    formatter = logging.Formatter(fmt="%(asctime)s - %(levelname)s - %(message)s", datefmt = "%Y-%m-%d %H:%M")
+
+    # process logger
+    logger_p = logging.getLogger('process')
+    logger_p.setLevel(logging.INFO)
+    fh_process = logging.FileHandler(path_logs+"/process_errors.log", encoding='utf-8')
+    fh_process.setFormatter(formatter)
+    logger_p.addHandler(fh_process)
+
+    # download logger
+    logger_d = logging.getLogger('download')
+    logger_d.setLevel(logging.INFO)
+    fh_download = logging.FileHandler(path_logs+"/download_fs.log", encoding='utf-8')
+    fh_download.setFormatter(formatter)
+    logger_d.addHandler(fh_download)
+
+    # failures of the run, one JSON record per line
+    ledger.open(path_logs+"/errors.jsonl")
+
+    # set main logger
+    logger.setLevel(logging.INFO)
+    fh = logging.FileHandler(path_logs+"/updates.log", encoding='utf-8')
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
 
 def get_list(date_j):
-    n_page = 1
-    dl_list = []
+    from codal_client import get_client
     # date_j = jalali.Gregorian(datetime.today().date()).persian_string("{}/{}/{}")
-    se = requests.Session()
-    retries = Retry(total=1,
-                    backoff_factor=0.3,
-                    status_forcelist=[ 500, 502, 503, 504 ])
-    headers = {
-        'Accept': 'application/json',   
-        'Accept-Language': 'en-US,en;q=0.9,fa;q=0.8',
-        'Cache-Control': 'max-age=0',
-        'Connection': 'keep-alive',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'Sec-Fetch-User': '?1',
-        'Upgrade-Insecure-Requests': '1',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/135.0.0.0 Safari/537.36',
-        'sec-ch-ua': '"Google Chrome";v="135", "Not-A.Brand";v="8", "Chromium";v="135"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Windows"',
-        # 'Cookie': 'Unknown=1076170924.20480.0000; TS018f30e4=01f9930bd25004a92d5c39c0a991dcecb352c8a7859cfbf02d8f452d460aa9aa3e775b07891903868ef6bbe2fa758aea712c1fb2952c636e6cdac208821a1b18709790f618823a3b5614466666c1dca443086d41dc365d1a79047ce194a79377841e54e1ce4b6260236ca1fcdd0cd3cac3bc0097b7; TS018fb0f7=01f9930bd2aec21c0723a2abc1fab3a6a7c7df63e6075a8ba0638ef854e7dabb2df5a2503de0c83d011ff921c40c2498d1cbcf408e',
-    }
-
-    se.mount('https://', HTTPAdapter(max_retries=retries))
-    result = 1
-    while result > 0: 
-        try:
-            search_url = f'https://search.codal.ir/api/search/v2/q?&LetterType=6&FromDate={date_j}&PageNumber={n_page}&CompanyType=1'
-            response = se.get(url = search_url, headers=headers) 
+    return get_client().get_list(date_j)
 
-            if response.status_code==200:
-                result = len(response.json()['Letters'])
-                if result > 0:
-                    dl_list.extend(response.json()['Letters'])
-            else:
-                logger.info(f'[List Error] Response status {response.status_code}')
-                result = 0
-            n_page+=1
-        except Exception as e_list_codal:
-            logger.info(f'[List Error] Exception {e_list_codal}')
-    
-    return dl_list
-
-class DateTimeDecoder(json.JSONDecoder):
-    def __init__(self, datetime_keys=None, format="%Y-%m-%d %H:%M:%S", *args, **kwargs):
-        self.datetime_keys = set(datetime_keys or [])
-        self.format = format
-        super().__init__(object_hook=self.object_hook, *args, **kwargs)
-
-    def object_hook(self, obj):
-        for key in self.datetime_keys:
-            if key in obj and isinstance(obj[key], str):
-                try:
-                    obj[key] = datetime.strptime(obj[key], self.format)
-                except ValueError:
-                    logger.info('[Warning] Some dates were not correctly formatted.')
-        return obj
-    
-def build_reprocess_list(path_log, list_df):
-    with open(path_log, 'r') as plogs:
-        errors = plogs.readlines()
-
-    errors_tracing_no = [re.findall(pattern=r'report no\. \[(\d+)\]', string=f)[0] for f in errors]
-    errors_df = pd.DataFrame(errors, columns=['er_str'])
-    # errors_df['name'] = errors_df['er_str'].str.extract(r'\- \[(.*)\] \| report')
-    errors_df['trace_no'] = errors_tracing_no
+## Download the reports with the async client, CODAL_CLIENT=requests falls back to the threaded downloader
+def download_all(download_df, path_download_html, path_download_excel, refresh=False):
+    from codal_client import get_client
+    if os.getenv('CODAL_CLIENT', 'async')=='requests':
+        from download import download_reports
+        download_reports(download_df, path_download_html, path_download_excel, refresh=refresh)
+    else:
+        get_client().download_reports(download_df, path_download_html, path_download_excel, refresh=refresh)
 
-    # reprocess = errors_df[errors_df['er_str'].str.contains('duplicate')][['trace_no']].drop_duplicates()
-    trace_no_errors = errors_df['trace_no'].unique()
+## Replace the docs (or the statuses in pipeline mode) of the reprocessed reports by trace_no, reports that had none before are appended
+def merge_docs(docs, docs_reprocess):
+    by_trace_no = {d['trace_no']: d for d in docs_reprocess}
+    merged = [by_trace_no.get(d['trace_no'], d) for d in docs]
+    previous = {d['trace_no'] for d in docs}
+    return merged + [d for d in docs_reprocess if d['trace_no'] not in previous]
 
-    list_reprocess = list_df[list_df['trace_no'].astype(str).isin(trace_no_errors)]
+## Reports whose processing recorded a failure in the error ledger
+def build_reprocess_list(list_df, stage='process'):
+    return list_df[list_df['trace_no'].astype(str).isin(ledger.trace_nos(stage))]
 
-    return list_reprocess
-    
 def update(date, path_download_html, path_download_excel, path_export, collection):
+    import pandas as pd
+    import jalali
+    jalali.register_accessor()
+    from pipeline import run_pipeline, pipeline_enabled, report_status
+    from process import bson_ready, process_reports, write_export, append_export, replace_export
+    from mongo_writer import bulk_upsert
     date_j = jalali.Gregorian(datetime.strptime(date,'%Y-%m-%d').date()).persian_string("{}/{}/{}")
     logger.info(f'[Info] Starting to update for date: {date_j}')
     dl_list = get_list(date_j)
     if len(dl_list) == 0:
         logger.info(f'[Info] Found 0 financial statements.')
         logger.info('[Info] Update aborted.')
-        return None
+        return dict(docs=0, failed=[])
     df_list = pd.DataFrame(dl_list)
     df_list = df_list[['TracingNo', 'Symbol', 'CompanyName', 'Title', 'PublishDateTime', 'LetterCode', 'Url', 'ExcelUrl']]
     df_list.columns=['trace_no', 'symbol', 'company_name', 'title', 'date_j', 'letter_code', 'url', 'excel_url']
@@ -147,72 +106,188 @@ def update(date, path_download_html, path_download_excel, path_export, collectio
 
     if 'sheet_no' not in df_list.columns:
         df_list['sheet_no'] = float('NaN')
-    df_list['date_j'] = df_list['date_j'].apply(unidecode)
-    df_list['date_g'] = df_list['date_j'].jalali.parse_jalali('%Y/%m/%d %H:%M:%S').jalali.to_gregorian()
+    df_list['date_j'] = df_list['date_j'].jdate.ascii_digits()
+    df_list['date_g'] = df_list['date_j'].jdate.to_gregorian()
     df_list['date_j'] = df_list['date_j'].str.slice(0,10)
     df_list = df_list[df_list['date_j'].eq(date_j)]
     logger.info(f'[Info] Found {len(df_list)} financial statements.')
 
     if len(df_list) == 0:
         logger.info('[Info] Update aborted.')
+        return dict(docs=0, failed=[])
     
     else:
         download_df = df_list[['trace_no', 'url', 'sheet_no', 'excel_url']]
 
-        # with Pool(processes=10) as pool:
-        #     rows = [row for _, row in download_df.iterrows()]
-        #     pool.starmap(download_sheets, zip(rows, repeat(path_download_html), repeat(path_download_excel)))
-        for _, row in download_df.iterrows():
-            download_sheets(row, path_download_html, path_download_excel)
-        logger.info('[Info] Download has finished.')
-
         ref_df = df_list[['trace_no', 'symbol', 'company_name', 'title', 'date_j', 'date_g', 'url', 'excel_url']]#.astype(str)
-        # rows = [row for _, row in ref_df.iterrows()]
-        # with Pool(processes=5) as p:
-        #     docs = p.starmap(json_export, zip(rows,  repeat(path_download_html), repeat(path_download_excel)))
-        docs = []
-        for _,row_ref in ref_df.iterrows():
-            docs.append(json_export(row_ref, path_download_html, path_download_excel))
-        with open(path_export+'/fs_success_data.json', 'w', encoding='utf-8') as uploadf:
-            json.dump(docs, uploadf, cls=NpEncoder, ensure_ascii=False)
-        processed_docs = json.loads(json.dumps(docs, cls=NpEncoder), cls=DateTimeDecoder, datetime_keys=['date_g'])
+        if pipeline_enabled:
+            ## Download, process and insert in one stream, CODAL_PIPELINE=1
+            ## The docs are appended to the export as NDJSON batch by batch, only the trace_no and status of the reports are kept
+            export_path = path_export+'/fs_success_data.jsonl'
+            open(export_path, 'wb').close()
+            processed_docs = run_pipeline(download_df, ref_df, path_download_html, path_download_excel, insert=lambda batch: bulk_upsert(collection, batch, workers=1), prepare=bson_ready, export=lambda batch: append_export(export_path, batch))
+        else:
+            download_all(download_df, path_download_html, path_download_excel)
+            logger.info('[Info] Download has finished.')
+            processed_docs = bson_ready(process_reports(ref_df, path_download_html, path_download_excel))
+            write_export(path_export+'/fs_success_data.json', processed_docs)
         logger.info('[Info] Processing has finished.')
 
-        ## Find reports with error, redownload and reprocess ALL
-        reprocess_df = build_reprocess_list(path_logs+"/process_errors.log", df_list)
+        ## Find reports with error, redownload and reprocess only them
+        reprocess_df = build_reprocess_list(df_list)
 
         if len(reprocess_df) != 0:
-            for _,r in reprocess_df.iterrows():
-                download_sheets(r, path_download_html, path_download_excel)
+            download_all(reprocess_df, path_download_html, path_download_excel, refresh=True)
             logger.info('[Info] Redownload reports with process error completed.')
-            docs_reprocess = []
-            for _, row_reprocess in ref_df.iterrows():
-                docs_reprocess.append(json_export(row_reprocess, path_download_html, path_download_excel))
-            with open(path_export+'/fs_success_data.json', 'w', encoding='utf-8') as uploadf:
-                json.dump(docs_reprocess, uploadf, cls=NpEncoder, ensure_ascii=False)
-            processed_docs = json.loads(json.dumps(docs_reprocess, cls=NpEncoder), cls=DateTimeDecoder, datetime_keys=['date_g'])
+            reprocess_ref_df = ref_df[ref_df['trace_no'].isin(reprocess_df['trace_no'])]
+            docs_reprocess = bson_ready(process_reports(reprocess_ref_df, path_download_html, path_download_excel))
+            if pipeline_enabled:
+                ## The pipeline already upserted the first pass, the docs of the reprocessed reports replace theirs
+                replace_export(export_path, docs_reprocess)
+                bulk_upsert(collection, docs_reprocess)
+                processed_docs = merge_docs(processed_docs, [report_status(d) for d in docs_reprocess])
+            else:
+                processed_docs = merge_docs(processed_docs, docs_reprocess)
+                write_export(path_export+'/fs_success_data.json', processed_docs)
+
+            logger.info(f'[Info] Finished reprocessing {len(reprocess_ref_df)} reports with errors.')
+
+        if not pipeline_enabled:
+            bulk_upsert(collection, processed_docs)
+
+        logger.info(f'[Info] Failures by stage: {ledger.summary()}')
+        ## Reports of the date that could not be downloaded or inserted, their date is not complete
+        failed = (ledger.trace_nos('download') | ledger.trace_nos('insert')) & set(df_list['trace_no'].astype(str))
+        return dict(docs=len(processed_docs), failed=sorted(failed))
+
+## Upload a run folder (fs-sheets, export and logs), by default to update_db/<folder>
+def sync_run(s3_client, bucket_name, local_directory, s3_prefix=None):
+    from sync import sync_directory_to_s3, sync_archive
+    s3_prefix = s3_prefix or "update_db/" + local_directory
+    exclude_patterns = ["*.txt", "*.py", "liara*", "*.ipynb", "__pycache__/*", ".dockerignore", ".git*", "cron*", "README.md", "*.env", "*.xlsx", ".codal-cache/*"]
+    ## The parsed documents written next to the sheets are a processing cache, they are not uploaded
+    if sync_archive:
+        ## SYNC_ARCHIVE=1: the downloaded sheets go up as one zip with an index of their byte ranges
+        sync_directory_to_s3(
+            local_directory=local_directory + '/fs-sheets',
+            bucket_name=bucket_name,
+            s3_client=s3_client,
+            exclude_patterns=exclude_patterns + ["html/*.json"],
+            archive_key=s3_prefix + "/fs-sheets.zip"
+        )
+        exclude_patterns = exclude_patterns + ["fs-sheets/*"]
+    else:
+        exclude_patterns = exclude_patterns + ["fs-sheets/html/*.json"]
+    ## Only the run folder is synced, under the same keys as when the whole working directory was walked
+    sync_directory_to_s3(
+        local_directory=local_directory,
+        bucket_name=bucket_name,
+        s3_client=s3_client,
+        s3_prefix=s3_prefix,
+        exclude_patterns=exclude_patterns
+    )
+
+## Dates of a backfill with their status, written after each date so an interrupted backfill resumes where it stopped
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dates = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as checkpoint_file:
+                self.dates = json.load(checkpoint_file)
 
-            logger.info('[Info] Finished reprocessing all reports.')
+    def done(self, date):
+        return self.dates.get(date, {}).get('status') == 'done'
 
+    def mark(self, date, status, **info):
+        with self.lock:
+            self.dates[date] = dict(status=status, time=datetime.now().isoformat(timespec='seconds'), **info)
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as checkpoint_file:
+                json.dump(self.dates, checkpoint_file, ensure_ascii=False, indent=2)
+            os.replace(self.path + '.tmp', self.path)
+
+def date_range(start, end):
+    first = datetime.strptime(start, '%Y-%m-%d').date()
+    last = datetime.strptime(end, '%Y-%m-%d').date()
+    return [(first + timedelta(days=n)).strftime('%Y-%m-%d') for n in range((last - first).days + 1)]
+
+## Update every date from start to end, `concurrency` dates at a time, with one MongoDB client, one S3 client and one Codal client
+## Each date is synced to update_db/backfill/<date> and marked done in the checkpoint, dates already done are skipped
+def backfill(start, end, concurrency=None, checkpoint_path=None):
+    init()
+    from pymongo import MongoClient
+    from utils import get_s3_client
+    from mongo_writer import ensure_trace_no_index
+    concurrency = concurrency or int(os.getenv('BACKFILL_CONCURRENCY', 2))
+    checkpoint = Checkpoint(checkpoint_path or os.getenv('BACKFILL_CHECKPOINT', 'backfill-checkpoint.json'))
+    dates = date_range(start, end)
+    pending = [date for date in dates if not checkpoint.done(date)]
+    logger.info(f'[Info] Backfill from {start} to {end}: {len(pending)} dates to update, {len(dates) - len(pending)} already done.')
+
+    client = MongoClient(os.getenv('MONGODB_URI'))
+    collection = client['fin-statements']['new']
+    ensure_trace_no_index(collection)
+    s3_client = get_s3_client()
+    bucket_name = os.getenv('BUCKET_NAME')
+
+    def update_date(date):
+        folder = today + '/backfill/' + date
+        path_download_html = folder + '/fs-sheets/html/'
+        path_download_excel = folder + '/fs-sheets/excel/'
+        os.makedirs(path_download_html, exist_ok=True)
+        os.makedirs(path_download_excel, exist_ok=True)
+        os.makedirs(folder + '/export', exist_ok=True)
         try:
-            result = collection.insert_many(processed_docs, ordered=False)
-            logger.info(f"[Info] No of inserts: {len(result.inserted_ids)}. Inserts: {result.inserted_ids}")
-        except BulkWriteError as bwe:
-            details = bwe.details
-            write_errors = details.get("writeErrors", [])
-            inserted_count = details.get("nInserted", 0)
+            result = update(date=date, path_download_excel=path_download_excel, path_download_html=path_download_html, path_export=folder + '/export', collection=collection)
+            sync_run(s3_client, bucket_name, folder, s3_prefix='update_db/backfill/' + date)
+            if result['failed']:
+                checkpoint.mark(date, 'failed', docs=result['docs'], error=f'Download or insert failures of reports {result["failed"]}')
+                logger.info(f'[Backfill Error] {date} | {len(result["failed"])} reports with download or insert failures.')
+            else:
+                checkpoint.mark(date, 'done', docs=result['docs'])
+                logger.info(f'[Info] Backfill of {date} done, {result["docs"]} docs.')
+        except Exception as e:
+            checkpoint.mark(date, 'failed', error=str(e))
+            logger.info(f'[Backfill Error] {date} | {e}')
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            list(executor.map(update_date, pending))
+    finally:
+        client.close()
+        close_clients()
+    failed = [date for date in pending if not checkpoint.done(date)]
+    logger.info(f'[Info] Backfill finished, {len(pending) - len(failed)} dates done, failed: {failed}')
+    sync_run(s3_client, bucket_name, today)
+    evict_cache()
+    shutil.rmtree(today)
+
+## Close the shared Codal client of the run and its connection pool
+def close_clients():
+    from codal_client import close_client
+    close_client()
 
-            logger.info(f"[Info] Number of inserts: {inserted_count} ")
-            for err in write_errors:
-                logger.info(f"[Error Insert] Index {err['index']}: {err['errmsg']}")
+def evict_cache():
+    from download import get_cache
+    cache = get_cache()
+    if cache:
+        cache.evict()
 
 def main():
+    init()
+    from pymongo import MongoClient
+    from utils import get_s3_client
+    from mongo_writer import ensure_trace_no_index
     MONGODB_URI = os.getenv('MONGODB_URI')
     ## Connect to MongoDB DB:
     client = MongoClient(MONGODB_URI)
     db = client['fin-statements']
     logger.info('[Info] Connected to MongoDB.')
     new_collection = db['new']
+    ensure_trace_no_index(new_collection)
 
     ## Initialize S3 client
     s3_client = get_s3_client()
@@ -226,19 +301,31 @@ def main():
     path_download_html = path_download + '/html/'
     os.makedirs(path_download_html, exist_ok=True)
     os.makedirs(path_download_excel, exist_ok=True)
-    update(date=yesterday, path_download_excel=path_download_excel, path_download_html=path_download_html, path_export=path_export, collection=new_collection)
+    from codal_client import ListError
+    try:
+        update(date=yesterday, path_download_excel=path_download_excel, path_download_html=path_download_html, path_export=path_export, collection=new_collection)
+    except ListError as e_list:
+        ## The logs of the run are still uploaded
+        logger.info(f'[Info] Update aborted, the list of reports could not be fetched | {e_list}')
+    finally:
+        client.close()
+        close_clients()
     
     print('Uploading files:')
-    sync_directory_to_s3(
-        local_directory="",
-        bucket_name=bucket_name,
-        s3_client=s3_client,
-        s3_prefix="update_db",
-        exclude_patterns=["*.txt", "*.py", "liara*", "*.ipynb", "__pycache__/*", ".dockerignore", ".git*", "cron*", "README.md", "*.env", "*.xlsx"]
-    )
+    sync_run(s3_client, bucket_name, today)
     print('Upload done.')
+    evict_cache()
     shutil.rmtree(today)
     print(f"Folder '{today}' and its contents have been deleted.")
     
 if __name__=='__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Update the financial statements of yesterday, or of a range of dates with --start and --end.')
+    parser.add_argument('--start', help='first date of a backfill, YYYY-MM-DD')
+    parser.add_argument('--end', help='last date of a backfill, YYYY-MM-DD, the start date by default')
+    parser.add_argument('--concurrency', type=int, help='dates updated at the same time, BACKFILL_CONCURRENCY or 2 by default')
+    parser.add_argument('--checkpoint', help='JSON file of the finished dates, BACKFILL_CHECKPOINT or backfill-checkpoint.json by default')
+    args = parser.parse_args()
+    if args.start:
+        backfill(args.start, args.end or args.start, concurrency=args.concurrency, checkpoint_path=args.checkpoint)
+    else:
+        main()
@@ -0,0 +1,118 @@
+## Writing the docs to MongoDB as upserts keyed on trace_no, so a rerun of a date replaces the corrected reports
+## Docs are sent in batches cut by their encoded size, below the BSON and message size limits, and batches run concurrently
+## The row labels set by update_labels_local are carried over from the replaced doc, a rerun does not wipe them
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bson
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from ledger import ledger
+
+logger = logging.getLogger('main')
+
+## A single document can not be larger than this in MongoDB
+max_doc_bytes = 16 * 1024 * 1024
+upsert_batch_bytes = int(os.getenv('MONGO_BATCH_BYTES', 8 * 1024 * 1024))
+upsert_batch_docs = int(os.getenv('MONGO_BATCH_DOCS', 500))
+upsert_workers = int(os.getenv('MONGO_WRITE_WORKERS', 4))
+
+## Index the upserts are matched on, an existing index with other options is kept as it is
+def ensure_trace_no_index(collection):
+    try:
+        collection.create_index('trace_no', unique=True)
+    except PyMongoError as e:
+        logger.info(f'[Warning] Could not create the trace_no index | {e}')
+
+## Docs with their encoded sizes in batches of at most max_bytes and max_docs, docs too large for MongoDB are left out
+def upsert_batches(docs, max_bytes=upsert_batch_bytes, max_docs=upsert_batch_docs):
+    batch, batch_bytes = [], 0
+    for doc in docs:
+        size = len(bson.encode(doc))
+        if size > max_doc_bytes:
+            logger.info(f'[Error Insert] Doc of report {doc.get("trace_no")} is {size} bytes, larger than the document limit')
+            ledger.record(doc.get('trace_no'), 'insert', 'Doc too large', f'{size} bytes')
+            continue
+        if batch and (batch_bytes + size > max_bytes or len(batch) >= max_docs):
+            yield batch, batch_bytes
+            batch, batch_bytes = [], 0
+        batch.append(doc)
+        batch_bytes += size
+    if batch:
+        yield batch, batch_bytes
+
+## Labels of the stored docs of a batch by trace_no, keyed like the label updates on (sheet title_Fa, row key)
+def stored_labels(collection, batch):
+    labels = {}
+    try:
+        stored = collection.find({'trace_no': {'$in': [doc['trace_no'] for doc in batch]}, 'sheets.tables.data.label': {'$exists': True}},
+                                 {'trace_no': 1, 'sheets.title_Fa': 1, 'sheets.tables.data.key': 1, 'sheets.tables.data.label': 1})
+        for doc in stored:
+            for sheet in doc.get('sheets') or []:
+                for table in sheet.get('tables') or []:
+                    for row in table.get('data') or []:
+                        if 'label' in row:
+                            labels.setdefault(doc['trace_no'], {})[(sheet.get('title_Fa'), row.get('key'))] = row['label']
+    except PyMongoError as e:
+        logger.info(f'[Warning] Could not read the labels of the stored docs, they must be set again | {e}')
+    return labels
+
+## Copy of the doc with the stored labels on its rows, the doc itself is left as it is
+def with_labels(doc, labels):
+    sheets = []
+    for sheet in doc.get('sheets') or []:
+        tables = []
+        for table in sheet.get('tables') or []:
+            data = table.get('data')
+            if isinstance(data, list):
+                data = [dict(row, label=labels[(sheet.get('title_Fa'), row.get('key'))])
+                        if isinstance(row, dict) and 'label' not in row and (sheet.get('title_Fa'), row.get('key')) in labels else row
+                        for row in data]
+                table = dict(table, data=data)
+            tables.append(table)
+        sheets.append(dict(sheet, tables=tables))
+    return dict(doc, sheets=sheets)
+
+def upsert_batch(collection, number, batch, batch_bytes):
+    labels = stored_labels(collection, batch)
+    requests = [ReplaceOne({'trace_no': doc['trace_no']}, with_labels(doc, labels[doc['trace_no']]) if doc['trace_no'] in labels else doc, upsert=True)
+                for doc in batch]
+    stats = dict(batch=number, docs=len(batch), bytes=batch_bytes, matched=0, modified=0, upserted=0, errors=0)
+    start = time.perf_counter()
+    try:
+        result = collection.bulk_write(requests, ordered=False)
+        stats.update(matched=result.matched_count, modified=result.modified_count, upserted=result.upserted_count)
+    except BulkWriteError as bwe:
+        details = bwe.details
+        write_errors = details.get('writeErrors', [])
+        stats.update(matched=details.get('nMatched', 0), modified=details.get('nModified', 0), upserted=details.get('nUpserted', 0), errors=len(write_errors))
+        for err in write_errors:
+            trace_no = batch[err['index']].get('trace_no')
+            logger.info(f"[Error Insert] Report {trace_no}: {err['errmsg']}")
+            ledger.record(trace_no, 'insert', 'Error Insert', err['errmsg'])
+    except PyMongoError as e:
+        stats['errors'] = len(batch)
+        logger.info(f'[Error Insert] Batch {number} of {len(batch)} docs failed | {e}')
+        for doc in batch:
+            ledger.record(doc.get('trace_no'), 'insert', 'Error Insert', e)
+    stats['seconds'] = round(time.perf_counter() - start, 3)
+    logger.info(f'[Info] Upsert batch {number}: {stats}')
+    return stats
+
+## Replace or insert the docs by trace_no, returns the totals of all batches
+def bulk_upsert(collection, docs, workers=upsert_workers, max_bytes=upsert_batch_bytes, max_docs=upsert_batch_docs):
+    start = time.perf_counter()
+    batches = list(upsert_batches(docs, max_bytes, max_docs))
+    if workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda args: upsert_batch(collection, *args), ((n, b, s) for n, (b, s) in enumerate(batches, 1))))
+    else:
+        results = [upsert_batch(collection, n, b, s) for n, (b, s) in enumerate(batches, 1)]
+    totals = dict(batches=len(results))
+    for key in ('docs', 'bytes', 'matched', 'modified', 'upserted', 'errors'):
+        totals[key] = sum(stats[key] for stats in results)
+    totals['seconds'] = round(time.perf_counter() - start, 3)
+    logger.info(f'[Info] Upserted {totals["docs"]} docs: {totals}')
+    return totals
@@ -0,0 +1,107 @@
+## HTML parser backend shared by download and process: lxml by default, html5lib kept as the fallback
+
+import json
+import os
+import re
+from bs4 import BeautifulSoup, FeatureNotFound
+try:
+    from lxml import html as lxml_html
+except ImportError:
+    lxml_html = None
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+parser_backends = ['lxml', 'html5lib']
+html_parser = os.getenv('HTML_PARSER', 'lxml' if lxml_html is not None else 'html5lib')
+
+if html_parser not in parser_backends:
+    raise ValueError(f'Unknown HTML_PARSER {html_parser}, expected one of {parser_backends}')
+
+def make_soup(html_content, parser=None):
+    try:
+        return BeautifulSoup(html_content, features=parser or html_parser)
+    except FeatureNotFound:
+        return BeautifulSoup(html_content, features='html5lib')
+
+def _select_options_soup(html_content, parser=None):
+    bs = make_soup(html_content, parser)
+    opt_tags = bs.find(name='select').findChildren('option', recursive=False)
+    selected = bs.find(name='select').findChildren('option', attrs={'selected': 'selected'}, recursive=False)
+    opt_tags.remove(selected[0])
+    return selected[0].attrs['value'], selected[0].contents[0], [o.attrs['value'] for o in opt_tags]
+
+def _select_options_lxml(html_content):
+    select = lxml_html.fromstring(html_content).find('.//select')
+    opt_tags = [o for o in select if o.tag == 'option']
+    selected = [o for o in opt_tags if o.get('selected') == 'selected'][0]
+    return selected.get('value'), selected.text, [o.get('value') for o in opt_tags if o is not selected]
+
+## Selected sheet of the page with its title, and the other sheets listed in the <select>
+def select_options(html_content, parser=None):
+    if (parser or html_parser) == 'lxml' and lxml_html is not None:
+        try:
+            return _select_options_lxml(html_content)
+        except (ValueError, IndexError, TypeError):
+            return _select_options_soup(html_content, 'html5lib')
+    return _select_options_soup(html_content, parser)
+
+datasource_marker = re.compile(r'var\s+datasource\s*=\s*(?={)')
+datasource_marker_bytes = re.compile(datasource_marker.pattern.encode())
+
+## Find `var datasource = {...};` in the raw page without building a DOM
+## The first `};` after the marker is tried first, the balanced-brace decoder is used when it is not the end of the object
+## Returns None when the page has no datasource and raises ValueError when it has one that could not be decoded
+def extract_datasource(html_content, max_candidates=5):
+    if isinstance(html_content, (bytes, bytearray, memoryview)):
+        match = datasource_marker_bytes.search(html_content)
+        end_token = b'};'
+    else:
+        match = datasource_marker.search(html_content)
+        end_token = '};'
+    if match is None:
+        return None
+    start = end = match.end()
+    for _ in range(max_candidates):
+        end = html_content.find(end_token, end)
+        if end == -1:
+            break
+        try:
+            return json_loads(html_content[start:end+1])
+        except ValueError:
+            end += 1
+    if not isinstance(html_content, str):
+        html_content = bytes(html_content).decode('utf-8')
+        start = datasource_marker.search(html_content).end()
+    return json.JSONDecoder().raw_decode(html_content, start)[0]
+
+## Parsed form of a sheet page: its sheet id and title, the other sheets of the report and the datasource
+## Raises when the page has no sheet <select>
+## `datasource` is left out when the page has one that could not be decoded, processing then parses the html itself
+def sheet_document(html_content):
+    selected_id, title, opt_tags_value = select_options(html_content)
+    document = dict(sheet_id=selected_id, title=(title or '').replace('\n', '').replace('\t', ''), options=opt_tags_value)
+    try:
+        document['datasource'] = extract_datasource(html_content)
+    except ValueError:
+        pass
+    return document
+
+## The document is stored next to the sheet html, `{trace_no}-{sheet}.json`
+def document_path(html_path):
+    return os.path.splitext(html_path)[0] + '.json'
+
+def write_sheet_document(html_path, document):
+    with open(document_path(html_path), 'wb') as docfile:
+        docfile.write(json_dumps(document))
+
+def read_sheet_document(html_path):
+    try:
+        with open(document_path(html_path), 'rb') as docfile:
+            return json_loads(docfile.read())
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,211 @@
+## Streaming update: a report is processed as soon as its sheets are downloaded and the docs are inserted in micro batches
+## At most `inflight` reports are between download and insert, so memory stays bounded
+## The docs are not kept after their batch is exported and inserted, only the trace_no and status of each report
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+from download import download_sheets, download_workers
+from codal_client import get_client
+from process import export_chunk, export_chunk_worker, process_pool, process_workers, IsolatedExporter
+from ledger import ledger
+
+logger = logging.getLogger('main')
+
+pipeline_enabled = os.getenv('CODAL_PIPELINE', '0') == '1'
+pipeline_inflight = int(os.getenv('PIPELINE_INFLIGHT', 64))
+pipeline_batch_size = int(os.getenv('PIPELINE_BATCH_SIZE', 50))
+pipeline_flush_seconds = float(os.getenv('PIPELINE_FLUSH_SECONDS', 5))
+
+## Status of a report whose doc was inserted, 'failed' when the insert recorded a failure for it
+def report_status(doc):
+    return dict(trace_no=doc['trace_no'], status='failed' if ledger.failed(doc['trace_no'], 'insert') else 'inserted')
+
+## Download, process and insert the reports, `export` and then `insert` are called with each batch of docs
+## download_df and ref_df are the same reports in the same order, the statuses of the reports with a doc are returned in that order
+def run_pipeline(download_df, ref_df, path_download_html, path_download_excel, insert, prepare=None, export=None,
+                 workers=process_workers, inflight=pipeline_inflight, batch_size=pipeline_batch_size, flush_seconds=pipeline_flush_seconds):
+    download_rows = [r for _, r in download_df.iterrows()]
+    ref_rows = [r for _, r in ref_df.iterrows()]
+    total = len(ref_rows)
+    batch_size = max(1, min(batch_size, inflight))
+    slots = threading.BoundedSemaphore(inflight)
+    ready = queue.Queue()
+    finished = queue.Queue()
+    statuses = [None] * total
+    stats = dict(batches=0, inserted=0)
+
+    use_requests = os.getenv('CODAL_CLIENT', 'async')=='requests'
+    download_executor = ThreadPoolExecutor(max_workers=download_workers) if use_requests else None
+
+    ## A download that can not be started is recorded and the report goes on to processing, so the run does not wait for it
+    def download(i):
+        r = download_rows[i]
+        try:
+            if use_requests:
+                future = download_executor.submit(download_sheets, r, path_download_html, path_download_excel)
+            else:
+                client = get_client()
+                future = client.submit(client.client.download_sheets(r, path_download_html, path_download_excel))
+        except Exception as e_download:
+            logger.info(f'[Pipeline Error] Download of report {ref_rows[i]["trace_no"]} could not start | {e_download}')
+            ledger.record(ref_rows[i]['trace_no'], 'download', 'Pipeline Download Error', e_download)
+            ready.put(i)
+            return
+        future.add_done_callback(lambda f: downloaded(i, f))
+
+    def downloaded(i, future):
+        if future.exception() is not None:
+            logger.info(f'[Pipeline Error] Download of report {ref_rows[i]["trace_no"]} failed | {future.exception()}')
+            ledger.record(ref_rows[i]['trace_no'], 'download', 'Pipeline Download Error', future.exception())
+        ready.put(i)
+
+    def feed():
+        for i in range(total):
+            slots.acquire()
+            download(i)
+
+    def flush(batch):
+        if batch:
+            if export is not None:
+                try:
+                    export([doc for _, doc in batch])
+                except Exception as e_export:
+                    logger.info(f'[Pipeline Error] Export of {len(batch)} docs failed | {e_export}')
+            try:
+                insert([doc for _, doc in batch])
+                stats['batches'] += 1
+                stats['inserted'] += len(batch)
+            except Exception as e_insert:
+                logger.info(f'[Pipeline Error] Insert of {len(batch)} docs failed | {e_insert}')
+                for _, doc in batch:
+                    ledger.record(doc['trace_no'], 'insert', 'Pipeline Insert Error', e_insert)
+            for i, doc in batch:
+                statuses[i] = report_status(doc)
+                slots.release()
+        return []
+
+    def write():
+        batch = []
+        deadline = None
+        for _ in range(total):
+            while True:
+                try:
+                    i, doc = finished.get(timeout=None if not batch else max(0, deadline - time.monotonic()))
+                    break
+                except queue.Empty:
+                    batch = flush(batch)
+            if doc is None:
+                slots.release()
+                continue
+            if prepare is not None:
+                try:
+                    doc = prepare(doc)
+                except Exception as e_prepare:
+                    logger.info(f'[Pipeline Error] Could not prepare the doc of report {ref_rows[i]["trace_no"]} | {e_prepare}')
+                    slots.release()
+                    continue
+            if not batch:
+                deadline = time.monotonic() + flush_seconds
+            batch.append((i, doc))
+            if len(batch) >= batch_size:
+                batch = flush(batch)
+        flush(batch)
+
+    feeder = threading.Thread(target=feed, name='pipeline-download', daemon=True)
+    writer = threading.Thread(target=write, name='pipeline-insert', daemon=True)
+    feeder.start()
+    writer.start()
+
+    ## Reports whose pool broke are retried alone on a pool of one worker, one at a time
+    retry = ThreadPoolExecutor(max_workers=1)
+    isolated = IsolatedExporter(path_download_html, path_download_excel)
+    ## Reports in flight by the pool they were submitted to, a pool that breaks while a report is submitted can drop it
+    ## without failing its future, so the reports of a broken pool still pending once it has shut down are retried too
+    submitted = defaultdict(dict)
+    retried, swept = set(), set()
+    retry_lock, submit_lock = threading.Lock(), threading.Lock()
+
+    def retry_isolated(i):
+        with retry_lock:
+            if i in retried:
+                return
+            retried.add(i)
+        retry.submit(export_isolated, i)
+
+    def sweep(executor):
+        with retry_lock:
+            if executor in swept:
+                return
+            swept.add(executor)
+        retry.submit(retry_dropped, executor)
+
+    ## Pools are shut down under submit_lock, shutting down a pool from two threads at once is not safe
+    def retry_dropped(executor):
+        with submit_lock:
+            executor.shutdown(wait=True)
+            pending = submitted.pop(executor, {})
+        for future, i in list(pending.items()):
+            if not future.done():
+                logger.info(f'[Warning] Report {ref_rows[i]["trace_no"]} was dropped by the broken process pool, retrying it')
+                retry_isolated(i)
+
+    def processed(i, future, executor):
+        submitted.get(executor, {}).pop(future, None)
+        try:
+            docs_chunk, records = future.result()
+            ledger.extend(records)
+            finished.put((i, docs_chunk[0]))
+        except BrokenProcessPool:
+            retry_isolated(i)
+            sweep(executor)
+        except Exception as e_process:
+            logger.info(f'[Pipeline Error] Processing of report {ref_rows[i]["trace_no"]} failed | {e_process}')
+            finished.put((i, None))
+
+    def export_inline(rows, path_download_html, path_download_excel):
+        return export_chunk(rows, path_download_html, path_download_excel), []
+
+    def export_isolated(i):
+        try:
+            doc = isolated.export(ref_rows[i])
+        except Exception as e_process:
+            logger.info(f'[Pipeline Error] Processing of report {ref_rows[i]["trace_no"]} failed | {e_process}')
+            ledger.record(ref_rows[i]['trace_no'], 'process', 'Pipeline Process Error', e_process)
+            doc = None
+        finished.put((i, doc))
+
+    pool = ExitStack()
+    try:
+        executor = pool.enter_context(process_pool(workers) if workers > 1 else ThreadPoolExecutor(max_workers=1))
+        for _ in range(total):
+            i = ready.get()
+            with submit_lock:
+                try:
+                    future = executor.submit(export_chunk_worker if workers > 1 else export_inline, [ref_rows[i]], path_download_html, path_download_excel)
+                except BrokenProcessPool:
+                    ## The reports of the broken pool are retried by their callbacks, the next reports go to a new pool
+                    logger.info('[Warning] Process pool broke, starting a new one')
+                    sweep(executor)
+                    pool.close()
+                    executor = pool.enter_context(process_pool(workers))
+                    future = executor.submit(export_chunk_worker, [ref_rows[i]], path_download_html, path_download_excel)
+                submitted[executor][future] = i
+            future.add_done_callback(lambda f, i=i, executor=executor: processed(i, f, executor))
+        writer.join()
+    finally:
+        with submit_lock:
+            pool.close()
+        retry.shutdown()
+        isolated.close()
+        if download_executor is not None:
+            download_executor.shutdown()
+    feeder.join()
+    logger.info(f'[Info] Pipeline finished {total} reports, {stats["inserted"]} docs inserted in {stats["batches"]} batches.')
+    return [status for status in statuses if status is not None]
@@ -4,10 +4,18 @@ import numpy as np
 import re
 from glob import glob
 import logging
-from bs4 import BeautifulSoup
-from xlcalculator import ModelCompiler
-from xlcalculator import Evaluator
-import jalali_pandas
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager, ExitStack
+from parsing import make_soup, extract_datasource, read_sheet_document
+from formula import evaluate_formulas
+from ledger import ledger
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from unidecode import unidecode
 import string
 from io import StringIO
@@ -20,6 +28,10 @@ import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 logger = logging.getLogger('process')
+logger_main = logging.getLogger('main')
+
+process_workers = int(os.getenv('PROCESS_WORKERS', os.cpu_count() or 1))
+process_chunk_size = int(os.getenv('PROCESS_CHUNK_SIZE', 8))
 
 ## Defining Custom Error Classes
 class NoHeader(Exception):
@@ -44,46 +56,159 @@ class NpEncoder(json.JSONEncoder):
             return obj.tolist()
         return super(NpEncoder, self).default(obj)
 
+## Converting docs to the python objects stored in MongoDB, in one walk
+## Same result as a round trip through NpEncoder: numpy values as python values, tuples as lists, timestamps as str,
+## except for the date_keys which are parsed back to datetime
+date_keys = {'date_g'}
+date_format = '%Y-%m-%d %H:%M:%S'
+
+def bson_ready(obj, key=None):
+    if isinstance(obj, dict):
+        return {k if isinstance(k, str) else json.dumps(k): bson_ready(v, k) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [bson_ready(v) for v in obj]
+    if obj is None or type(obj) in (str, int, bool):
+        value = obj
+    elif isinstance(obj, (float, np.floating)):
+        value = float(obj)
+    elif isinstance(obj, np.integer):
+        value = int(obj)
+    elif isinstance(obj, np.bool_):
+        value = bool(obj)
+    elif isinstance(obj, (np.datetime64, np.complexfloating, pd.Timestamp)) or obj is pd.NaT:
+        value = str(obj)
+    elif isinstance(obj, np.ndarray):
+        if np.issubdtype(obj.dtype, np.datetime64) or np.issubdtype(obj.dtype, np.complexfloating):
+            return obj.astype(str).tolist()
+        return bson_ready(obj.tolist())
+    else:
+        return obj
+    if key in date_keys and isinstance(value, str):
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            logger_main.info('[Warning] Some dates were not correctly formatted.')
+    return value
+
+## Export file of the docs, the datetimes are written back as str
+def export_default(obj):
+    if isinstance(obj, datetime):
+        return str(obj)
+    raise TypeError(f'Type is not JSON serializable: {type(obj).__name__}')
+
+def export_bytes(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=export_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(obj, default=export_default, ensure_ascii=False).encode('utf-8')
+
+def write_export(path, docs):
+    with open(path, 'wb') as exportf:
+        exportf.write(export_bytes(docs))
+
+## NDJSON export, one doc per line, appended as the docs are ready so they are not kept until the end of the run
+def append_export(path, docs):
+    with open(path, 'ab') as exportf:
+        exportf.write(b''.join(export_bytes(doc) + b'\n' for doc in docs))
+
+## Replace the lines of the reprocessed docs in an NDJSON export, the file is copied line by line
+def replace_export(path, docs):
+    trace_nos = {doc['trace_no'] for doc in docs}
+    loads = orjson.loads if orjson is not None else json.loads
+    if os.path.exists(path):
+        with open(path, 'rb') as exportf, open(path + '.tmp', 'wb') as tmpf:
+            for line in exportf:
+                if loads(line)['trace_no'] not in trace_nos:
+                    tmpf.write(line)
+        os.replace(path + '.tmp', path)
+    append_export(path, docs)
+
 ## Defining Processing Chunks for Efficient Processing
 def divide_chunks(l, n):
     for i in range(0, len(l), n): 
         yield l[i:i + n]
 
-## Formatting as list of key values in JSON
-def json_formatter(row):
-    return dict(key=row.name, value=row.values.tolist())
+## Formatting a table slice as list of key values in JSON, the first column is the key of each row
+## Walks the values once, NaN is written as None
+## Rows keep the types of a transpose: without NaN the values are upcast to the common dtype of the columns (int and
+## float columns give floats), with NaN the columns are object and every value keeps its own type
+def json_formatter(sliced_df):
+    na = sliced_df.isna().to_numpy()
+    keys = sliced_df.iloc[:, 0].to_numpy(dtype=object)
+    keys[na[:, 0]] = None
+    if na[:, 1:].any():
+        values = sliced_df.iloc[:, 1:].to_numpy(dtype=object)
+        values[na[:, 1:]] = None
+    else:
+        values = sliced_df.iloc[:, 1:].to_numpy()
+    return dict(data=[dict(key=key, value=row.tolist()) for key, row in zip(keys.tolist(), values)], columns=sliced_df.columns[1:].to_list())
 
 ## Processing cell values before export
+negative_pattern = re.compile(r'\((\d+)\)')
+number_pattern = re.compile(r'^[+-]?([0-9]*[.])?[0-9]+$')
+digit_pattern = re.compile(r'\d')
+punctuation_table = str.maketrans(string.punctuation, ' '*len(string.punctuation))
+
+## Transliteration of each character as unidecode does it, filled as characters are met
+class UnidecodeTable(dict):
+    def __missing__(self, code):
+        self[code] = unidecode(chr(code))
+        return self[code]
+
+unidecode_table = UnidecodeTable()
+
 def process_negative_values(s):
-    return re.sub(r'\((\d+)\)', '-\\1', str(s))
+    return negative_pattern.sub('-\\1', str(s))
 
 def pre_text(text):
     if '%' in str(text):
         return str(text).replace('%', '').strip()
     elif str(text)=='nan':
         return text
-    elif bool(re.match(r'^[+-]?([0-9]*[.])?[0-9]+$', str(text))):
+    elif number_pattern.match(str(text)):
        return str(text).replace(',', '').strip()
-    elif bool(re.search(r'\d', str(text))):
+    elif digit_pattern.search(str(text)):
        return str(text).replace(',', '').strip()
     else:
-       return str(text).strip().translate(str.maketrans(string.punctuation, ' '*len(string.punctuation)) ).replace('  ', ' ')
+       return str(text).strip().translate(punctuation_table).replace('  ', ' ')
     
 def convert_unicode(s):
-    res = []
     if str(s)=='nan':
         return s
-    for word in str(s).split():
-        if bool(re.search(r'\d', str(word))):
-            res.append(unidecode(word))
-        else:
-            res.append(word)
-    return ' '.join(res)
+    return ' '.join(word.translate(unidecode_table) if digit_pattern.search(word) else word for word in str(s).split())
+
+def normalize_cell(value):
+    return process_negative_values(pre_text(convert_unicode(value)))
+
+def numeric_cell(value):
+    return pd.to_numeric(normalize_cell(value), errors='ignore')
+
+## Apply a cell function once per distinct value, values are keyed with their type so 1 and 1.0 stay apart
+def memoize(func):
+    memo = {}
+    def lookup(value):
+        key = (value.__class__, value)
+        try:
+            return memo[key]
+        except KeyError:
+            memo[key] = result = func(value)
+            return result
+    return lookup
+
+## Normalize every cell column by column: digits to latin, commas and percent signs stripped, (123) to -123
+## With numeric=True the cells are also converted to numbers where possible
+def normalize_table(df_table, numeric=False):
+    cell = memoize(numeric_cell if numeric else normalize_cell)
+    return df_table.apply(lambda column: column.map(cell))
 
 ## Find the datasource script tag in the HTML
 def datasource_from_html(html_content):
+    # Fast path on the raw page
+    try:
+        return extract_datasource(html_content)
+    except ValueError:
+        pass
     # Parse HTML content
-    soup = BeautifulSoup(html_content, 'html5lib')
+    soup = make_soup(html_content)
     # Find data
     table = soup.find_all('script', string=re.compile(pattern='datasource'))
     p = re.findall('var datasource = ({.*?});', str(table))
@@ -94,13 +219,15 @@ def datasource_from_html(html_content):
         return None
 
 ## Find the option and table tags in the HTML
-def read_html_table(html_content):
-    bs = BeautifulSoup(html_content, features='html5lib')
+def read_html_table(html_content, document=None):
+    bs = make_soup(html_content)
+    if document is not None:
+        return bs.select('table:not(.Hidden)'), document['sheet_id'], document['title'],
     title = bs.find('option', attrs=dict(selected='selected'))
     return bs.select('table:not(.Hidden)'), title.attrs['value'], title.contents[0].replace('\n','').replace('\t', ''),
 
 ## Extract cells' formula from datasource and compute cells' data
-def extract_from_data(df_con):
+def extract_from_data(df_con, template=None):
     df_con = df_con[['cellGroupName', 'columnSequence', 'rowSequence', 'value', 'address', 'cssClass', 'formula', 'isVisible', 'valueTypeName']]
     df_con = df_con.drop_duplicates().copy()
     df_con_dd = df_con[df_con['columnSequence'].isin(df_con.groupby('columnSequence')[['value', 'rowSequence']].apply(lambda x: x.values.tolist(), include_groups=False).drop_duplicates().index.values)].copy()
@@ -114,22 +241,13 @@ def extract_from_data(df_con):
     df_con_dd.loc[df_con_dd['formula'].astype(str).ne(''), 'formula'] = '=' + df_con_dd.loc[df_con_dd['formula'].astype(str).ne(''), 'formula'].str.replace('^=','', regex=True)
     df_con_dd.loc[df_con_dd['formula'].astype(str).ne(''), 'value_ex'] = df_con_dd.loc[df_con_dd['formula'].astype(str).ne(''), 'formula']
 
-    compiler = ModelCompiler()
-    my_model = compiler.read_and_parse_dict(df_con_dd.set_index('address')['value_ex'].to_dict())
-    evaluator = Evaluator(my_model)
+    results = evaluate_formulas(df_con_dd.set_index('address')['value_ex'].to_dict(), template)
 
-    for formula in my_model.formulae:
-        try:
-            val = evaluator.evaluate(formula)
-            if type(val)!=float:
-                if val.value=='#DIV/0!':
-                    pass
-                else:
-                    df_con_dd.loc[df_con_dd['address'].eq(formula.replace('Sheet1!', '')), 'value'] = val.value
-            else:
-                df_con_dd.loc[df_con_dd['address'].eq(formula.replace('Sheet1!', '')), 'value'] = val
-        except Exception:
-            pass
+    ## Write all the computed values back in one assignment
+    if results:
+        mask = df_con_dd['address'].isin(results.keys())
+        computed = df_con_dd.loc[mask, 'address']
+        df_con_dd.loc[mask, 'value'] = pd.Series([results[a] for a in computed], index=computed.index, dtype=object)
 
     df_con_dd = df_con_dd[df_con_dd['isVisible'].eq(True)]
 
@@ -137,17 +255,14 @@ def extract_from_data(df_con):
 
 ## Construct table from the cells' data
 def json_from_data(df_con_dd):
-    cons = pd.DataFrame(columns=sorted(df_con_dd['columnSequence'].unique()))
     if not df_con_dd['cellGroupName'].eq('Header').any():
         raise NoHeader
     header= df_con_dd[df_con_dd['cellGroupName'].eq('Header')]['rowSequence'].unique()
     sharh = df_con_dd[df_con_dd['value'].eq('شرح')]['columnSequence'].values
     if len(sharh)==0:
         raise NoSharh
-    rows = df_con_dd.groupby(['rowSequence'])
-    for ind, group in rows:
-        construct_row = group.T.set_axis(group['columnSequence'], axis='columns')
-        cons.loc[ind] = construct_row.loc['value']
+    ## One grid of the values, rows and columns sorted by their sequence, NaN where a row has no cell
+    cons = df_con_dd.astype({'value': object}).pivot(index='rowSequence', columns='columnSequence', values='value').rename_axis(index=None, columns=None)
 
     cons = cons.set_axis(pd.MultiIndex.from_arrays(cons.loc[header].ffill().ffill(axis=1).values), axis='columns').iloc[max(header):]
     sharh_index = cons.columns.get_indexer_for(cons.filter(like='شرح').columns.unique())
@@ -156,10 +271,7 @@ def json_from_data(df_con_dd):
         sliced_df = cons.iloc[:, index_c:]
         # sliced_df = sliced_df[~sliced_df.iloc[:, 1:].astype(str).map(len).eq(0).all(axis=1)]
         sliced_df = sliced_df[~sliced_df.iloc[:, 1:].isna().all(axis=1)]
-        sliced_df = sliced_df.replace(to_replace=float('NaN'),value=None)
-        fields_dict = dict(data=sliced_df.iloc[:, 1:].T.set_axis(sliced_df.iloc[:, 0], axis='columns').apply(json_formatter, axis=0).values.tolist())
-        fields_dict['columns'] = sliced_df.columns[1:].to_list()
-        result.append(fields_dict)
+        result.append(json_formatter(sliced_df))
         cons = cons.iloc[:, :index_c]
 
     return result
@@ -184,7 +296,7 @@ def json_from_html_table(tables):
         row_data = [cell.text.strip() for cell in cells]
         all_data.append(row_data)
     df_table = pd.DataFrame(all_data, columns=header)
-    df_table = df_table.map(convert_unicode).map(pre_text).map(process_negative_values)
+    df_table = normalize_table(df_table)
 
     sharh = df_table.columns.get_indexer_for(['شرح'])
     result = []
@@ -193,10 +305,7 @@ def json_from_html_table(tables):
             sliced_df = df_table.iloc[:, index_c:]
             sliced_df = sliced_df[~sliced_df.astype(str).map(len).eq(0).all(axis=1)]
             sliced_df = sliced_df[~sliced_df.eq('None').all(axis=1)]
-            sliced_df = sliced_df.replace(to_replace=float('NaN'), value=None)
-            fields_dict = dict(data=sliced_df.iloc[:, 1:].T.set_axis(sliced_df.iloc[:, 0], axis='columns').apply(json_formatter, axis=0).values.tolist())
-            fields_dict['columns'] = sliced_df.columns[1:].to_list()
-            result.append(fields_dict)
+            result.append(json_formatter(sliced_df))
             df_table = df_table.iloc[:, :index_c]
 
     return result
@@ -204,7 +313,7 @@ def json_from_html_table(tables):
 ## Extract data from xls files as HTML tags
 def extract_tag_from_html(html_content):
     # Parse HTML content
-    soup = BeautifulSoup(html_content, 'html5lib')
+    soup = make_soup(html_content)
     div_tags = soup.find_all('h3')
         
     return div_tags
@@ -246,8 +355,7 @@ def construct_from_html_tag(tag):
 
     change = df_table.columns.get_indexer_for(df_table.filter(regex='درصد|تغییر').columns.unique())
     df_table = df_table.iloc[:, [j for j, c in enumerate(df_table.columns) if j not in change]].copy()
-    df_table = df_table.map(convert_unicode).map(pre_text).map(process_negative_values)
-    df_table = df_table.map(pd.to_numeric, errors='ignore')
+    df_table = normalize_table(df_table, numeric=True)
     df_table = df_table.replace({'nan': None}).replace({'None': None})
 
     result = []
@@ -256,14 +364,15 @@ def construct_from_html_tag(tag):
     for index_c in sorted(sharh_index, reverse=True):
         sliced_df = df_table.iloc[:, index_c:]
         sliced_df = sliced_df[~sliced_df.iloc[:, 1:].isna().all(axis=1)]
-        sliced_df = sliced_df.replace(to_replace=float('NaN'), value=None)
-        fields_dict = dict(data=sliced_df.iloc[:, 1:].T.set_axis(sliced_df.iloc[:, 0], axis='columns').apply(json_formatter, axis=0).values.tolist())
-        fields_dict['columns'] = sliced_df.columns[1:].to_list()
-        result.append(fields_dict)
+        result.append(json_formatter(sliced_df))
         df_table = df_table.iloc[:, :index_c]
 
     return result
 
+## Sheet id of a downloaded sheet file, `{trace_no}-{sheet}.html`
+def sheet_of(fname):
+    return Path(fname).stem.split('-', 1)[-1]
+
 ## Construct the final json file for import
 def json_export(index_row, path_download_html, path_download_excel):
     dict_report = index_row.to_dict()
@@ -277,15 +386,22 @@ def json_export(index_row, path_download_html, path_download_excel):
             dict_report['period'] = 12
         else:
             logger.info(f'[Title Error] Could not extract period of the report. report no. [{index_row["trace_no"]}]')
-    sheets = [str(Path(p)) for p in glob(path_download_html+str(index_row['trace_no'])+'-*')]
+            ledger.record(index_row['trace_no'], 'process', 'Title Error')
+    sheets = [str(Path(p)) for p in glob(path_download_html+str(index_row['trace_no'])+'-*.html')]
     for fname in sheets:
+        document = read_sheet_document(fname)
+        if document is None or 'datasource' not in document or document['datasource'] is None:
+            try:
+                with open(fname, 'r', encoding='utf-8') as fbuffer:
+                    html_content = str(fbuffer.read())
+            except Exception as exf:
+                logger.info(f'[HTML File Error] | report no. [{index_row["trace_no"]} | {exf} | filename{fname}]')
+                ledger.record(index_row['trace_no'], 'process', 'HTML File Error', exf, sheet=sheet_of(fname))
         try:
-            with open(fname, 'r', encoding='utf-8') as fbuffer:
-                html_content = str(fbuffer.read())
-        except Exception as exf:
-            logger.info(f'[HTML File Error] | report no. [{index_row["trace_no"]} | {exf} | filename{fname}]')
-        try:
-            sheet_data = datasource_from_html(html_content=html_content)
+            if document is not None and 'datasource' in document:
+                sheet_data = document['datasource']
+            else:
+                sheet_data = datasource_from_html(html_content=html_content)
             if sheet_data:
                 dict_report.update({k: sheet_data.get(k, None) for k in ['title_Fa', 'title_En', 'yearEndToDate', 'kind', 'type', 'isAudited', 'state']})
                 dict_report['version'] = re.findall(r'V(\d{1})', str(sheet_data['title_En']))
@@ -295,6 +411,7 @@ def json_export(index_row, path_download_html, path_download_excel):
                     return dict_report
                 elif len(sheet_data['sheets'])==0:
                     logger.info(f'[Empty DataSource] | report no. [{index_row["trace_no"]}] | filename {fname}')
+                    ledger.record(index_row['trace_no'], 'process', 'Empty DataSource', sheet=sheet_of(fname))
                     continue
                 else:
                     dict_sheet = dict(tables=[])
@@ -305,7 +422,7 @@ def json_export(index_row, path_download_html, path_download_excel):
                         for table in sheet_data['sheets'][0]['tables']:
                             try:
                                 if len(table['cells'])>0:
-                                    extr_data = extract_from_data(pd.DataFrame(table['cells']))
+                                    extr_data = extract_from_data(pd.DataFrame(table['cells']), template=(dict_sheet['sheet_id'], table.get('versionNo', None)))
                                     list_table = json_from_data(extr_data)
                                     for d in list_table:
                                         d['version_no'] = table.get('versionNo', None)
@@ -318,6 +435,7 @@ def json_export(index_row, path_download_html, path_download_excel):
                                 pass
                             except Exception as e_build:
                                 logger.info(f'[Error Datasource] | report no. [{index_row["trace_no"]}] | {e_build} | filename {fname}')
+                                ledger.record(index_row['trace_no'], 'process', 'Error Datasource', e_build, sheet=sheet_of(fname))
                         if len(dict_sheet['tables'])==0:
                             continue
                         else:
@@ -326,11 +444,12 @@ def json_export(index_row, path_download_html, path_download_excel):
                         dict_sheet['to_insert'] = True
                         dict_report['sheets'].append(dict_sheet)
             else:
+                ## Sheets without a datasource are read from their html table, this is not a failure of the report
                 logger.info(f'[No Datasource] | report no. [{index_row["trace_no"]}] | filename {fname}')
 
                 dict_sheet = dict(tables=[])
                 try:
-                    elements = read_html_table(html_content)
+                    elements = read_html_table(html_content, document)
                     if (int(elements[1]) in [19, 30]):
                         continue #filtering these sheets
                     dict_sheet['title_Fa'] = elements[2]
@@ -340,14 +459,17 @@ def json_export(index_row, path_download_html, path_download_excel):
                         dict_report['sheets'].append(dict_sheet)
                     else:
                         logger.info(f'[Empty HTML Table] | report no. [{index_row["trace_no"]}] | filename {fname}')
+                        ledger.record(index_row['trace_no'], 'process', 'Empty HTML Table', sheet=sheet_of(fname))
                 except NoSharh:
                     pass
                 except NoHeader:
                     pass
                 except Exception as e_build:
                     logger.info(f'[Error HTML Table] | report no. [{index_row["trace_no"]}] | {e_build} | filename {fname}')
+                    ledger.record(index_row['trace_no'], 'process', 'Error HTML Table', e_build, sheet=sheet_of(fname))
         except Exception as nfe:
             logger.info(f'[HTML Unknown Format] | report no. [{index_row["trace_no"]}] | {nfe} | filename {fname}')
+            ledger.record(index_row['trace_no'], 'process', 'HTML Unknown Format', nfe, sheet=sheet_of(fname))
 
     if os.path.exists(path_download_excel+str(index_row['trace_no'])+'.xls'):
         try:
@@ -355,6 +477,7 @@ def json_export(index_row, path_download_html, path_download_excel):
                 excel_content = str(fbuffer.read())
         except Exception as exf:
             logger.info(f'[ٍExcel File Error] | report no. [{index_row["trace_no"]}] | {exf}')
+            ledger.record(index_row['trace_no'], 'process', 'Excel File Error', exf, sheet='excel')
         try:
             tags = extract_tag_from_html(excel_content)
             for tag in tags:
@@ -387,10 +510,132 @@ def json_export(index_row, path_download_html, path_download_excel):
                     continue
                 except Exception as e_build:
                     logger.info(f'[Excel Table Error] | report no. [{index_row["trace_no"]}] | {e_build}')
+                    ledger.record(index_row['trace_no'], 'process', 'Excel Table Error', e_build, sheet='excel')
 
         except Exception as nfe:
             logger.info(f'[Excel Unknown Format] | report no. [{index_row["trace_no"]}] | {nfe}')
+            ledger.record(index_row['trace_no'], 'process', 'Excel Unknown Format', nfe, sheet='excel')
     if len(sheets)==0:
         dict_report['no_file'] = True
 
     return dict_report
+
+## Export one report, an unexpected error is logged against the report instead of stopping the batch
+def export_report(row, path_download_html, path_download_excel):
+    try:
+        return json_export(row, path_download_html, path_download_excel)
+    except Exception as e_report:
+        logger.info(f'[Process Error] | report no. [{row["trace_no"]}] | {type(e_report).__name__}: {e_report}')
+        ledger.record(row['trace_no'], 'process', 'Process Error', e_report)
+        return None
+
+def export_chunk(rows, path_download_html, path_download_excel):
+    return [export_report(row, path_download_html, path_download_excel) for row in rows]
+
+## Chunk exported in a worker process, the failures it recorded are sent back with the docs
+def export_chunk_worker(rows, path_download_html, path_download_excel):
+    return export_chunk(rows, path_download_html, path_download_excel), ledger.drain()
+
+## Worker logs go through the queue to the handlers of the parent process
+def init_process_worker(log_queue, level):
+    logger.handlers = [QueueHandler(log_queue)]
+    logger.setLevel(level)
+    logger.propagate = False
+    ledger.detach()
+
+## Pool of processes exporting reports, the logs of the workers are written by the handlers of this process
+@contextmanager
+def process_pool(workers):
+    context = multiprocessing.get_context()
+    log_queue = context.Queue()
+    listener = QueueListener(log_queue, *logger.handlers, respect_handler_level=True)
+    listener.start()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=init_process_worker, initargs=(log_queue, logger.getEffectiveLevel())) as executor:
+            yield executor
+    finally:
+        listener.stop()
+
+## Pool of one worker exporting one report at a time, so a report that breaks the pool is known
+## That report is recorded as failed and the next report gets a new pool
+class IsolatedExporter:
+    def __init__(self, path_download_html, path_download_excel):
+        self.path_download_html = path_download_html
+        self.path_download_excel = path_download_excel
+        self.pool = None
+
+    def export(self, row):
+        if self.pool is None:
+            self.pool = ExitStack()
+            self.executor = self.pool.enter_context(process_pool(1))
+        try:
+            docs, records = self.executor.submit(export_chunk_worker, [row], self.path_download_html, self.path_download_excel).result()
+        except BrokenProcessPool as e_pool:
+            self.close()
+            logger.info(f'[Process Error] | report no. [{row["trace_no"]}] | The worker process exporting the report died')
+            ledger.record(row['trace_no'], 'process', 'Worker Died', e_pool)
+            return None
+        ledger.extend(records)
+        return docs[0]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+## Export tasks (lists of row indices) on a new pool, the docs are set in `docs` by row index
+## Returns the row indices of the tasks that did not finish because the pool broke
+## A pool that breaks while a task is submitted can drop it without failing its future, so once the pool is known
+## to be broken it is shut down and the tasks still pending are taken as unfinished
+def export_on_pool(rows, tasks, docs, workers, path_download_html, path_download_excel):
+    unfinished = []
+    broken = False
+    with process_pool(workers) as executor:
+        futures = []
+        try:
+            for task in tasks:
+                futures.append(executor.submit(export_chunk_worker, [rows[i] for i in task], path_download_html, path_download_excel))
+        except BrokenProcessPool:
+            executor.shutdown(wait=True)
+            broken = True
+        for task, future in zip(tasks, futures):
+            if broken and not future.done():
+                unfinished.extend(task)
+                continue
+            try:
+                task_docs, records = future.result()
+            except BrokenProcessPool:
+                if not broken:
+                    executor.shutdown(wait=True)
+                    broken = True
+                unfinished.extend(task)
+                continue
+            ledger.extend(records)
+            for i, doc in zip(task, task_docs):
+                docs[i] = doc
+    return unfinished + [i for task in tasks[len(futures):] for i in task]
+
+## Export the reports of ref_df, on a pool of processes when workers > 1, docs are returned in the order of the rows
+## Reports are sent to the workers in chunks. If the pool breaks, the unfinished reports are retried one per task on a
+## new pool, and if that pool breaks too they are exported one at a time so the report that breaks it is recorded as failed
+def process_reports(ref_df, path_download_html, path_download_excel, workers=process_workers, chunk_size=process_chunk_size):
+    rows = [row for _, row in ref_df.iterrows()]
+    if workers <= 1 or len(rows) <= 1:
+        docs = export_chunk(rows, path_download_html, path_download_excel)
+    else:
+        docs = [None] * len(rows)
+        chunks = list(divide_chunks(list(range(len(rows))), chunk_size))
+        unfinished = export_on_pool(rows, chunks, docs, min(workers, len(chunks)), path_download_html, path_download_excel)
+        if unfinished:
+            logger_main.info(f'[Warning] Process pool broke, retrying {len(unfinished)} reports one per task on a new pool')
+            unfinished = export_on_pool(rows, [[i] for i in unfinished], docs, min(workers, len(unfinished)), path_download_html, path_download_excel)
+        if unfinished:
+            logger_main.info(f'[Warning] Process pool broke again, exporting {len(unfinished)} reports one at a time')
+            isolated = IsolatedExporter(path_download_html, path_download_excel)
+            try:
+                for i in unfinished:
+                    docs[i] = isolated.export(rows[i])
+            finally:
+                isolated.close()
+    return [doc for doc in docs if doc is not None]
@@ -1,14 +1,198 @@
 import os
+import re
+import time
+import json
+import zlib
 import fnmatch
+import hashlib
+import zipfile
 import boto3
-from typing import List, Optional
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Pattern, Tuple
 
-def should_exclude(file_path: str, exclude_patterns: List[str]) -> bool:
-    for pattern in exclude_patterns:
-        if fnmatch.fnmatch(file_path, pattern):
-            return True
-    return False
+MB = 1024 * 1024
 
+sync_archive = os.getenv('SYNC_ARCHIVE', '0') == '1'
+sync_workers = int(os.getenv('SYNC_WORKERS', 8))
+multipart_threshold = int(os.getenv('SYNC_MULTIPART_THRESHOLD_MB', 16)) * MB
+multipart_chunksize = int(os.getenv('SYNC_MULTIPART_CHUNKSIZE_MB', 16)) * MB
+
+def make_transfer_config(max_concurrency: int = 4) -> TransferConfig:
+    return TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=multipart_chunksize,
+        max_concurrency=max_concurrency,
+        use_threads=True
+    )
+
+def compile_exclude_patterns(exclude_patterns: List[str]) -> Optional[Pattern]:
+    if not exclude_patterns:
+        return None
+    return re.compile('|'.join(f'(?:{fnmatch.translate(pattern)})' for pattern in exclude_patterns))
+
+## Directories whose files are all excluded by a 'dir/*' pattern are not walked
+def compile_exclude_dirs(exclude_patterns: List[str]) -> Optional[Pattern]:
+    dir_patterns = [pattern[:-2] for pattern in exclude_patterns if pattern.endswith('/*') and len(pattern) > 2]
+    return compile_exclude_patterns(dir_patterns)
+
+def should_exclude(file_path: str, exclude_patterns) -> bool:
+    if not isinstance(exclude_patterns, re.Pattern):
+        exclude_patterns = compile_exclude_patterns(list(exclude_patterns))
+    return exclude_patterns is not None and exclude_patterns.match(file_path) is not None
+
+## Size and ETag of every object under the prefix
+def list_remote_objects(s3_client, bucket_name: str, s3_prefix: str = "") -> Dict[str, Tuple[int, str]]:
+    remote = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix):
+        for obj in page.get('Contents', []):
+            remote[obj['Key']] = (obj['Size'], obj.get('ETag', '').strip('"'))
+    return remote
+
+## ETag S3 gives the file when it is uploaded with this transfer config: the MD5 of the file, or of the part MD5s for multipart uploads
+def local_etag(local_path: str, size: int, config: TransferConfig) -> str:
+    with open(local_path, 'rb') as data:
+        if size < config.multipart_threshold:
+            md5 = hashlib.md5()
+            for block in iter(lambda: data.read(MB), b''):
+                md5.update(block)
+            return md5.hexdigest()
+        parts = []
+        for part in iter(lambda: data.read(config.multipart_chunksize), b''):
+            parts.append(hashlib.md5(part).digest())
+    return f'{hashlib.md5(b"".join(parts)).hexdigest()}-{len(parts)}'
+
+def is_unchanged(local_path: str, size: int, remote: Optional[Tuple[int, str]], config: TransferConfig) -> bool:
+    if remote is None or remote[0] != size:
+        return False
+    return local_etag(local_path, size, config) == remote[1]
+
+## (local path, path relative to the directory) of the files that are not excluded
+def list_local_files(local_directory: str, exclude_patterns: List[str]) -> List[Tuple[str, str]]:
+    exclude_re = compile_exclude_patterns(exclude_patterns)
+    exclude_dirs_re = compile_exclude_dirs(exclude_patterns)
+    local_directory = os.path.abspath(local_directory)
+    local_files = []
+    for root, dirs, files in os.walk(local_directory):
+        relative_root = os.path.relpath(root, local_directory)
+        if exclude_dirs_re is not None:
+            dirs[:] = [d for d in dirs if not exclude_dirs_re.match(os.path.normpath(os.path.join(relative_root, d)))]
+        for file in files:
+            local_path = os.path.join(root, file)
+            relative_path = os.path.relpath(local_path, local_directory)
+            if exclude_re is None or not exclude_re.match(relative_path):
+                local_files.append((local_path, relative_path))
+    return local_files
+
+## Write-only file object uploading what is written to it as the parts of a multipart upload, nothing is kept on disk
+## An object smaller than one part is sent with a single put_object
+class S3MultipartWriter:
+    def __init__(self, s3_client, bucket_name: str, s3_key: str, part_size: int = multipart_chunksize):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.part_size = max(part_size, 5 * MB)
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.parts = []
+
+    def write(self, data) -> int:
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def seekable(self) -> bool:
+        return False
+
+    def flush(self) -> None:
+        pass
+
+    def upload_part(self, body: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key)['UploadId']
+        number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id, PartNumber=number, Body=body)
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def close(self) -> None:
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.s3_key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.upload_part(bytes(self.buffer))
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id,
+                                                     MultipartUpload={'Parts': self.parts})
+        self.buffer = bytearray()
+
+    def abort(self) -> None:
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.s3_key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+
+def archive_index_key(archive_key: str) -> str:
+    return archive_key + '.index.json'
+
+## Zip the files into one object while they are read, a manifest next to it gives the byte range of every file in the archive
+def archive_files_to_s3(files: List[Tuple[str, str]], bucket_name: str, s3_client, archive_key: str) -> Dict[str, float]:
+    start = time.perf_counter()
+    writer = S3MultipartWriter(s3_client, bucket_name, archive_key)
+    index = {}
+    size = 0
+    try:
+        with zipfile.ZipFile(writer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for local_path, relative_path in files:
+                name = relative_path.replace(os.sep, '/')
+                info = zipfile.ZipInfo.from_file(local_path, name)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(local_path, 'rb') as data, archive.open(info, 'w') as member:
+                    offset = writer.tell()
+                    for block in iter(lambda: data.read(MB), b''):
+                        member.write(block)
+                index[name] = dict(offset=offset, length=info.compress_size, size=info.file_size, method=info.compress_type, crc=info.CRC)
+                size += info.file_size
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    manifest = dict(archive=archive_key, files=index)
+    s3_client.put_object(Bucket=bucket_name, Key=archive_index_key(archive_key), Body=json.dumps(manifest, ensure_ascii=False).encode('utf-8'),
+                         ContentType='application/json')
+    elapsed = time.perf_counter() - start
+    summary = dict(files=len(index), bytes=size, archive_bytes=writer.position, seconds=round(elapsed, 3))
+    summary['mb_per_second'] = round(size / MB / elapsed, 2) if elapsed else 0.0
+    print(f"Archived {summary['files']} files ({summary['bytes']} bytes) into '{archive_key}' ({summary['archive_bytes']} bytes) "
+          f"in {summary['seconds']}s: {summary['mb_per_second']} MB/s")
+    return summary
+
+def load_archive_index(s3_client, bucket_name: str, archive_key: str) -> Dict[str, Dict[str, int]]:
+    body = s3_client.get_object(Bucket=bucket_name, Key=archive_index_key(archive_key))['Body'].read()
+    return json.loads(body)['files']
+
+## Content of one file of an archive, read with a ranged GET of its compressed bytes
+def fetch_archived_file(s3_client, bucket_name: str, archive_key: str, name: str, index: Optional[Dict[str, Dict[str, int]]] = None) -> bytes:
+    if index is None:
+        index = load_archive_index(s3_client, bucket_name, archive_key)
+    entry = index[name]
+    if entry['length'] == 0:
+        data = b''
+    else:
+        byte_range = f"bytes={entry['offset']}-{entry['offset'] + entry['length'] - 1}"
+        data = s3_client.get_object(Bucket=bucket_name, Key=archive_key, Range=byte_range)['Body'].read()
+    if entry['method'] == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    if zlib.crc32(data) != entry['crc']:
+        raise ValueError(f"CRC mismatch for '{name}' in '{archive_key}'")
+    return data
+
+## With archive_key the files are zipped into that single object instead of being uploaded one by one
 def sync_directory_to_s3(
     local_directory: str,
     bucket_name: str,
@@ -18,9 +202,14 @@ def sync_directory_to_s3(
     aws_access_key_id: Optional[str] = None,
     aws_secret_access_key: Optional[str] = None,
     aws_session_token: Optional[str] = None,
-    region_name: Optional[str] = None
-) -> None:
+    region_name: Optional[str] = None,
+    max_workers: int = sync_workers,
+    skip_unchanged: bool = True,
+    transfer_config: Optional[TransferConfig] = None,
+    archive_key: Optional[str] = None
+) -> Dict[str, float]:
     exclude_patterns = exclude_patterns or []
+    transfer_config = transfer_config or make_transfer_config()
 
     if s3_client is None:
         s3_client = boto3.client(
@@ -31,24 +220,53 @@ def sync_directory_to_s3(
             region_name=region_name
         )
 
-    local_directory = os.path.abspath(local_directory)
+    start = time.perf_counter()
 
-    files_to_upload = []
-    for root, _, files in os.walk(local_directory):
-        for file in files:
-            local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_path, local_directory)
-            if not should_exclude(relative_path, exclude_patterns):
-                files_to_upload.append((local_path, relative_path))
+    files_to_upload = list_local_files(local_directory, exclude_patterns)
+    if archive_key is not None:
+        return archive_files_to_s3(files_to_upload, bucket_name, s3_client, archive_key)
 
-    for local_path, relative_path in files_to_upload:
-        s3_key = os.path.join(s3_prefix, relative_path).replace(os.sep, '/')
+    remote = {}
+    if skip_unchanged and files_to_upload:
         try:
-            with open(local_path, "rb") as data:
-                s3_client.upload_fileobj(data, bucket_name, s3_key)
-            print(f"File '{relative_path}' uploaded successfully.")
+            remote = list_remote_objects(s3_client, bucket_name, s3_prefix)
         except Exception as e:
-            print(f"Error uploading file: {e}")
+            print(f"Error listing remote files, uploading all: {e}")
+
+    summary = dict(files=0, bytes=0, skipped=0, skipped_bytes=0, failed=0)
+
+    def upload(local_path, relative_path):
+        s3_key = os.path.join(s3_prefix, relative_path).replace(os.sep, '/')
+        size = os.path.getsize(local_path)
+        if skip_unchanged and is_unchanged(local_path, size, remote.get(s3_key), transfer_config):
+            return relative_path, size, False
+        s3_client.upload_file(local_path, bucket_name, s3_key, Config=transfer_config)
+        return relative_path, size, True
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(upload, local_path, relative_path) for local_path, relative_path in files_to_upload]
+        for future in as_completed(futures):
+            try:
+                relative_path, size, uploaded = future.result()
+            except Exception as e:
+                summary['failed'] += 1
+                print(f"Error uploading file: {e}")
+                continue
+            if uploaded:
+                summary['files'] += 1
+                summary['bytes'] += size
+                print(f"File '{relative_path}' uploaded successfully.")
+            else:
+                summary['skipped'] += 1
+                summary['skipped_bytes'] += size
+
+    elapsed = time.perf_counter() - start
+    summary['seconds'] = round(elapsed, 3)
+    summary['files_per_second'] = round(summary['files'] / elapsed, 2) if elapsed else 0.0
+    summary['mb_per_second'] = round(summary['bytes'] / MB / elapsed, 2) if elapsed else 0.0
+    print(f"Uploaded {summary['files']} files ({summary['bytes']} bytes), skipped {summary['skipped']} unchanged, "
+          f"{summary['failed']} failed in {summary['seconds']}s: {summary['files_per_second']} files/s, {summary['mb_per_second']} MB/s")
+    return summary
 
 if __name__ == "__main__":
     s3_client = boto3.client(
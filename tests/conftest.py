@@ -0,0 +1,28 @@
+## Tests run against the flat modules of the repository root, with the saved Codal pages under fixtures/codal
+
+import os
+import sys
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+@pytest.fixture
+def codal_paths():
+    return os.path.join(fixtures, 'codal', 'html') + '/', os.path.join(fixtures, 'codal', 'excel') + '/'
+
+## Rows of ref_df for the fixture reports: 1001 has datasource sheets and an html table sheet, 1002 an html table
+## sheet and an excel export, 2001 an html table sheet with unclosed tags and a malformed excel export
+@pytest.fixture
+def codal_rows():
+    import pandas as pd
+    titles = {
+        1001: 'اطلاعات و صورت‌های مالی میاندوره‌ای دوره ۶ ماهه منتهی به ۱۴۰۳/۰۶/۳۱ (حسابرسی نشده)',
+        1002: 'صورت‌های مالی سال مالی منتهی به ۱۴۰۲/۱۲/۲۹',
+        2001: 'صورت‌های مالی سال مالی منتهی به ۱۴۰۲/۱۲/۲۹',
+    }
+    return [pd.Series(dict(trace_no=trace_no, symbol='s', company_name='c', title=title, date_j='1403/07/01',
+                           date_g=pd.Timestamp('2024-09-22 10:00:00'), url='u', excel_url='e'))
+            for trace_no, title in titles.items()]
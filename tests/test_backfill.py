@@ -0,0 +1,100 @@
+## Backfill of a range of dates: each date is marked in the checkpoint file, a rerun only updates the dates not done
+
+import json
+import os
+import threading
+import pytest
+import pymongo
+import main
+import mongo_writer
+import utils
+from main import Checkpoint, backfill, date_range
+
+def test_date_range():
+    assert date_range('2024-02-28', '2024-03-01') == ['2024-02-28', '2024-02-29', '2024-03-01']
+    assert date_range('2024-03-01', '2024-03-01') == ['2024-03-01']
+    assert date_range('2024-03-02', '2024-03-01') == []
+
+def test_checkpoint(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint = Checkpoint(path)
+    assert not checkpoint.done('2024-09-01')
+    checkpoint.mark('2024-09-01', 'done', docs=3)
+    checkpoint.mark('2024-09-02', 'failed', error='list')
+    assert os.listdir(tmp_path) == ['checkpoint.json']
+    reloaded = Checkpoint(path)
+    assert reloaded.done('2024-09-01') and not reloaded.done('2024-09-02') and not reloaded.done('2024-09-03')
+    assert reloaded.dates['2024-09-01']['docs'] == 3 and reloaded.dates['2024-09-02']['error'] == 'list'
+    with open(path, encoding='utf-8') as checkpoint_file:
+        assert sorted(json.load(checkpoint_file)) == ['2024-09-01', '2024-09-02']
+
+def test_checkpoint_marks_from_threads(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+    threads = [threading.Thread(target=checkpoint.mark, args=(f'2024-09-{day:02d}', 'done')) for day in range(1, 21)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(Checkpoint(checkpoint.path).done(f'2024-09-{day:02d}') for day in range(1, 21)) == 20
+
+class FakeMongoClient:
+    def __init__(self, uri=None):
+        self.closed = False
+
+    def __getitem__(self, name):
+        return {'new': 'collection'}
+
+    def close(self):
+        self.closed = True
+
+## backfill with the MongoDB, S3 and Codal side replaced, `outcomes` gives the result of update by date
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'init', lambda: os.makedirs(main.today, exist_ok=True))
+    monkeypatch.setattr(pymongo, 'MongoClient', FakeMongoClient)
+    monkeypatch.setattr(utils, 'get_s3_client', lambda: 's3')
+    monkeypatch.setattr(mongo_writer, 'ensure_trace_no_index', lambda collection: None)
+    monkeypatch.setattr(main, 'close_clients', lambda: None)
+    monkeypatch.setattr(main, 'evict_cache', lambda: None)
+    calls = dict(update=[], sync=[])
+    def sync_run(s3_client, bucket_name, local_directory, s3_prefix=None):
+        calls['sync'].append(s3_prefix)
+    monkeypatch.setattr(main, 'sync_run', sync_run)
+    def run(start, end, outcomes=None, concurrency=2):
+        def update(date, path_download_excel, path_download_html, path_export, collection):
+            calls['update'].append(date)
+            assert os.path.isdir(path_download_html) and os.path.isdir(path_download_excel) and os.path.isdir(path_export)
+            outcome = (outcomes or {}).get(date, dict(docs=2, failed=[]))
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        monkeypatch.setattr(main, 'update', update)
+        calls['update'].clear()
+        calls['sync'].clear()
+        backfill(start, end, concurrency=concurrency, checkpoint_path=str(tmp_path / 'checkpoint.json'))
+        return Checkpoint(str(tmp_path / 'checkpoint.json'))
+    run.calls = calls
+    return run
+
+def test_backfill_resumes_after_failures(run, tmp_path):
+    outcomes = {'2024-09-02': RuntimeError('list failed'), '2024-09-03': dict(docs=1, failed=['1003'])}
+    checkpoint = run('2024-09-01', '2024-09-04', outcomes)
+    assert sorted(run.calls['update']) == ['2024-09-01', '2024-09-02', '2024-09-03', '2024-09-04']
+    assert {date: entry['status'] for date, entry in checkpoint.dates.items()} == \
+        {'2024-09-01': 'done', '2024-09-02': 'failed', '2024-09-03': 'failed', '2024-09-04': 'done'}
+    assert checkpoint.dates['2024-09-02']['error'] == 'list failed'
+    assert sorted(run.calls['sync'][:-1]) == ['update_db/backfill/2024-09-01', 'update_db/backfill/2024-09-03', 'update_db/backfill/2024-09-04']
+    assert run.calls['sync'][-1] is None
+    assert os.listdir(tmp_path) == ['checkpoint.json']
+    checkpoint = run('2024-09-01', '2024-09-04')
+    assert sorted(run.calls['update']) == ['2024-09-02', '2024-09-03']
+    assert all(checkpoint.done(date) for date in date_range('2024-09-01', '2024-09-04'))
+    run('2024-09-01', '2024-09-04')
+    assert run.calls['update'] == []
+
+## The range can grow, only the new dates are updated
+def test_backfill_extends_the_range(run):
+    run('2024-09-01', '2024-09-02', concurrency=1)
+    run('2024-08-31', '2024-09-03', concurrency=1)
+    assert run.calls['update'] == ['2024-08-31', '2024-09-03']
@@ -0,0 +1,58 @@
+## bson_ready gives the docs of the NpEncoder / DateTimeDecoder round trip it replaced, with the same value types
+
+import json
+import math
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pytest
+import process
+from process import NpEncoder, bson_ready
+
+## The decoder of the round trip before the docs were converted in one walk
+class DateTimeDecoder(json.JSONDecoder):
+    def __init__(self, datetime_keys=None, format="%Y-%m-%d %H:%M:%S", *args, **kwargs):
+        self.datetime_keys = set(datetime_keys or [])
+        self.format = format
+        super().__init__(object_hook=self.object_hook, *args, **kwargs)
+
+    def object_hook(self, obj):
+        for key in self.datetime_keys:
+            if key in obj and isinstance(obj[key], str):
+                try:
+                    obj[key] = datetime.strptime(obj[key], self.format)
+                except ValueError:
+                    pass
+        return obj
+
+def round_trip(docs):
+    return json.loads(json.dumps(docs, cls=NpEncoder), cls=DateTimeDecoder, datetime_keys=['date_g'])
+
+def typed(obj):
+    if isinstance(obj, dict):
+        return [(key, typed(value)) for key, value in obj.items()]
+    if isinstance(obj, list):
+        return [typed(value) for value in obj]
+    if isinstance(obj, float) and math.isnan(obj):
+        return ('nan',)
+    return (type(obj).__name__, obj)
+
+docs = {
+    'numpy_scalars': [dict(trace_no=np.int64(1001), value=np.float32(1.5), big=np.uint64(2 ** 63), small=np.int8(-3), nan=np.float64('nan'))],
+    'python_values': [dict(trace_no=1, title='صورت', ok=True, none=None, value=2.0, nan=float('nan'), inf=float('inf'))],
+    'containers': [dict(rows=(1, (2, 3)), array=np.array([[1, 2], [3, 4]]), floats=np.array([1.5, np.nan]), empty=[])],
+    'non_str_keys': [{1: 'a', 2.5: 'b', False: 'c', None: 'd', 'k': {3: 'e'}}],
+    'timestamps': [dict(date=pd.Timestamp('2024-09-22 10:00:00'), np_date=np.datetime64('2024-09-22T10:00:00'),
+                        dates=np.array(['2024-09-22', '2024-09-23'], dtype='datetime64[D]'), complex=np.complex128(1 + 2j))],
+    'date_g': [dict(date_g='2024-09-22 10:00:00', nested=dict(date_g='2024-09-23 11:30:00', other='2024-09-23 11:30:00')),
+               dict(date_g=pd.Timestamp('2024-09-22 10:00:00')), dict(date_g='1403/07/01'), dict(date_g=None), dict(date_g=5)],
+}
+
+@pytest.mark.parametrize('name', sorted(docs))
+def test_same_as_round_trip(name):
+    assert typed(bson_ready(docs[name])) == typed(round_trip(docs[name]))
+
+def test_fixture_docs(codal_rows, codal_paths):
+    exported = [process.json_export(row, *codal_paths) for row in codal_rows]
+    assert typed(bson_ready(exported)) == typed(round_trip(exported))
+    assert all(type(doc['date_g']) is datetime for doc in bson_ready(exported))
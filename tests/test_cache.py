@@ -0,0 +1,81 @@
+## Persistent download cache: entries, freshness, revalidation headers and eviction
+
+import os
+import time
+import pytest
+import cache as cache_module
+from cache import DownloadCache, cache_from_env
+
+@pytest.fixture
+def cache(tmp_path):
+    return DownloadCache(str(tmp_path / 'cache'), fresh_for=60, max_age=3600, max_bytes=100)
+
+def test_put_and_get(cache):
+    assert cache.get(1001, 1) is None
+    cache.put(1001, 1, 'صفحه', etag='"a"', last_modified='Sun, 01 Sep 2024 10:00:00 GMT')
+    entry = cache.get('1001', '1')
+    assert entry['trace_no'] == '1001' and entry['sheet_id'] == '1'
+    assert entry['size'] == len('صفحه'.encode('utf-8'))
+    assert cache.body(entry) == 'صفحه'
+    assert cache.is_fresh(entry)
+
+def test_put_replaces_the_entry(cache):
+    cache.put(1001, 1, 'old', etag='"a"')
+    cache.put(1001, 1, 'new')
+    entry = cache.get(1001, 1)
+    assert cache.body(entry) == 'new' and entry['etag'] is None
+
+## Sheets with the same body share one file
+def test_bodies_are_shared(cache):
+    cache.put(1001, 1, 'same')
+    cache.put(1002, 1, 'same')
+    assert cache.get(1001, 1)['sha256'] == cache.get(1002, 1)['sha256']
+    assert len(os.listdir(os.path.join(cache.path, 'bodies'))) == 1
+
+def test_entry_without_its_body_is_a_miss(cache):
+    cache.put(1001, 1, 'body')
+    os.remove(cache.body_path(cache.get(1001, 1)['sha256']))
+    assert cache.get(1001, 1) is None
+
+def test_freshness_and_touch(cache, monkeypatch):
+    cache.put(1001, 1, 'body')
+    now = time.time()
+    monkeypatch.setattr(cache_module.time, 'time', lambda: now + 120)
+    assert not cache.is_fresh(cache.get(1001, 1))
+    cache.touch(1001, 1)
+    assert cache.is_fresh(cache.get(1001, 1))
+
+def test_conditional_headers(cache):
+    cache.put(1001, 1, 'a', etag='"a"', last_modified='Sun, 01 Sep 2024 10:00:00 GMT')
+    cache.put(1001, 2, 'b', etag='"b"')
+    cache.put(1001, 3, 'c')
+    assert cache.conditional_headers(cache.get(1001, 1)) == {'If-None-Match': '"a"', 'If-Modified-Since': 'Sun, 01 Sep 2024 10:00:00 GMT'}
+    assert cache.conditional_headers(cache.get(1001, 2)) == {'If-None-Match': '"b"'}
+    assert cache.conditional_headers(cache.get(1001, 3)) == {}
+
+def test_evict_old_entries(cache, monkeypatch):
+    cache.put(1001, 1, 'old')
+    now = time.time()
+    monkeypatch.setattr(cache_module.time, 'time', lambda: now + 7200)
+    cache.put(1001, 2, 'new')
+    assert cache.evict() == 1
+    assert cache.get(1001, 1) is None and cache.get(1001, 2) is not None
+
+## Past max_bytes the least recently fetched entries go first
+def test_evict_to_max_bytes(cache, monkeypatch):
+    now = time.time()
+    for n in range(4):
+        monkeypatch.setattr(cache_module.time, 'time', lambda n=n: now + n)
+        cache.put(1001, n, str(n) * 40)
+    cache.evict()
+    assert [cache.get(1001, n) is not None for n in range(4)] == [False, False, True, True]
+    assert len(os.listdir(os.path.join(cache.path, 'bodies'))) == 2
+
+def test_cache_from_env(tmp_path, monkeypatch):
+    monkeypatch.setenv('CODAL_CACHE', '0')
+    assert cache_from_env() is None
+    monkeypatch.setenv('CODAL_CACHE', '1')
+    monkeypatch.setenv('CODAL_CACHE_DIR', str(tmp_path / 'env-cache'))
+    monkeypatch.setenv('CODAL_CACHE_FRESH_HOURS', '2')
+    cache = cache_from_env()
+    assert cache.path == str(tmp_path / 'env-cache') and cache.fresh_for == 7200
@@ -0,0 +1,207 @@
+## The list of a date is complete or the search fails, a failed page is never taken for the end of the list
+
+import asyncio
+import os
+import aiohttp
+import pytest
+from aiohttp import web
+import codal_client
+import download
+from cache import DownloadCache
+from codal_client import CodalClient, ListError, ResponseError
+from conftest import fixtures
+from ledger import ledger
+
+def client_with_pages(pages, failing=(), page_count=True):
+    client = CodalClient()
+    async def search_page(date_j, n_page):
+        if n_page in failing:
+            raise ResponseError('Response status 503')
+        letters = pages[n_page - 1] if n_page <= len(pages) else []
+        return dict(Letters=letters, Page=len(pages) if page_count else 0, Total=0)
+    client.search_page = search_page
+    return client
+
+pages = [[dict(TracingNo=1), dict(TracingNo=2)], [dict(TracingNo=3), dict(TracingNo=4)], [dict(TracingNo=5)]]
+
+@pytest.mark.parametrize('page_count', [True, False])
+def test_all_pages(page_count):
+    letters = asyncio.run(client_with_pages(pages, page_count=page_count).get_list('1403/07/01'))
+    assert [letter['TracingNo'] for letter in letters] == [1, 2, 3, 4, 5]
+
+@pytest.mark.parametrize('page_count', [True, False])
+@pytest.mark.parametrize('failing', [1, 2, 3])
+def test_failed_page_raises(failing, page_count):
+    with pytest.raises(ListError):
+        asyncio.run(client_with_pages(pages, failing=(failing,), page_count=page_count).get_list('1403/07/01'))
+
+def test_empty_date():
+    assert asyncio.run(client_with_pages([[]]).get_list('1403/07/01')) == []
+
+## Tests against a local codal.ir stub served by aiohttp, the client runs on the same event loop
+def page(name):
+    with open(os.path.join(fixtures, 'codal', 'html', name), encoding='utf-8') as sheetfile:
+        return sheetfile.read()
+
+class Stub:
+    def __init__(self):
+        self.requests = []
+        ## Statuses served before the normal answer of a path, e.g. {'/flaky': [503, 503]}
+        self.failures = {}
+        self.etags = {}
+
+    async def handle(self, request):
+        self.requests.append((request.path, request.query.get('SheetId'), dict(request.headers)))
+        failures = self.failures.get(request.path, [])
+        if failures:
+            return web.Response(status=failures.pop(0), text='unavailable')
+        if request.path == '/report':
+            sheet = request.query.get('SheetId', '0')
+            if sheet in self.failures.get('sheets', ()):
+                return web.Response(status=500, text='error')
+            etag = self.etags.get(sheet)
+            if etag and request.headers.get('If-None-Match') == etag:
+                return web.Response(status=304)
+            return web.Response(text=page(f'1001-{sheet}.html'), content_type='text/html', headers={'ETag': etag} if etag else None)
+        if request.path == '/excel':
+            return web.Response(text='<html><h3>صورت سود و زیان</h3><table></table></html>', content_type='text/html')
+        if request.path == '/search':
+            n_page = int(request.query['page'])
+            if n_page in self.failures.get('pages', ()):
+                return web.Response(status=500, text='error')
+            return web.json_response(dict(Letters=[dict(TracingNo=n_page * 10 + i) for i in range(2)], Page=3, Total=6))
+        return web.Response(text='ok')
+
+## Run `scenario(client, base)` against the stub, with no backoff so the retries are immediate
+def run(stub, scenario, **kwargs):
+    async def main():
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', stub.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        base = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        client = CodalClient(**dict(dict(rate=0, retries=2, backoff_factor=0, timeout=5, search_url=base + '/search?date={date_j}&page={n_page}'), **kwargs))
+        await client.start()
+        try:
+            return await scenario(client, base)
+        finally:
+            await client.close()
+            await runner.cleanup()
+    return asyncio.run(main())
+
+@pytest.fixture
+def no_cache(monkeypatch):
+    monkeypatch.setattr(download, '_cache', None)
+    monkeypatch.setattr(download, '_cache_opened', True)
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(download, '_cache', cache)
+    monkeypatch.setattr(download, '_cache_opened', True)
+    return cache
+
+def test_get_retries_the_status_forcelist(no_cache):
+    stub = Stub()
+    stub.failures['/flaky'] = [503, 502]
+    status, text = run(stub, lambda client, base: client.get(base + '/flaky', {}))
+    assert (status, text) == (200, 'ok')
+    assert len(stub.requests) == 3
+
+def test_get_returns_the_last_status_when_retries_are_exhausted(no_cache):
+    stub = Stub()
+    stub.failures['/down'] = [503, 503, 503, 503]
+    status, text = run(stub, lambda client, base: client.get(base + '/down', {}))
+    assert (status, text) == (503, 'unavailable')
+    assert len(stub.requests) == 3
+
+def test_get_does_not_retry_other_statuses(no_cache):
+    stub = Stub()
+    stub.failures['/missing'] = [404]
+    assert run(stub, lambda client, base: client.get(base + '/missing', {}))[0] == 404
+    assert len(stub.requests) == 1
+
+def test_get_raises_on_connection_errors_after_the_retries(no_cache):
+    async def scenario(client, base):
+        return await client.get('http://127.0.0.1:9/closed', {})
+    with pytest.raises(aiohttp.ClientError):
+        run(Stub(), scenario)
+
+## The backoff before a retry is jittered in [0, backoff_factor * 2 ** attempt]
+def test_backoff_between_retries(no_cache, monkeypatch):
+    sleeps = []
+    async def sleep(delay):
+        sleeps.append(delay)
+    monkeypatch.setattr(codal_client.random, 'uniform', lambda low, high: high)
+    stub = Stub()
+    stub.failures['/flaky'] = [503, 503]
+    async def scenario(client, base):
+        monkeypatch.setattr(codal_client.asyncio, 'sleep', sleep)
+        try:
+            return await client.get(base + '/flaky', {})
+        finally:
+            monkeypatch.undo()
+    assert run(stub, scenario, backoff_factor=0.5)[0] == 200
+    assert sleeps == [0.5, 1.0]
+
+def test_cached_get_revalidates_with_304(cache):
+    stub = Stub()
+    stub.etags['1'] = '"v1"'
+    cache.put(1001, '1', page('1001-1.html'), etag='"v1"')
+    cache.fresh_for = 0
+    status, text = run(stub, lambda client, base: client.cached_get(1001, '1', base + '/report?SheetId=1', {}))
+    assert (status, text) == (200, page('1001-1.html'))
+    assert stub.requests[0][2]['If-None-Match'] == '"v1"'
+    cache.fresh_for = 60
+    assert cache.is_fresh(cache.get(1001, '1'))
+
+def test_cached_get_serves_a_fresh_entry(cache):
+    stub = Stub()
+    cache.put(1001, '1', page('1001-1.html'))
+    assert run(stub, lambda client, base: client.cached_get(1001, '1', base + '/report?SheetId=1', {}))[0] == 200
+    assert stub.requests == []
+
+def test_cached_get_does_not_cache_errors(cache):
+    stub = Stub()
+    stub.failures['/report'] = [500, 500, 500]
+    assert run(stub, lambda client, base: client.cached_get(1001, '1', base + '/report?SheetId=1', {}))[0] == 500
+    assert cache.get(1001, '1') is None
+
+def report_row(base):
+    return dict(trace_no=1001, url=base + '/report?LetterSerial=x', sheet_no=float('nan'), excel_url=base + '/excel')
+
+def test_download_sheets(no_cache, tmp_path):
+    stub = Stub()
+    html, excel = str(tmp_path / 'html') + '/', str(tmp_path / 'excel') + '/'
+    os.makedirs(html)
+    os.makedirs(excel)
+    run(stub, lambda client, base: client.download_sheets(report_row(base), html, excel))
+    assert sorted(os.listdir(html)) == ['1001-0.html', '1001-0.json', '1001-1.html', '1001-1.json', '1001-2.html', '1001-2.json']
+    assert os.listdir(excel) == []
+
+## A sub sheet that fails makes the report fall back to its excel export
+def test_download_sheets_falls_back_to_excel(no_cache, tmp_path):
+    ledger.reset()
+    stub = Stub()
+    stub.failures['sheets'] = ['2']
+    html, excel = str(tmp_path / 'html') + '/', str(tmp_path / 'excel') + '/'
+    os.makedirs(html)
+    os.makedirs(excel)
+    try:
+        run(stub, lambda client, base: client.download_sheets(report_row(base), html, excel))
+        assert os.listdir(excel) == ['1001.xls']
+        assert [(entry['kind'], entry['sheet']) for entry in ledger.records] == [('Sub sheet did not download', '2')]
+    finally:
+        ledger.reset()
+
+def test_get_list_from_the_search_api(no_cache):
+    letters = run(Stub(), lambda client, base: client.get_list('1403/07/01'))
+    assert [letter['TracingNo'] for letter in letters] == [10, 11, 20, 21, 30, 31]
+
+def test_get_list_raises_when_a_page_fails(no_cache):
+    stub = Stub()
+    stub.failures['pages'] = [2]
+    with pytest.raises(ListError):
+        run(stub, lambda client, base: client.get_list('1403/07/01'))
@@ -0,0 +1,105 @@
+## Downloading a sheet through the cache: each page is parsed once, and invalid bodies are never cached
+
+import os
+import pytest
+import download
+import parsing
+from cache import DownloadCache
+from conftest import fixtures
+
+sheet_page = open(os.path.join(fixtures, 'codal', 'html', '1001-1.html'), encoding='utf-8').read()
+
+class Response:
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = DownloadCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(download, '_cache', cache)
+    monkeypatch.setattr(download, '_cache_opened', True)
+    return cache
+
+## Responses served by download.get in order, the requests are kept with their headers
+@pytest.fixture
+def responses(monkeypatch):
+    served, requests = [], []
+    def get(url, headers, timeout=None):
+        requests.append(dict(url=url, headers=headers))
+        return served.pop(0)
+    monkeypatch.setattr(download, 'get', get)
+    return served, requests
+
+@pytest.fixture
+def parses(monkeypatch):
+    calls = []
+    def sheet_document(text):
+        calls.append(text)
+        return parsing.sheet_document(text)
+    monkeypatch.setattr(download, 'sheet_document', sheet_document)
+    return calls
+
+def row():
+    return dict(trace_no=1001, url='https://codal.ir/Reports/Decision.aspx?LetterSerial=x&SheetId=0', sheet_no=float('nan'), excel_url='e')
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_sub_sheet_is_parsed_once(cache, responses, parses, tmp_path, cached):
+    served, requests = responses
+    if cached:
+        cache.put(1001, 1, sheet_page)
+    else:
+        served.append(Response(200, sheet_page))
+    path = str(tmp_path) + '/'
+    assert download.download_sub_sheet(row(), 1, path)
+    assert len(parses) == 1
+    assert len(requests) == (0 if cached else 1)
+    assert parsing.read_sheet_document(path + '1001-1.html')['sheet_id'] == parsing.sheet_document(sheet_page)['sheet_id']
+
+def test_report_page_is_parsed_once(cache, responses, parses, tmp_path):
+    served, _ = responses
+    served.append(Response(200, sheet_page))
+    options = download.download_report_page(row(), str(tmp_path) + '/', str(tmp_path) + '/')
+    assert options == parsing.sheet_document(sheet_page)['options']
+    assert len(parses) == 1
+
+@pytest.mark.parametrize('sheet_id, text, valid', [
+    (1, sheet_page, True),
+    (1, '<html><body>سامانه در حال به روز رسانی است</body></html>', False),
+    (1, '<select><option value="1">a</option></select>', False),
+    ('excel', '<html><h3>صورت سود و زیان</h3><table></table></html>', True),
+    ('excel', '<html>Error</html>', False),
+])
+def test_valid_body(sheet_id, text, valid):
+    assert download.valid_body(sheet_id, text) is valid
+
+def test_invalid_body_is_not_cached(cache, responses):
+    served, _ = responses
+    served.append(Response(200, '<html>maintenance</html>', {'ETag': '"m"'}))
+    assert download.cached_get(1001, 1, 'u', {}) == (200, '<html>maintenance</html>')
+    assert cache.get(1001, 1) is None
+
+## A cached body that is not valid any more is refetched without the revalidation headers
+def test_invalid_cached_body_is_refetched(cache, responses):
+    served, requests = responses
+    cache.put(1001, 1, '<html>maintenance</html>', etag='"m"')
+    served.append(Response(200, sheet_page, {'ETag': '"s"'}))
+    assert download.cached_get(1001, 1, 'u', {}) == (200, sheet_page)
+    assert 'If-None-Match' not in requests[0]['headers']
+    assert cache.body(cache.get(1001, 1)) == sheet_page
+
+def test_stale_entry_is_revalidated(cache, responses):
+    served, requests = responses
+    cache.put(1001, 1, sheet_page, etag='"s"', last_modified='Sun, 01 Sep 2024 10:00:00 GMT')
+    cache.fresh_for = 0
+    served.append(Response(304, ''))
+    assert download.cached_get(1001, 1, 'u', {'Accept': 'text/html'}) == (200, sheet_page)
+    assert requests[0]['headers'] == {'Accept': 'text/html', 'If-None-Match': '"s"', 'If-Modified-Since': 'Sun, 01 Sep 2024 10:00:00 GMT'}
+
+def test_refresh_skips_a_fresh_entry(cache, responses):
+    served, requests = responses
+    cache.put(1001, 1, sheet_page, etag='"s"')
+    served.append(Response(200, sheet_page))
+    download.cached_get(1001, 1, 'u', {}, refresh=True)
+    assert len(requests) == 1
@@ -0,0 +1,27 @@
+## NDJSON export of the pipeline: batches are appended and the reprocessed docs replace their lines
+
+import json
+from datetime import datetime
+from process import append_export, replace_export
+
+def read_lines(path):
+    with open(path, encoding='utf-8') as exportf:
+        return [json.loads(line) for line in exportf]
+
+def test_batches_are_appended(tmp_path):
+    path = str(tmp_path / 'fs_success_data.jsonl')
+    append_export(path, [dict(trace_no=1, title='صورت'), dict(trace_no=2, date_g=datetime(2024, 9, 22, 10))])
+    append_export(path, [dict(trace_no=3)])
+    assert read_lines(path) == [dict(trace_no=1, title='صورت'), dict(trace_no=2, date_g='2024-09-22 10:00:00'), dict(trace_no=3)]
+
+def test_reprocessed_docs_replace_their_lines(tmp_path):
+    path = str(tmp_path / 'fs_success_data.jsonl')
+    append_export(path, [dict(trace_no=1, state=0), dict(trace_no=2, state=0), dict(trace_no=3, state=0)])
+    replace_export(path, [dict(trace_no=2, state=1), dict(trace_no=4, state=1)])
+    assert read_lines(path) == [dict(trace_no=1, state=0), dict(trace_no=3, state=0), dict(trace_no=2, state=1), dict(trace_no=4, state=1)]
+    assert not (tmp_path / 'fs_success_data.jsonl.tmp').exists()
+
+def test_replace_without_export(tmp_path):
+    path = str(tmp_path / 'fs_success_data.jsonl')
+    replace_export(path, [dict(trace_no=5)])
+    assert read_lines(path) == [dict(trace_no=5)]
@@ -0,0 +1,100 @@
+## The native formula evaluation gives the same results as xlcalculator on the tables of the datasource sheets
+
+import math
+import pytest
+import formula
+from formula import FormulaGraph, Unsupported, evaluate_formulas, xlcalculator_results
+
+def same(native, reference):
+    assert set(native) == set(reference)
+    for address, value in native.items():
+        expected = reference[address]
+        assert type(value) is type(expected), address
+        if isinstance(value, float) and math.isnan(value):
+            assert math.isnan(expected), address
+        else:
+            assert value == expected, address
+
+def formulas_of(values):
+    return {address: value for address, value in values.items() if isinstance(value, str) and value[:1] == '='}
+
+## Native results, the table must not fall back to xlcalculator
+def native_results(values):
+    return FormulaGraph(formulas_of(values)).evaluate(dict(values))
+
+tables = {
+    'arithmetic': {
+        'A1': 10, 'A2': 2.5, 'A3': -4,
+        'B1': '=A1+A2*A3', 'B2': '=(A1-A2)/A3', 'B3': '=-A1+-(A2)', 'B4': '=B1*2-B2',
+    },
+    'div0': {
+        'A1': 5, 'A2': 0,
+        'B1': '=A1/A2', 'B2': '=B1+1', 'B3': '=SUM(B1,A1)', 'B4': '=A1/Z9', 'B5': '=-B1',
+    },
+    'text_to_number': {
+        'A1': '5', 'A2': ' 7 ', 'A3': '1.5', 'A4': 'abc', 'A5': 'true', 'A6': '0',
+        'B1': '=A1+A2', 'B2': '=A3*2', 'B3': '=A4+1', 'B4': '=A5+1', 'B5': '=-A1', 'B6': '=A1/A6', 'B7': '=B3*0',
+    },
+    'blank_refs': {
+        'A1': 3,
+        'B1': '=Z1', 'B2': '=Z1+A1', 'B3': '=A1*Z2', 'B4': '=-Z3', 'B5': '=SUM(Z1:Z3)', 'B6': '=A1/Z4',
+    },
+    'sum_ranges': {
+        'A1': 1, 'A2': '2', 'A3': 'abc', 'A4': 4.5, 'A5': 'true',
+        'C1': 5, 'C2': 0,
+        'B1': '=SUM(A1:A5)', 'B2': '=SUM(A1:A5,10)', 'B3': '=SUM(A1:A8)', 'B4': '=sum(A1:A2, C1)',
+        'D1': '=C1/C2', 'D2': '=SUM(C1:C2,D1)', 'D3': '=SUM(A1,A3)', 'D4': '=SUM(A3)+1',
+    },
+}
+
+## xlcalculator recurses on a cycle until it runs out of memory, its result on this table is recorded instead
+cycles = {'A1': 1, 'B1': '=B2+1', 'B2': '=B1+A1', 'B3': '=B1*2', 'B4': '=A1+1', 'B5': '=B5'}
+cycles_xlcalculator = {'B4': 2}
+
+@pytest.mark.parametrize('name', sorted(tables))
+def test_native_matches_xlcalculator(name):
+    values = tables[name]
+    same(native_results(values), xlcalculator_results(dict(values)))
+
+@pytest.mark.parametrize('name', sorted(tables))
+def test_evaluate_formulas_matches_xlcalculator(name):
+    values = tables[name]
+    same(evaluate_formulas(dict(values), ('test', name)), xlcalculator_results(dict(values)))
+
+## #DIV/0! propagates through arithmetic and the cells are left out, SUM skips the error of an argument like xlcalculator
+def test_div0_cells_are_left_out():
+    assert native_results(tables['div0']) == {'B3': 5}
+
+def test_value_errors_are_kept():
+    results = native_results(tables['text_to_number'])
+    assert results['B3'] == '#VALUE!'
+    assert results['B1'] == 12
+
+def test_cycle_cells_are_left_out():
+    same(native_results(cycles), cycles_xlcalculator)
+    same(evaluate_formulas(dict(cycles), ('test', 'cycles')), cycles_xlcalculator)
+
+## A range read past more than max_empty empty cells is evaluated by xlcalculator
+def test_long_empty_range_falls_back():
+    values = {'A1': 1, f'A{formula.max_empty + 5}': 2, 'B1': f'=SUM(A1:A{formula.max_empty + 5})', 'B2': '=B1+1'}
+    with pytest.raises(Unsupported):
+        native_results(values)
+    same(evaluate_formulas(dict(values), ('test', 'long_empty_range')), xlcalculator_results(dict(values)))
+
+def test_short_empty_range_is_native():
+    values = {'A1': 1, f'A{formula.max_empty}': 2, 'B1': f'=SUM(A1:A{formula.max_empty})'}
+    same(native_results(values), xlcalculator_results(dict(values)))
+
+def test_unsupported_function_falls_back():
+    values = {'A1': 4, 'A2': 2, 'B1': '=MAX(A1:A2)', 'B2': '=ROUND(A1/3,2)'}
+    with pytest.raises(Unsupported):
+        native_results(values)
+    same(evaluate_formulas(dict(values), ('test', 'functions')), xlcalculator_results(dict(values)))
+
+## The graph of a template is compiled once and reused for the tables with the same formulas
+def test_template_graph_is_reused():
+    cache = formula.FormulaCache()
+    formulas = formulas_of(tables['arithmetic'])
+    assert cache.get('t', formulas) is cache.get('t', dict(formulas))
+    assert cache.hits == 1 and cache.misses == 1
+    assert cache.get('t', dict(formulas, B5='=A1')) is not cache.get('t', formulas)
@@ -0,0 +1,42 @@
+## Importing the entry points is cheap and has no side effects, measured with python -X importtime in a clean process
+
+import os
+import subprocess
+import sys
+import pytest
+from conftest import root
+
+## Cumulative import time allowed for an entry point, in milliseconds
+import_budget_ms = float(os.getenv('IMPORT_TIME_BUDGET_MS', 200))
+heavy_modules = {'pandas', 'numpy', 'pymongo', 'boto3', 'bs4', 'xlcalculator', 'aiohttp', 'requests'}
+
+## Modules imported by `import <module>` with their cumulative import time in microseconds
+def import_times(module, cwd):
+    env = dict(os.environ, PYTHONPATH=root)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+@pytest.mark.parametrize('module', ['main', 'update_labels_local'])
+def test_entry_point_import(module, tmp_path):
+    times = import_times(module, tmp_path)
+    assert not heavy_modules & {name.split('.')[0] for name in times}
+    assert times[module] / 1000 <= import_budget_ms
+    assert list(tmp_path.iterdir()) == []
+
+## The download cache and the session are created on first use, not when the module is imported
+@pytest.mark.parametrize('module', ['download', 'codal_client', 'jalali'])
+def test_import_creates_no_files(module, tmp_path):
+    import_times(module, tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+@pytest.mark.parametrize('module', ['jalali', 'download'])
+def test_import_without_pandas(module, tmp_path):
+    times = import_times(module, tmp_path)
+    assert not {'numpy', 'pandas'} & {name.split('.')[0] for name in times}
@@ -0,0 +1,87 @@
+## Array conversions and the jdate accessor give the dates of the Persian and Gregorian classes, for every day of the supported range
+
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+import jalali
+from jalali import Gregorian, Persian
+
+first_day = datetime.date(1900, 3, 21)
+last_day = datetime.date(2094, 3, 19)
+days = [datetime.date.fromordinal(n) for n in range(first_day.toordinal(), last_day.toordinal() + 1)]
+
+@pytest.fixture(scope='module')
+def persian_days():
+    return [Gregorian(day).persian_tuple() for day in days]
+
+def test_range():
+    assert (jalali.first_year, jalali.last_year) == (1279, 1472)
+    assert Gregorian(first_day).persian_tuple() == (1279, 1, 1)
+    assert Gregorian(last_day).persian_tuple() == (1472, 12, 29)
+    assert Gregorian(last_day + datetime.timedelta(days=1)).persian_tuple() == (1473, 1, 1)
+
+def test_gregorian_to_jalali(persian_days):
+    year, month, day = jalali.gregorian_to_jalali(np.array([d.year for d in days]), np.array([d.month for d in days]), np.array([d.day for d in days]))
+    assert list(zip(year.tolist(), month.tolist(), day.tolist())) == persian_days
+
+def test_jalali_to_gregorian(persian_days):
+    year, month, day = (np.array(values) for values in zip(*persian_days))
+    assert list(zip(*(values.tolist() for values in jalali.jalali_to_gregorian(year, month, day)))) == [Persian(*date).gregorian_tuple() for date in persian_days]
+    assert list(zip(*(values.tolist() for values in jalali.jalali_to_gregorian(year, month, day)))) == [(d.year, d.month, d.day) for d in days]
+
+def test_ordinals(persian_days):
+    ordinals = np.array([d.toordinal() for d in days])
+    assert (jalali.jalali_to_ordinal(*(np.array(values) for values in zip(*persian_days))) == ordinals).all()
+    assert list(zip(*(values.tolist() for values in jalali.ordinal_to_gregorian(ordinals)))) == [(d.year, d.month, d.day) for d in days]
+
+## Every Jalali date of the range is valid, the day after the last day of each month is not
+def test_jalali_valid(persian_days):
+    year, month, day = (np.array(values) for values in zip(*persian_days))
+    assert jalali.jalali_valid(year, month, day).all()
+    last = {}
+    for y, m, d in persian_days:
+        last[y, m] = d
+    ends = np.array([(y, m, d + 1) for (y, m), d in last.items()])
+    assert not jalali.jalali_valid(ends[:, 0], ends[:, 1], ends[:, 2]).any()
+    assert sorted({d for (y, m), d in last.items() if m == 12}) == [29, 30]
+
+@pytest.mark.parametrize('date', [(1278, 12, 29), (1473, 1, 1), (1403, 0, 1), (1403, 13, 1), (1403, 7, 31), (1403, 1, 0), (1402, 12, 30)])
+def test_invalid_jalali_dates(date):
+    with pytest.raises(ValueError):
+        jalali.jalali_to_gregorian(*(np.array([value]) for value in date))
+
+@pytest.mark.parametrize('date', [(1900, 3, 20), (2094, 3, 20), (2023, 2, 29), (2024, 4, 31)])
+def test_invalid_gregorian_dates(date):
+    with pytest.raises(ValueError):
+        jalali.gregorian_to_jalali(*(np.array([value]) for value in date))
+
+def test_to_gregorian(persian_days):
+    jalali.register_accessor()
+    strings = pd.Series([f'{y}/{m:02d}/{d:02d}' for y, m, d in persian_days])
+    assert strings.jdate.to_gregorian().dt.date.tolist() == [Persian(*date).gregorian_datetime() for date in persian_days]
+
+def test_to_jalali(persian_days):
+    jalali.register_accessor()
+    dates = pd.Series(pd.to_datetime(days))
+    assert dates.jdate.to_jalali().tolist() == [Gregorian(d).persian_string('{}/{}/{}') for d in days]
+    assert dates.jdate.to_jalali('{}-{}-{}').tolist()[:2] == ['1279-01-01', '1279-01-02']
+
+def test_accessor_formats():
+    jalali.register_accessor()
+    series = pd.Series(['۱۴۰۳/۰۱/۰۱', '1393-1-11 10:30', '1393/01/11 10:30:15', None], name='date_j', index=[5, 6, 7, 8])
+    result = series.jdate.to_gregorian()
+    assert result.name == 'date_j' and result.index.tolist() == [5, 6, 7, 8]
+    assert result.tolist()[:3] == [pd.Timestamp('2024-03-20'), pd.Timestamp('2014-03-31 10:30'), pd.Timestamp('2014-03-31 10:30:15')]
+    assert pd.isna(result[8])
+    dates = pd.Series([pd.Timestamp('2014-03-31 10:30'), pd.NaT])
+    jalali_dates = dates.jdate.to_jalali()
+    assert jalali_dates[0] == '1393/01/11' and pd.isna(jalali_dates[1])
+
+def test_accessor_errors():
+    jalali.register_accessor()
+    series = pd.Series(['1402/12/30', '1403/12/30', 'not a date'])
+    with pytest.raises(ValueError):
+        series.jdate.to_gregorian()
+    result = series.jdate.to_gregorian(errors='coerce')
+    assert pd.isna(result[0]) and result[1] == pd.Timestamp('2025-03-20') and pd.isna(result[2])
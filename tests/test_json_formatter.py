@@ -0,0 +1,46 @@
+## json_formatter gives the rows of the transpose it replaced, with the same value types
+
+import math
+import numpy as np
+import pandas as pd
+import pytest
+from process import json_formatter
+
+## The formatting before the slices were walked once: NaN replaced by None, then one row per column of the transpose
+def old_json_formatter(sliced_df):
+    sliced_df = sliced_df.replace(to_replace=float('NaN'), value=None)
+    rows = sliced_df.iloc[:, 1:].T.set_axis(sliced_df.iloc[:, 0], axis='columns')
+    return dict(data=rows.apply(lambda row: dict(key=row.name, value=row.values.tolist()), axis=0).values.tolist(),
+                columns=sliced_df.columns[1:].to_list())
+
+def typed(obj):
+    if isinstance(obj, dict):
+        return {key: typed(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [typed(value) for value in obj]
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, float) and math.isnan(obj):
+        return ('nan',)
+    return (type(obj).__name__, obj)
+
+slices = {
+    'int_and_float': pd.DataFrame({'شرح': ['فروش', 'سود'], '1403': [1, 2], '1402': [1.5, 2.5]}),
+    'int_and_float_with_nan': pd.DataFrame({'شرح': ['فروش', 'سود'], '1403': [1, 2], '1402': [1.5, np.nan]}),
+    'ints': pd.DataFrame({'شرح': ['فروش', 'سود'], '1403': [1, 2], '1402': [3, 4]}),
+    'object': pd.DataFrame({'شرح': ['فروش', 'سود'], '1403': ['12', None], '1402': [1.5, 2.5]}),
+    'numeric_and_nan_keys': pd.DataFrame({'شرح': [1, np.nan], '1403': [1.5, 2.5]}),
+    'duplicate_columns': pd.DataFrame([['فروش', 1, 2.5], ['سود', 3, 4.5]], columns=['شرح', 'مبلغ', 'مبلغ']),
+}
+
+@pytest.mark.parametrize('name', sorted(slices))
+def test_same_as_transpose(name):
+    assert typed(json_formatter(slices[name])) == typed(old_json_formatter(slices[name]))
+
+## Without NaN an int column next to a float column is upcast to float, with NaN each value keeps its type
+def test_value_types():
+    assert json_formatter(slices['int_and_float'])['data'] == [dict(key='فروش', value=[1.0, 1.5]), dict(key='سود', value=[2.0, 2.5])]
+    assert [type(v) for v in json_formatter(slices['int_and_float'])['data'][0]['value']] == [float, float]
+    data = json_formatter(slices['int_and_float_with_nan'])['data']
+    assert data == [dict(key='فروش', value=[1, 1.5]), dict(key='سود', value=[2, None])]
+    assert type(data[0]['value'][0]) is int
@@ -0,0 +1,105 @@
+## Upserts by trace_no: batches cut by encoded size, write errors in the ledger and the stored labels kept on a rerun
+
+import bson
+import pytest
+from pymongo.errors import BulkWriteError, PyMongoError
+import mongo_writer
+from ledger import ledger
+from mongo_writer import bulk_upsert, upsert_batches
+
+class Result:
+    def __init__(self, matched, upserted):
+        self.matched_count, self.modified_count, self.upserted_count = matched, matched, upserted
+
+## A collection keeping the docs by trace_no, the replaces of the trace_nos in `failing` are write errors
+class FakeCollection:
+    def __init__(self, docs=(), failing=(), error=None):
+        self.docs = {doc['trace_no']: doc for doc in docs}
+        self.failing = set(failing)
+        self.error = error
+        self.batches = []
+
+    def find(self, query, projection=None):
+        return [doc for trace_no, doc in self.docs.items() if trace_no in query['trace_no']['$in']]
+
+    def bulk_write(self, requests, ordered=True):
+        if self.error:
+            raise self.error
+        self.batches.append([request._doc for request in requests])
+        matched = upserted = 0
+        errors = []
+        for index, request in enumerate(requests):
+            trace_no = request._filter['trace_no']
+            if trace_no in self.failing:
+                errors.append(dict(index=index, code=11000, errmsg=f'E11000 duplicate key error trace_no: {trace_no}'))
+                continue
+            matched, upserted = matched + (trace_no in self.docs), upserted + (trace_no not in self.docs)
+            self.docs[trace_no] = request._doc
+        if errors:
+            raise BulkWriteError(dict(writeErrors=errors, nMatched=matched, nModified=matched, nUpserted=upserted))
+        return Result(matched, upserted)
+
+@pytest.fixture(autouse=True)
+def clean_ledger():
+    ledger.reset()
+    yield
+    ledger.reset()
+
+def doc(trace_no, size=0):
+    return dict(trace_no=trace_no, body='x' * size)
+
+def test_batches_cut_by_bytes():
+    docs = [doc(n, 100) for n in range(10)]
+    size = len(bson.encode(docs[0]))
+    batches = list(upsert_batches(docs, max_bytes=3 * size, max_docs=100))
+    assert [len(batch) for batch, _ in batches] == [3, 3, 3, 1]
+    assert [batch_bytes for _, batch_bytes in batches] == [3 * size, 3 * size, 3 * size, size]
+    assert [d['trace_no'] for batch, _ in batches for d in batch] == list(range(10))
+
+def test_batches_cut_by_docs():
+    assert [len(batch) for batch, _ in upsert_batches([doc(n) for n in range(5)], max_bytes=10 ** 6, max_docs=2)] == [2, 2, 1]
+
+## A doc larger than max_bytes is sent alone, a doc over the document limit is left out and recorded
+def test_large_docs(monkeypatch):
+    monkeypatch.setattr(mongo_writer, 'max_doc_bytes', 1000)
+    docs = [doc(1, 10), doc(2, 600), doc(3, 2000), doc(4, 10)]
+    batches = list(upsert_batches(docs, max_bytes=500, max_docs=100))
+    assert [[d['trace_no'] for d in batch] for batch, _ in batches] == [[1], [2], [4]]
+    assert [(entry['trace_no'], entry['stage'], entry['kind']) for entry in ledger.records] == [('3', 'insert', 'Doc too large')]
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_bulk_upsert(workers):
+    collection = FakeCollection(docs=[doc(1)])
+    totals = bulk_upsert(collection, [doc(n, 100) for n in range(1, 8)], workers=workers, max_bytes=10 ** 6, max_docs=3)
+    assert {key: totals[key] for key in ('batches', 'docs', 'matched', 'upserted', 'errors')} == dict(batches=3, docs=7, matched=1, upserted=6, errors=0)
+    assert sorted(collection.docs) == list(range(1, 8))
+
+## The write errors of a batch are recorded by the trace_no at their index, the other docs are written
+def test_write_errors_in_the_ledger():
+    collection = FakeCollection(failing=[2, 5])
+    totals = bulk_upsert(collection, [doc(n) for n in range(1, 7)], workers=1, max_docs=3)
+    assert totals['errors'] == 2 and totals['upserted'] == 4
+    assert sorted(collection.docs) == [1, 3, 4, 6]
+    assert [(entry['trace_no'], entry['stage'], entry['kind']) for entry in ledger.records] == [('2', 'insert', 'Error Insert'), ('5', 'insert', 'Error Insert')]
+    assert 'E11000' in ledger.records[0]['error']
+    assert ledger.trace_nos('insert') == {'2', '5'}
+
+def test_failed_batch_records_every_doc():
+    totals = bulk_upsert(FakeCollection(error=PyMongoError('connection closed')), [doc(n) for n in range(1, 4)], workers=1)
+    assert totals['errors'] == 3
+    assert ledger.trace_nos('insert') == {'1', '2', '3'}
+
+def report(trace_no, rows, title='صورت سود و زیان'):
+    return dict(trace_no=trace_no, sheets=[dict(title_Fa=title, tables=[dict(data=rows, columns=['1403'])])])
+
+## The labels set by update_labels_local on the stored doc are kept when the report is replaced
+def test_labels_are_kept():
+    stored = report(1, [dict(key='فروش', value=[1], label='Revenue'), dict(key='سود', value=[2])])
+    collection = FakeCollection(docs=[stored, report(2, [dict(key='فروش', value=[1], label='Revenue')], title='other')])
+    new = [report(1, [dict(key='فروش', value=[10]), dict(key='سود', value=[20]), dict(key='جدید', value=[30])]),
+           report(2, [dict(key='فروش', value=[10])]), report(3, [dict(key='فروش', value=[10])])]
+    bulk_upsert(collection, new, workers=1)
+    assert collection.docs[1]['sheets'][0]['tables'][0]['data'] == [dict(key='فروش', value=[10], label='Revenue'), dict(key='سود', value=[20]), dict(key='جدید', value=[30])]
+    assert collection.docs[2]['sheets'][0]['tables'][0]['data'] == [dict(key='فروش', value=[10])]
+    assert 'label' not in collection.docs[3]['sheets'][0]['tables'][0]['data'][0]
+    assert 'label' not in new[0]['sheets'][0]['tables'][0]['data'][0]
@@ -0,0 +1,91 @@
+## normalize_table gives the same cells as the chain of cell maps it replaced, on generated tables
+
+import random
+import re
+import string
+import pandas as pd
+import pytest
+from unidecode import unidecode
+from process import normalize_table
+
+## The cell functions as they were before the tables were normalized column by column
+def old_process_negative_values(s):
+    return re.sub(r'\((\d+)\)', '-\\1', str(s))
+
+def old_pre_text(text):
+    if '%' in str(text):
+        return str(text).replace('%', '').strip()
+    elif str(text)=='nan':
+        return text
+    elif bool(re.match(r'^[+-]?([0-9]*[.])?[0-9]+$', str(text))):
+       return str(text).replace(',', '').strip()
+    elif bool(re.search(r'\d', str(text))):
+       return str(text).replace(',', '').strip()
+    else:
+       return str(text).strip().translate(str.maketrans(string.punctuation, ' '*len(string.punctuation)) ).replace('  ', ' ')
+
+def old_convert_unicode(s):
+    res = []
+    if str(s)=='nan':
+        return s
+    for word in str(s).split():
+        if bool(re.search(r'\d', str(word))):
+            res.append(unidecode(word))
+        else:
+            res.append(word)
+    return ' '.join(res)
+
+def old_normalize(df_table, numeric=False):
+    df_table = df_table.map(old_convert_unicode).map(old_pre_text).map(old_process_negative_values)
+    if numeric:
+        df_table = df_table.map(pd.to_numeric, errors='ignore')
+    return df_table
+
+persian_digits = '۰۱۲۳۴۵۶۷۸۹'
+arabic_digits = '٠١٢٣٤٥٦٧٨٩'
+pieces = list(persian_digits + arabic_digits + string.digits) + [',', '%', '(', ')', ' ', '  ', '-', '+', '.', '/', 'ریال', 'سود', 'abc', '٬', '‌', ':']
+
+def cell(rng):
+    kind = rng.random()
+    if kind < 0.05:
+        return float('nan')
+    if kind < 0.08:
+        return None
+    if kind < 0.12:
+        return rng.choice([0, -7, 1402, 2.5, -0.0, 10**12])
+    if kind < 0.2:
+        digits = rng.choice([persian_digits, arabic_digits, string.digits])
+        number = ''.join(rng.choice(digits) for _ in range(rng.randint(1, 9)))
+        return rng.choice(['({})', '{}%', '{},{}', '-{}', ' {} ', 'nan', '({}) ریال']).format(number, number[::-1])
+    return ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 12)))
+
+def table(rng):
+    n_columns = rng.randint(1, 6)
+    columns = [rng.choice(['شرح', '۱۴۰۲/۱۲/۲۹', '1401', 'مبلغ']) for _ in range(n_columns)]
+    rows = [[cell(rng) for _ in columns] for _ in range(rng.randint(0, 15))]
+    return pd.DataFrame(rows, columns=columns, dtype=object)
+
+def same_cells(new, old):
+    assert new.shape == old.shape
+    assert new.columns.tolist() == old.columns.tolist()
+    assert new.dtypes.tolist() == old.dtypes.tolist()
+    for (_, a), (_, b) in zip(new.items(), old.items()):
+        for x, y in zip(a.tolist(), b.tolist()):
+            if x != x:
+                assert y != y and type(x) is type(y)
+            else:
+                assert type(x) is type(y) and x == y, (x, y)
+
+@pytest.mark.parametrize('numeric', [False, True])
+@pytest.mark.parametrize('seed', range(20))
+def test_normalize_table_matches_cell_maps(seed, numeric):
+    rng = random.Random(seed)
+    for _ in range(10):
+        df = table(rng)
+        same_cells(normalize_table(df.copy(), numeric=numeric), old_normalize(df.copy(), numeric=numeric))
+
+## Columns with the same name are normalized separately, each keeps its own cells
+def test_duplicate_columns():
+    df = pd.DataFrame([['۱۲٬۳۴۵', '(۱۲)', 'nan'], ['٥%', 'سود', float('nan')]], columns=['شرح', 'مبلغ', 'مبلغ'], dtype=object)
+    for numeric in (False, True):
+        same_cells(normalize_table(df.copy(), numeric=numeric), old_normalize(df.copy(), numeric=numeric))
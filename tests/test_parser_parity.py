@@ -0,0 +1,38 @@
+## json_export gives the same documents whichever HTML parser backend reads the pages
+
+import json
+import pytest
+import parsing
+import process
+
+def export(rows, paths, parser, monkeypatch):
+    monkeypatch.setattr(parsing, 'html_parser', parser)
+    docs = [process.json_export(row, *paths) for row in rows]
+    return json.dumps(docs, cls=process.NpEncoder, ensure_ascii=False, sort_keys=True)
+
+def test_json_export_same_under_lxml_and_html5lib(codal_rows, codal_paths, monkeypatch):
+    assert export(codal_rows, codal_paths, 'lxml', monkeypatch) == export(codal_rows, codal_paths, 'html5lib', monkeypatch)
+
+@pytest.mark.parametrize('parser', ['lxml', 'html5lib'])
+def test_fixture_sheets_are_extracted(codal_rows, codal_paths, parser, monkeypatch):
+    docs = json.loads(export(codal_rows, codal_paths, parser, monkeypatch))
+    titles = {doc['trace_no']: [sheet['title_Fa'] for sheet in doc['sheets']] for doc in docs}
+    assert len(titles[1001]) == 3
+    assert 'صورت سود و زیان' in titles[1002]
+    assert titles[2001] == ['جریان وجوه نقد', 'صورت سود و زیان', 'صورت وضعیت مالی', 'یادداشت‌های تفسیری']
+
+@pytest.mark.parametrize('parser', ['lxml', 'html5lib'])
+def test_select_options(codal_paths, parser):
+    with open(codal_paths[0] + '2001-3.html', encoding='utf-8') as page:
+        assert parsing.select_options(page.read(), parser) == ('3', '\n\tجریان وجوه نقد', ['0'])
+
+## Sheets read from their html table are not failures, a clean report is not selected for reprocessing
+def test_html_table_sheets_are_not_failures(codal_rows, codal_paths):
+    from ledger import ledger
+    ledger.reset()
+    try:
+        for row in codal_rows:
+            process.json_export(row, *codal_paths)
+        assert ledger.trace_nos('process') == set()
+    finally:
+        ledger.reset()
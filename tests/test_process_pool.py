@@ -0,0 +1,123 @@
+## A report that kills its worker process is recorded as failed, the other reports are exported on new pools
+
+import os
+import threading
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+import pandas as pd
+import pytest
+import process
+import pipeline
+from ledger import ledger
+
+crashing = {'1003'}
+
+def fake_export(row, path_download_html, path_download_excel):
+    if str(row['trace_no']) in crashing:
+        os._exit(1)
+    if str(row['trace_no']) == '1005':
+        raise ValueError('bad table')
+    return dict(trace_no=row['trace_no'], pid=os.getpid())
+
+@pytest.fixture
+def reports(monkeypatch):
+    monkeypatch.setattr(process, 'json_export', fake_export)
+    ledger.reset()
+    yield pd.DataFrame(dict(trace_no=list(range(1001, 1011))))
+    ledger.reset()
+
+def test_process_reports_isolates_the_crashing_report(reports):
+    docs = process.process_reports(reports, 'html/', 'excel/', workers=2, chunk_size=3)
+    assert [doc['trace_no'] for doc in docs] == [1001, 1002, 1004, 1006, 1007, 1008, 1009, 1010]
+    assert all(doc['pid'] != os.getpid() for doc in docs)
+    assert ledger.trace_nos('process') == {'1003', '1005'}
+    kinds = {entry['trace_no']: entry['kind'] for entry in ledger.records}
+    assert kinds == {'1003': 'Worker Died', '1005': 'Process Error'}
+
+def test_pipeline_isolates_the_crashing_report(reports, monkeypatch):
+    monkeypatch.setenv('CODAL_CLIENT', 'requests')
+    monkeypatch.setattr(pipeline, 'download_sheets', lambda r, path_download_html, path_download_excel: None)
+    batches, exported = [], []
+    statuses = pipeline.run_pipeline(reports, reports, 'html/', 'excel/', insert=batches.append, export=exported.extend,
+                                     workers=2, inflight=4, batch_size=2, flush_seconds=0.1)
+    assert statuses == [dict(trace_no=t, status='inserted') for t in [1001, 1002, 1004, 1006, 1007, 1008, 1009, 1010]]
+    assert all(doc['pid'] != os.getpid() for doc in exported)
+    assert sorted(doc['trace_no'] for doc in exported) == [status['trace_no'] for status in statuses]
+    assert sorted(doc['trace_no'] for batch in batches for doc in batch) == [status['trace_no'] for status in statuses]
+    assert ledger.trace_nos('process') == {'1003', '1005'}
+    assert {entry['trace_no']: entry['kind'] for entry in ledger.records} == {'1003': 'Worker Died', '1005': 'Process Error'}
+
+## A run in a thread, a run that hangs fails the test instead of blocking it
+def run_in_thread(run):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(value=run()), daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), 'the run did not finish'
+    return result['value']
+
+def run_pipeline(reports, **kwargs):
+    return run_in_thread(lambda: pipeline.run_pipeline(reports, reports, 'html/', 'excel/', insert=lambda batch: None, workers=2, inflight=4,
+                                                       batch_size=2, flush_seconds=0.1, **kwargs))
+
+def test_pipeline_download_that_can_not_start(reports, monkeypatch):
+    monkeypatch.delenv('CODAL_CLIENT', raising=False)
+    def get_client():
+        raise RuntimeError('no event loop')
+    monkeypatch.setattr(pipeline, 'get_client', get_client)
+    statuses = run_pipeline(reports)
+    assert [status['trace_no'] for status in statuses] == [1001, 1002, 1004, 1006, 1007, 1008, 1009, 1010]
+    assert ledger.trace_nos('download') == {str(t) for t in range(1001, 1011)}
+
+def test_pipeline_isolated_export_that_raises(reports, monkeypatch):
+    monkeypatch.setenv('CODAL_CLIENT', 'requests')
+    monkeypatch.setattr(pipeline, 'download_sheets', lambda r, path_download_html, path_download_excel: None)
+    def export(self, row):
+        raise OSError('can not start a process')
+    monkeypatch.setattr(process.IsolatedExporter, 'export', export)
+    statuses = run_pipeline(reports)
+    assert 1003 not in [status['trace_no'] for status in statuses]
+    assert '1003' in ledger.trace_nos('process')
+
+## A pool that breaks while a report is submitted can drop it without failing its future, on Python 3.11 the
+## broken pool fails the futures it knows of without holding the lock submit takes
+class DroppingPool:
+    pools = []
+
+    def __init__(self):
+        self.submits = 0
+        DroppingPool.pools.append(self)
+
+    def submit(self, fn, rows, *args):
+        self.submits += 1
+        future = Future()
+        if len(DroppingPool.pools) > 1:
+            future.set_result(fn(rows, *args))
+        elif self.submits == 2:
+            future.set_exception(BrokenProcessPool('worker died'))
+        elif self.submits > 2:
+            raise BrokenProcessPool('pool is broken')
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+def test_pipeline_retries_reports_dropped_by_a_broken_pool(reports, monkeypatch):
+    monkeypatch.setenv('CODAL_CLIENT', 'requests')
+    monkeypatch.setattr(pipeline, 'download_sheets', lambda r, path_download_html, path_download_excel: None)
+    monkeypatch.setattr(pipeline, 'export_chunk_worker', lambda rows, *args: ([dict(trace_no=rows[0]['trace_no'])], []))
+    monkeypatch.setattr(DroppingPool, 'pools', [])
+    monkeypatch.setattr(pipeline, 'process_pool', contextmanager(lambda workers: (yield DroppingPool())))
+    monkeypatch.setattr(process.IsolatedExporter, 'export', lambda self, row: dict(trace_no=row['trace_no']))
+    statuses = run_pipeline(reports)
+    assert sorted(status['trace_no'] for status in statuses) == list(range(1001, 1011))
+    assert len(DroppingPool.pools) == 2
+
+def test_process_reports_retries_tasks_dropped_by_a_broken_pool(reports, monkeypatch):
+    monkeypatch.setattr(process, 'export_chunk_worker', lambda rows, *args: ([dict(trace_no=row['trace_no']) for row in rows], []))
+    monkeypatch.setattr(DroppingPool, 'pools', [])
+    monkeypatch.setattr(process, 'process_pool', contextmanager(lambda workers: (yield DroppingPool())))
+    docs = run_in_thread(lambda: process.process_reports(reports, 'html/', 'excel/', workers=2, chunk_size=3))
+    assert [doc['trace_no'] for doc in docs] == list(range(1001, 1011))
+    assert len(DroppingPool.pools) == 2
@@ -0,0 +1,210 @@
+## Sync of a run folder to S3 against an in-memory S3 client: ETags computed like S3, unchanged files skipped, excluded folders not walked
+
+import hashlib
+import io
+import json
+import os
+import zipfile
+import pytest
+import sync
+from boto3.s3.transfer import TransferConfig
+from sync import list_local_files, local_etag, sync_directory_to_s3
+
+class Paginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix=''):
+        keys = sorted(key for bucket, key in self.s3.objects if bucket == Bucket and key.startswith(Prefix))
+        for start in range(0, max(len(keys), 1), 2):
+            yield dict(Contents=[dict(Key=key, Size=len(self.s3.objects[Bucket, key]), ETag=f'"{self.s3.etags[Bucket, key]}"') for key in keys[start:start + 2]])
+
+class Body:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+## The calls of the boto3 S3 client used by sync, objects are kept in memory with the ETag S3 would give them
+class FakeS3:
+    def __init__(self):
+        self.objects, self.etags, self.uploads, self.parts = {}, {}, [], {}
+
+    def get_paginator(self, name):
+        assert name == 'list_objects_v2'
+        return Paginator(self)
+
+    def upload_file(self, local_path, bucket, key, Config=None):
+        with open(local_path, 'rb') as data:
+            body = data.read()
+        self.uploads.append(key)
+        self.objects[bucket, key] = body
+        if len(body) < Config.multipart_threshold:
+            self.etags[bucket, key] = hashlib.md5(body).hexdigest()
+        else:
+            chunks = [body[n:n + Config.multipart_chunksize] for n in range(0, len(body), Config.multipart_chunksize)]
+            self.etags[bucket, key] = hashlib.md5(b''.join(hashlib.md5(chunk).digest() for chunk in chunks)).hexdigest() + f'-{len(chunks)}'
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Bucket, Key] = bytes(Body)
+        self.etags[Bucket, Key] = hashlib.md5(Body).hexdigest()
+
+    def get_object(self, Bucket, Key, Range=None):
+        body = self.objects[Bucket, Key]
+        if Range is not None:
+            first, last = Range[len('bytes='):].split('-')
+            body = body[int(first):int(last) + 1]
+        return dict(Body=Body(body))
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f'upload-{len(self.parts)}'
+        self.parts[upload_id] = []
+        return dict(UploadId=upload_id)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        assert PartNumber == len(self.parts[UploadId]) + 1
+        self.parts[UploadId].append(Body)
+        return dict(ETag=f'"{hashlib.md5(Body).hexdigest()}"')
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        assert [part['PartNumber'] for part in MultipartUpload['Parts']] == list(range(1, len(self.parts[UploadId]) + 1))
+        self.put_object(Bucket, Key, b''.join(self.parts.pop(UploadId)))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.parts.pop(UploadId)
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as output:
+        output.write(data)
+
+@pytest.fixture
+def run_folder(tmp_path):
+    folder = tmp_path / 'run'
+    write(str(folder / 'logs' / 'updates.log'), b'log')
+    write(str(folder / 'export' / 'fs_success_data.jsonl'), b'{"trace_no": 1}\n' * 10)
+    write(str(folder / 'fs-sheets' / 'html' / '1001-0.html'), '<html>صورت</html>'.encode('utf-8'))
+    write(str(folder / 'fs-sheets' / 'html' / '1001-0.json'), b'{}')
+    write(str(folder / '.codal-cache' / 'index.sqlite'), b'cache')
+    write(str(folder / 'notes.txt'), b'notes')
+    return str(folder)
+
+small_parts = TransferConfig(multipart_threshold=64, multipart_chunksize=64)
+
+@pytest.mark.parametrize('size, config', [(0, small_parts), (10, small_parts), (64, small_parts), (200, small_parts), (200, TransferConfig())])
+def test_local_etag_matches_s3(tmp_path, size, config):
+    path = str(tmp_path / 'file')
+    write(path, os.urandom(size))
+    s3 = FakeS3()
+    s3.upload_file(path, 'bucket', 'file', Config=config)
+    assert local_etag(path, size, config) == s3.etags['bucket', 'file']
+    assert local_etag(path, size, config).endswith('-4') == (size == 200 and config is small_parts)
+
+def test_unchanged_files_are_skipped(run_folder):
+    s3 = FakeS3()
+    first = sync_directory_to_s3(run_folder, 'bucket', s3, s3_prefix='update_db/run', transfer_config=small_parts, max_workers=4)
+    assert first['files'] == 6 and first['skipped'] == 0 and first['failed'] == 0
+    assert sync_directory_to_s3(run_folder, 'bucket', s3, s3_prefix='update_db/run', transfer_config=small_parts)['skipped'] == 6
+    write(os.path.join(run_folder, 'logs', 'updates.log'), b'lag')
+    write(os.path.join(run_folder, 'export', 'fs_success_data.jsonl'), b'{"trace_no": 2}\n' * 10)
+    s3.uploads.clear()
+    third = sync_directory_to_s3(run_folder, 'bucket', s3, s3_prefix='update_db/run', transfer_config=small_parts)
+    assert sorted(s3.uploads) == ['update_db/run/export/fs_success_data.jsonl', 'update_db/run/logs/updates.log']
+    assert third['files'] == 2 and third['skipped'] == 4
+
+def test_upload_all_without_skip(run_folder):
+    s3 = FakeS3()
+    sync_directory_to_s3(run_folder, 'bucket', s3, transfer_config=small_parts)
+    assert sync_directory_to_s3(run_folder, 'bucket', s3, transfer_config=small_parts, skip_unchanged=False)['files'] == 6
+
+def test_failed_uploads_are_counted(run_folder):
+    s3 = FakeS3()
+    def upload_file(local_path, bucket, key, Config=None):
+        if key.endswith('.html'):
+            raise OSError('connection reset')
+        FakeS3.upload_file(s3, local_path, bucket, key, Config)
+    s3.upload_file = upload_file
+    summary = sync_directory_to_s3(run_folder, 'bucket', s3, transfer_config=small_parts)
+    assert summary['failed'] == 1 and summary['files'] == 5
+
+## The run folder sync of main: the parsed documents and the cache are not uploaded, and their folders are not walked
+def test_excluded_files_and_folders(run_folder, monkeypatch):
+    walked = []
+    walk = os.walk
+    def spy(top, *args, **kwargs):
+        for root, dirs, files in walk(top, *args, **kwargs):
+            walked.append(os.path.relpath(root, top))
+            yield root, dirs, files
+    monkeypatch.setattr(sync.os, 'walk', spy)
+    excludes = ['*.txt', '.codal-cache/*', 'fs-sheets/html/*.json']
+    assert sorted(relative for _, relative in list_local_files(run_folder, excludes)) == \
+        ['export/fs_success_data.jsonl', 'fs-sheets/html/1001-0.html', 'logs/updates.log']
+    assert '.codal-cache' not in walked and 'fs-sheets/html' in walked
+    walked.clear()
+    assert sorted(relative for _, relative in list_local_files(run_folder, excludes + ['fs-sheets/*'])) == ['export/fs_success_data.jsonl', 'logs/updates.log']
+    assert not [root for root in walked if root.startswith('fs-sheets')]
+
+def test_should_exclude():
+    assert sync.should_exclude('fs-sheets/html/1001-0.json', ['fs-sheets/html/*.json'])
+    assert not sync.should_exclude('fs-sheets/html/1001-0.html', ['fs-sheets/html/*.json'])
+    assert not sync.should_exclude('a.txt', [])
+
+## Archive mode: the files are streamed into one zip, each one is read back with a ranged GET given by the index manifest
+@pytest.fixture
+def sheets(tmp_path):
+    folder = tmp_path / 'fs-sheets'
+    write(str(folder / 'html' / '1001-0.html'), '<html>صورت سود و زیان</html>'.encode('utf-8') * 100)
+    write(str(folder / 'html' / '1001-0.json'), b'{}')
+    write(str(folder / 'html' / 'empty.html'), b'')
+    write(str(folder / 'excel' / '1002.xls'), os.urandom(6 * 1024 * 1024))
+    return str(folder)
+
+def read(path):
+    with open(path, 'rb') as data:
+        return data.read()
+
+def test_archive_and_fetch(sheets):
+    s3 = FakeS3()
+    summary = sync_directory_to_s3(sheets, 'bucket', s3, exclude_patterns=['html/*.json'], archive_key='update_db/run/fs-sheets.zip')
+    assert summary['files'] == 3
+    archive = s3.objects['bucket', 'update_db/run/fs-sheets.zip']
+    assert summary['archive_bytes'] == len(archive)
+    assert sorted(zipfile.ZipFile(io.BytesIO(archive)).namelist()) == ['excel/1002.xls', 'html/1001-0.html', 'html/empty.html']
+    manifest = json.loads(s3.objects['bucket', 'update_db/run/fs-sheets.zip.index.json'])
+    assert manifest['archive'] == 'update_db/run/fs-sheets.zip'
+    index = sync.load_archive_index(s3, 'bucket', 'update_db/run/fs-sheets.zip')
+    assert sorted(index) == ['excel/1002.xls', 'html/1001-0.html', 'html/empty.html']
+    for name in index:
+        expected = read(os.path.join(sheets, *name.split('/')))
+        assert sync.fetch_archived_file(s3, 'bucket', 'update_db/run/fs-sheets.zip', name) == expected
+        assert sync.fetch_archived_file(s3, 'bucket', 'update_db/run/fs-sheets.zip', name, index=index) == expected
+
+## With parts of 5 MB the 6 MB file makes the archive larger than one part, it is sent as a multipart upload
+def test_archive_is_uploaded_in_parts(sheets, monkeypatch):
+    monkeypatch.setattr(sync.S3MultipartWriter.__init__, '__defaults__', (5 * sync.MB,))
+    s3 = FakeS3()
+    calls = []
+    upload_part = s3.upload_part
+    s3.upload_part = lambda **kwargs: calls.append(kwargs['PartNumber']) or upload_part(**kwargs)
+    sync.archive_files_to_s3(list_local_files(sheets, []), 'bucket', s3, 'run.zip')
+    assert calls == [1, 2] and s3.parts == {}
+    assert sync.fetch_archived_file(s3, 'bucket', 'run.zip', 'excel/1002.xls') == read(os.path.join(sheets, 'excel', '1002.xls'))
+
+def test_fetch_checks_the_crc(sheets):
+    s3 = FakeS3()
+    sync.archive_files_to_s3(list_local_files(sheets, []), 'bucket', s3, 'run.zip')
+    index = sync.load_archive_index(s3, 'bucket', 'run.zip')
+    index['html/1001-0.html']['crc'] ^= 1
+    with pytest.raises(ValueError):
+        sync.fetch_archived_file(s3, 'bucket', 'run.zip', 'html/1001-0.html', index=index)
+
+## A failed archive aborts its multipart upload and writes no manifest
+def test_failed_archive_is_aborted(sheets, monkeypatch):
+    monkeypatch.setattr(sync.S3MultipartWriter.__init__, '__defaults__', (5 * sync.MB,))
+    s3 = FakeS3()
+    files = list_local_files(sheets, [])
+    files.append((os.path.join(sheets, 'missing.html'), 'missing.html'))
+    with pytest.raises(OSError):
+        sync.archive_files_to_s3(sorted(files, key=lambda file: file[1] != 'excel/1002.xls'), 'bucket', s3, 'run.zip')
+    assert s3.parts == {} and ('bucket', 'run.zip.index.json') not in s3.objects
@@ -1,45 +1,60 @@
-from pymongo import MongoClient, errors
-import pandas as pd
-from dotenv import load_dotenv
 import logging
 import os
 from utils import get_s3_client, download_file
 
-logging.basicConfig(
-   level=logging.INFO,  # Set the logging level
-   format="%(asctime)s - %(levelname)s - %(message)s",
-   handlers=[
-   logging.FileHandler("logs/update_labels.log", encoding='utf-8'),
-   ]
-)
+collection = None
 
-load_dotenv()
-MONGODB_URI = os.environ['MONGODB_URI']
+# Logging, .env and the MongoDB connection are set up by init, not when the module is imported
+# pymongo and pandas are imported where they are used
+def init():
+   global collection
+   from dotenv import load_dotenv
+   from pymongo import MongoClient
+   logging.basicConfig(
+      level=logging.INFO,  # Set the logging level
+      format="%(asctime)s - %(levelname)s - %(message)s",
+      handlers=[
+      logging.FileHandler("logs/update_labels.log", encoding='utf-8'),
+      ]
+   )
 
-# Connect to your MongoDB cluster:
-client = MongoClient(MONGODB_URI)
-print("Connected to MongoDB server.")
-db = client['fin-statements']
-collection = db['new']
+   load_dotenv()
+   MONGODB_URI = os.environ['MONGODB_URI']
+
+   # Connect to your MongoDB cluster:
+   client = MongoClient(MONGODB_URI)
+   print("Connected to MongoDB server.")
+   db = client['fin-statements']
+   collection = db['new']
+
+def label_filter(row):
+   return {  
+      "$and":
+      [ 
+         # {'lastModified': {'$exists': True}},
+         {"sheets.tables.data.key": row['distinctValues']},
+         # {"sheets.tables": { "$exists": "true", "$not": {"$size": 0}}},
+         {"sheets.title_Fa": row['sheet']}
+      ]
+   # '_id': id
+   }
+
+def label_update(row):
+   return {
+      "$set": {"sheets.$[sheet].tables.$[].data.$[element].label": row['Label']}
+   }
+
+def label_array_filters(row):
+   # return [ {"sheet.title_Fa": row['sheet']} ,{"element.key": row['distinctValues'].replace('ی', 'ي') } ] 
+   return [ {"sheet.title_Fa": row['sheet']} ,{"element.key": row['distinctValues']} ] 
 
 def update_labels(row):
+   from pymongo import errors
    try:
       result = collection.update_many(
-         {  
-            "$and":
-            [ 
-               # {'lastModified': {'$exists': True}},
-               {"sheets.tables.data.key": row['distinctValues']},
-               # {"sheets.tables": { "$exists": "true", "$not": {"$size": 0}}},
-               {"sheets.title_Fa": row['sheet']}
-            ]
-         # '_id': id
-         },
-         {
-            "$set": {"sheets.$[sheet].tables.$[].data.$[element].label": row['Label']}
-         },
-         # array_filters=[ {"sheet.title_Fa": row['sheet']} ,{"element.key": row['distinctValues'].replace('ی', 'ي') } ] 
-         array_filters=[ {"sheet.title_Fa": row['sheet']} ,{"element.key": row['distinctValues']} ] 
+         label_filter(row),
+         label_update(row),
+         array_filters=label_array_filters(row)
       )
       if result.modified_count!=0:
          # logging.info(f"No of modified: {result.modified_count}")
@@ -51,8 +66,45 @@ def update_labels(row):
       logging.info(f"Operation failed: {e}")
    except errors.PyMongoError as e:
       logging.info(f"An error occurred: {e}")
-   
+
+## Multikey index on the row keys the label filters match on, created once if it is missing
+def ensure_label_index():
+   from pymongo import errors
+   try:
+      indexes = collection.index_information()
+      if not any(index['key'] == [("sheets.tables.data.key", 1)] for index in indexes.values()):
+         collection.create_index("sheets.tables.data.key")
+         logging.info("Created the index on sheets.tables.data.key.")
+   except errors.PyMongoError as e:
+      logging.info(f"Could not create the label index: {e}")
+
+## The labels of each sheet are sent as bulk_write batches of UpdateMany, the modified count is logged per sheet
+## Batches are unordered, so only the last label of a key in a sheet is kept, as it was the one applied last row by row
+def update_labels_bulk(label_df, batch_size=None):
+   from pymongo import UpdateMany, errors
+   batch_size = batch_size or int(os.getenv('LABELS_BATCH_SIZE', 500))
+   ensure_label_index()
+   modified = {}
+   for sheet, sheet_df in label_df.groupby('sheet', sort=False, dropna=False):
+      sheet_df = sheet_df.drop_duplicates(subset='distinctValues', keep='last')
+      operations = [UpdateMany(label_filter(row), label_update(row), array_filters=label_array_filters(row)) for _, row in sheet_df.iterrows()]
+      modified[sheet] = 0
+      for i in range(0, len(operations), batch_size):
+         try:
+            result = collection.bulk_write(operations[i:i+batch_size], ordered=False)
+            modified[sheet] += result.modified_count
+         except errors.BulkWriteError as bwe:
+            modified[sheet] += bwe.details.get('nModified', 0)
+            for err in bwe.details.get('writeErrors', []):
+               logging.info(f"Operation failed for label {sheet_df.iloc[i + err['index']]['Label']} in sheet {sheet}: {err['errmsg']}")
+         except errors.PyMongoError as e:
+            logging.info(f"An error occurred in sheet {sheet}: {e}")
+      logging.info(f"No of modified in sheet {sheet}: {modified[sheet]} ({len(operations)} labels)")
+   return modified
+
 if __name__=="__main__":
+   import pandas as pd
+   init()
    s3_client = get_s3_client()
    bucket_name = os.getenv('BUCKET_NAME')
    download_file(s3_client, bucket_name, 'Label.xlsx')
@@ -61,8 +113,11 @@ if __name__=="__main__":
    label_df_fill = label_df.replace({float('nan'): None})
    label_df_fill['Label'] = label_df_fill['Label'].str.replace('ي', 'ی')
 
-   for _, row in label_df_fill.iterrows():
-      update_labels(row)
+   if os.getenv('LABELS_MODE', 'bulk') == 'bulk':
+      update_labels_bulk(label_df_fill)
+   else:
+      for _, row in label_df_fill.iterrows():
+         update_labels(row)
    # rows = [row for _, row in label_df_fill[label_df_fill['distinctValues'].str.contains('ی')].iterrows()]
    # rows = [row for _, row in label_df_fill.iterrows()]
    # pool = Pool(processes=8)
@@ -1,10 +1,11 @@
 # utils.py
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
+# boto3 is imported when a client is created, importing utils stays cheap
 import os 
 
 # Initialize S3 client
 def get_s3_client():
+    import boto3
+    from botocore.exceptions import NoCredentialsError
     try:
         s3_client = boto3.client(
             "s3",
@@ -19,6 +20,7 @@ def get_s3_client():
 
 # List all buckets
 def list_buckets(s3_client):
+    from botocore.exceptions import ClientError
     try:
         response = s3_client.list_buckets()
         return [bucket['Name'] for bucket in response.get('Buckets', [])]